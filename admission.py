@@ -0,0 +1,81 @@
+"""Admission control: which connections the server takes on, and for how long.
+
+Every accepted connection is admitted here before a thread or task is started
+for it. Past max_connections open connections, or max_unauthenticated that
+have not logged in (or sent LISTEN) yet, a new connection is told so in a frame
+and closed right away, so a reconnect storm costs one accept() and one write
+per connection over the limit instead of a thread each. A connection that has
+not logged in within auth_timeout seconds is closed as well, and so is one
+that announces a frame larger than max_frame_size (see framing.py), and one
+that lets more than outbound_queue_bytes of replies pile up unread.
+
+Every refusal is counted by reason, see stats().
+"""
+import threading
+
+# why a connection was refused or closed
+TOO_MANY_CONNECTIONS = "too_many_connections"
+TOO_MANY_UNAUTHENTICATED = "too_many_unauthenticated"
+AUTH_TIMEOUT = "auth_timeout"
+FRAME_TOO_LARGE = "frame_too_large"
+OUTBOUND_FULL = "outbound_full"
+REASONS = (TOO_MANY_CONNECTIONS, TOO_MANY_UNAUTHENTICATED, AUTH_TIMEOUT, FRAME_TOO_LARGE, OUTBOUND_FULL)
+
+# what the client is told before the connection is closed
+NOTICES = {
+    TOO_MANY_CONNECTIONS: "Connection refused. Too many connections, try again later.",
+    TOO_MANY_UNAUTHENTICATED: "Connection refused. Too many connections logging in, try again later.",
+    AUTH_TIMEOUT: "Connection closed. Not logged in in time.",
+    FRAME_TOO_LARGE: "Connection closed. Frame too large.",
+    OUTBOUND_FULL: "Connection closed. Too many replies not read.",
+}
+
+
+class Admission:
+    """The open connections of a server, and the counters of those it refused."""
+
+    def __init__(self, max_connections=10000, max_unauthenticated=1000):
+        self.max_connections = max_connections
+        self.max_unauthenticated = max_unauthenticated
+        self.connections = set() # sockets (or StreamSockets) of every open client connection
+        self.unauthenticated = set() # of them, those that have not logged in or sent LISTEN yet
+        self.lock = threading.Lock()
+
+        # counters
+        self.admitted = 0
+        self.refused = dict.fromkeys(REASONS, 0)
+
+
+    # returns None if the connection is taken on, else the reason it is not (to be counted with refuse())
+    def admit(self, sock):
+        with self.lock:
+            if len(self.connections) >= self.max_connections:
+                return TOO_MANY_CONNECTIONS
+            if len(self.unauthenticated) >= self.max_unauthenticated:
+                return TOO_MANY_UNAUTHENTICATED
+            self.connections.add(sock)
+            self.unauthenticated.add(sock)
+            self.admitted += 1
+            return None
+
+
+    def authenticated(self, sock):
+        with self.lock:
+            self.unauthenticated.discard(sock)
+
+
+    def refuse(self, reason):
+        with self.lock:
+            self.refused[reason] += 1
+
+
+    def release(self, sock):
+        with self.lock:
+            self.connections.discard(sock)
+            self.unauthenticated.discard(sock)
+
+
+    def stats(self):
+        with self.lock:
+            return {"connections": len(self.connections), "unauthenticated": len(self.unauthenticated),
+                    "admitted": self.admitted, "refused": dict(self.refused)}
@@ -0,0 +1,378 @@
+import time
+import asyncio
+import logging
+import traceback
+import framing
+from server import Server
+from user import User
+from pipeline import Reply
+import protocol_v2
+from protocol_v2 import BinarySocket
+from outbound import AsyncOutboundQueue
+import admission
+from framing import FrameTooLarge
+
+logger = logging.getLogger(__name__)
+
+
+class StreamSocket:
+    """Socket-like wrapper around an asyncio StreamWriter.
+
+    The request handlers of Server only ever write to a socket, so handing them
+    this wrapper lets both engines share the same handler code. Writes go into
+    the transport buffer and never block the event loop. A handler may also run
+    on another thread (see AsyncServer.reads_block), its writes are then handed
+    to the loop, in order.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+
+    def on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def sendall(self, data):
+        if self.on_loop():
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, bytes(data))
+
+    def sendmsg(self, buffers):
+        if self.on_loop():
+            self.writer.writelines(buffers)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, b"".join(buffers))
+        return sum(len(buf) for buf in buffers)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def close(self):
+        if self.on_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncServer(Server):
+    """Runs every connection on a single asyncio event loop instead of one thread per socket.
+
+    Speaks the same wire protocol and shares the request handlers with Server,
+    only the accept loop and the reads are asynchronous, and so are the
+    requests that change the registry (LOGIN, REGISTER, LISTEN, LOGOUT,
+    CREATE_ROOM, ADD_PARTICIPANTS): they await the *_async changes below, which
+    a cluster node only completes once the change has gone around the bus (see
+    replica.Replica).
+    """
+
+    def run_server(self):
+        asyncio.run(self.serve())
+
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+        async with server:
+            await server.serve_forever()
+
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        print(f"Client connected: {addr}")
+        client_socket = StreamSocket(writer)
+        reason = self.admission.admit(client_socket)
+        if reason:
+            self.refuse(client_socket, reason)
+            self.cleanup_client(client_socket)
+            return
+        await self.handle_auth_async(reader, client_socket, addr)
+
+
+    async def handle_auth_async(self, reader, client_socket, addr):
+        username = None
+        deadline = time.monotonic() + self.config.auth_timeout # for the whole login, not each request
+        while True:
+            try:
+                _, msg = await asyncio.wait_for(self.receive_request_async(reader, client_socket),
+                                                max(deadline - time.monotonic(), 0))
+                action = msg[0]
+                self.logger.debug(f"Client chose action: {action}")
+
+                if action == protocol_v2.HELLO:
+                    client_socket = self.negotiate_protocol(client_socket, msg)
+                    continue
+
+                elif action == "REGISTER":
+                    await self.register_async(client_socket, msg, addr)
+                    continue
+
+                elif action == "LOGIN":
+                    username = await self.login_async(client_socket, msg, addr)
+                    if username:
+                        self.authenticated(client_socket)
+                        await self.on_login_success_async(username, reader, client_socket)
+                        break
+                    elif username == None:
+                        continue
+                    else:#if username == False
+                        self.cleanup_client(client_socket)
+                        break
+
+                elif action == "LISTEN":
+                    username = msg[1]
+                    self.authenticated(client_socket)
+                    await self.add_listening_socket_async(username, client_socket)
+                    await self.hold_listening_connection(reader, username, client_socket)
+                    break
+
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.logger.debug(f"Client {addr} disconnected before logging in")
+                self.cleanup_client(client_socket)
+                break
+
+            except TimeoutError:
+                self.refuse(client_socket, admission.AUTH_TIMEOUT)
+                self.cleanup_client(client_socket)
+                break
+
+            except FrameTooLarge:
+                self.refuse(client_socket, admission.FRAME_TOO_LARGE)
+                self.cleanup_client(client_socket)
+                break
+
+            except Exception as e:
+                self.logger.error("Exception in handle_auth_async():")
+                self.logger.exception(e)
+                self.cleanup_client(client_socket)
+                break
+
+
+    # Server.login() and register() with the password hashing awaited instead of waited for (see credentials.py)
+    async def login_async(self, client_socket, msg, addr):
+        try:
+            verification = self.begin_login(client_socket, msg)
+            if verification is None:
+                return None
+            verified = await asyncio.wrap_future(verification)
+            if not verified:
+                return self.end_login(client_socket, msg, addr, verified)
+            accepted = await self.accept_login_async(User(msg[1], None, socket=client_socket, address=addr))
+            return self.answer_login(client_socket, msg, accepted)
+
+        except Exception as e:
+            self.send_all(client_socket, "Login failed. Ran into exception server-side!")
+            self.logger.error(f"Ran into Exception during login_async(): {e}")
+            return False
+
+
+    async def register_async(self, client_socket, msg, addr):
+        try:
+            hashing = self.begin_register(client_socket, msg)
+            if hashing is None:
+                return None
+            password_hash = await asyncio.wrap_future(hashing)
+            added = await self.add_registered_user_async(User(msg[1], password_hash, socket=None, address=addr))
+            return self.answer_register(client_socket, msg, added)
+
+        except Exception as e:
+            self.send_all(client_socket, "Registration failed. Ran into exception server-side!")
+            self.logger.error(f"Ran into Exception during register_async(): {e}")
+            return False
+
+
+    # the event loop must not block on the log committer, then() runs on the loop once the write is done
+    def when_durable(self, durable, then, wait=True):
+        if durable.done():
+            super().when_durable(durable, then)
+            return
+        durable.add_done_callback(
+            lambda done: self.loop.call_soon_threadsafe(Server.when_durable, self, done, then))
+
+
+    def create_outbound_queue(self, sock, username):
+        return AsyncOutboundQueue(sock, self.config.outbound_queue_size, self.config.outbound_policy,
+                                  name=username, lagged_notice=self.encode_frame("LAGGED"),
+                                  max_bytes=self.config.outbound_queue_bytes)
+
+
+    async def on_login_success_async(self, username, reader, client_socket):
+        while True:
+            try:
+                request_id, msg = await self.receive_request_async(reader, client_socket)
+                self.logger.debug(f"Received msg from client: {msg}")
+
+                # handlers never block on this engine, so pipelined requests are simply answered in order
+                sock = Reply(client_socket, request_id) if request_id is not None else client_socket
+                if not await self.handle_action_async(username, reader, sock, msg):
+                    break
+
+                # the next request is only read once the replies are below the transport's high-water mark,
+                # so a client that does not read them cannot make them pile up in memory
+                if self.unread_replies(client_socket) > self.config.outbound_queue_bytes:
+                    self.refuse(client_socket, admission.OUTBOUND_FULL)
+                    await self.logout_async(username, client_socket)
+                    break
+                await self.raw_socket(client_socket).writer.drain()
+
+            except FrameTooLarge:
+                self.refuse(client_socket, admission.FRAME_TOO_LARGE)
+                await self.logout_async(username, client_socket)
+                break
+
+            except Exception as e:
+                self.logger.error("Exception in on_login_success_async():")
+                traceback.print_exception(e)
+                await self.logout_async(username, client_socket)
+                break
+
+
+    # bytes written to the connection that the transport has not sent yet
+    def unread_replies(self, client_socket):
+        return self.raw_socket(client_socket).writer.transport.get_write_buffer_size()
+
+
+    # Server.handle_action() with the requests that change the registry awaited
+    async def handle_action_async(self, username, reader, client_socket, msg):
+        action = msg[0]
+        if action == "LOGOUT":
+            await self.logout_async(username, client_socket)
+            return False
+
+        elif action == "CREATE_ROOM":
+            await self.create_room_async(username, client_socket, msg)
+
+        elif action == "ADD_PARTICIPANTS":
+            await self.add_participants_async(username, reader, client_socket, msg)
+
+        elif action in ("SELECT_ROOM", "HISTORY", "SEARCH") and self.reads_block(username, msg):
+            # on the request pool, the loop goes on with the other connections while the pages are read
+            return await asyncio.wrap_future(self.request_pool.submit(self.handle_action, username, client_socket, msg))
+
+        else:
+            return self.handle_action(username, client_socket, msg)
+
+        return True
+
+
+    # the steps of Server.logout(), create_room() and add_participants(), awaiting the registry and the client
+    async def logout_async(self, username, client_socket):
+        self.answer_logout(username, client_socket)
+        if username:
+            await self.release_login_async(username)
+
+        self.cleanup_client(client_socket)
+
+
+    async def create_room_async(self, username, client_socket, msg):
+        room = self.room_to_create(msg)
+        if await self.add_room_async(room):
+            await self.add_participant_async(room, username)
+            self.logger.debug("Room created successfully.\n")
+        self.answer_pipelined(client_socket, "SUCCESSFULLY CREATED ROOM!")
+
+
+    # ADD_PARTICIPANTS of a lockstep text client waits for a second frame from the client
+    async def add_participants_async(self, username, reader, client_socket, msg):
+        try:
+            room_name = msg[1]
+            if room_name not in self.rooms:
+                self.send_all(client_socket, "Access Denied!")
+                return
+            new_participants = self.requested_participants(client_socket, msg)
+            if new_participants is None and self.choice_follows(client_socket):
+                new_participants = await self.receive_async(reader)
+            await self.apply_new_participants_async(room_name, new_participants)
+            self.answer_named_participants(client_socket, msg)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise
+
+        except Exception as e:
+            self.logger.error(f"Exception in add_participants_async(): {e}")
+
+
+    async def apply_new_participants_async(self, room_name, new_participants):
+        for participant in self.split_participants(new_participants):
+            await self.add_participant_async(self.rooms[room_name], participant)
+
+
+    # whether the history a SELECT_ROOM, HISTORY or SEARCH reads may have to come from another process,
+    # a read that blocks; pages of a single process are in memory or in its own logs
+    def reads_block(self, username, msg):
+        return False
+
+
+    # CHANGES TO THE REGISTRY, made right away in a single process; a cluster node completes
+    # them once they have gone around the bus, without blocking the loop (see replica.Replica)
+    async def add_room_async(self, room):
+        return self.add_room(room)
+
+
+    async def add_registered_user_async(self, user):
+        return self.add_registered_user(user)
+
+
+    async def add_participant_async(self, room, username):
+        return self.add_participant(room, username)
+
+
+    async def accept_login_async(self, user):
+        return self.accept_login(user)
+
+
+    async def release_login_async(self, username):
+        return self.release_login(username)
+
+
+    async def add_listening_socket_async(self, username, client_socket):
+        return self.add_listening_socket(username, client_socket)
+
+
+    # a logout applied by the bus thread of a cluster node closes the user's LISTEN connection
+    # there (see replica.py), and a transport is only ever touched on the loop
+    def cleanup_client(self, client_socket):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            super().cleanup_client(client_socket)
+        else:
+            self.loop.call_soon_threadsafe(super().cleanup_client, client_socket)
+
+
+    # there is no socket timeout to reset on this engine, handle_auth_async() keeps the deadline
+    def authenticated(self, client_socket):
+        self.admission.authenticated(self.raw_socket(client_socket))
+
+
+    # the client never writes to its listening socket, reading only tells us when it goes away
+    async def hold_listening_connection(self, reader, username, client_socket):
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+        user = self.logged_in_users.get(username)
+        if user and user.listening_socket is client_socket:
+            user.listening_socket = None
+            user.outbound.close()
+        self.cleanup_client(client_socket)
+
+
+    # FOR RECEIVING MESSAGES
+    async def receive_async(self, reader):
+        return (await framing.read_frame(reader, self.config.max_frame_size)).decode()
+
+
+    async def receive_request_async(self, reader, client_socket):
+        payload = await framing.read_frame(reader, self.config.max_frame_size)
+        if isinstance(client_socket, BinarySocket):
+            return None, self.parse_binary_request(payload)
+        return self.parse_text_request(payload.decode())
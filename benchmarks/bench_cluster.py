@@ -0,0 +1,163 @@
+"""Measures how much relay traffic each node of a cluster receives.
+
+Starts --nodes cluster nodes in this process (see cluster.py) and logs --users
+users in on each. Every node gets --rooms rooms whose participants are all
+logged in on it, and every pair of neighbouring nodes shares --shared rooms with
+participants on both. A participant of every room posts --messages messages
+to it, then the benchmark checks that every participant got every UPDATE and
+prints, per node, how many messages were relayed to it compared with all the
+messages posted, and how many relays went into one frame between nodes.
+
+Since rooms are owned by node rid % nodes, most rooms are owned by a node
+their participants are not on, so most messages go through a relay.
+
+    python benchmarks/bench_cluster.py --nodes 3 --rooms 4 --shared 2 --messages 200
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from cluster import ThreadedClusterNode
+from config import ServerConfig
+from bench_engines import connect, send_all, receive
+
+out = sys.stdout
+
+
+class BenchNode(ThreadedClusterNode):
+
+    def run_server(self):
+        threading.Thread(target=super().run_server, daemon=True).start()
+
+
+def start_nodes(nodes, port):
+    addresses = [("127.0.0.1", port + 100 + index) for index in range(nodes)]
+    started = [None] * nodes
+
+    def start(index):
+        config = ServerConfig(message_durability="enqueue", history_compression="none",
+                              user_message_rate=0, broadcast_message_rate=0, large_room_message_rate=0, room_message_rate=0)
+        started[index] = BenchNode("127.0.0.1", port + index, config, index, addresses)
+
+    threads = [threading.Thread(target=start, args=(index,)) for index in range(nodes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return started
+
+
+def login(port, username):
+    command = connect(port)
+    send_all(command, f"REGISTER|{username}|pw")
+    receive(command)
+    send_all(command, f"LOGIN|{username}|pw")
+    if "successful" not in receive(command):
+        raise RuntimeError(f"login failed for {username}")
+    listening = connect(port)
+    send_all(listening, f"LISTEN|{username}")
+    receive(listening)
+    return command, listening
+
+
+def run(nodes, users, rooms, shared, messages, port):
+    cluster = start_nodes(nodes, port)
+    time.sleep(0.2) # until every node accepts
+
+    sessions = {} # username: (node, command, listening)
+    for node in range(nodes):
+        for i in range(users):
+            username = f"n{node}u{i}"
+            sessions[username] = (node, *login(port + node, username))
+
+    # room name: its participants
+    room_members = {}
+    for node in range(nodes):
+        for i in range(rooms):
+            room_members[f"local{node}.{i}"] = [f"n{node}u{j}" for j in range(users)]
+        for i in range(shared if nodes > 1 else 0):
+            other = (node + 1) % nodes
+            room_members[f"shared{node}-{other}.{i}"] = [f"n{node}u{j}" for j in range(users)] + \
+                                                       [f"n{other}u{j}" for j in range(users)]
+    for room_name, members in room_members.items():
+        _, command, _ = sessions[members[0]]
+        send_all(command, f"#1|CREATE_ROOM|{room_name}")
+        receive(command)
+        send_all(command, f"#2|ADD_PARTICIPANTS|{room_name}|{'|'.join(members[1:])}")
+        receive(command)
+
+    received = {username: 0 for username in sessions}
+
+    def listen(username, sock):
+        try:
+            while True:
+                if receive(sock).startswith("UPDATE|"):
+                    received[username] += 1
+        except (EOFError, OSError):
+            pass
+
+    for username, (_, _, listening) in sessions.items():
+        threading.Thread(target=listen, args=(username, listening), daemon=True).start()
+
+    before = [dict(node.bus.stats()["received"]) for node in cluster]
+    # the first member of a room posts to it, one room after the other when it is the first of several
+    posts = {}
+    for room_name, members in room_members.items():
+        posts.setdefault(members[0], []).append(room_name)
+
+    def post(username, room_names):
+        _, command, _ = sessions[username]
+        for room_name in room_names:
+            for i in range(messages):
+                send_all(command, f"SEND_MESSAGE|{room_name}|message {i}")
+                receive(command)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=post, args=item) for item in posts.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    expected = {username: 0 for username in sessions}
+    for members in room_members.values():
+        for username in members:
+            expected[username] += messages
+    deadline = time.monotonic() + 10
+    while received != expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    total = len(room_members) * messages
+    missing = sum(expected[u] - received[u] for u in sessions)
+    print(f"{nodes} nodes, {len(room_members)} rooms, {total} messages in {elapsed:.2f}s, "
+          f"{missing} UPDATEs missing", file=out)
+    for index, node in enumerate(cluster):
+        stats = node.bus.stats()
+        relays = stats["received"].get("relay", 0) - before[index].get("relay", 0)
+        interested = sum(messages for room_name, members in room_members.items()
+                         if any(sessions[m][0] == index for m in members) and node.owner(node.rooms[room_name]) != index)
+        print(f"  node {index}: {relays:6} relays received of {total} messages posted "
+              f"({interested} to rooms it has users in and does not own), "
+              f"{stats['entries sent'] / max(1, stats['frames sent']):.1f} entries per frame sent", file=out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--users", type=int, default=3, help="per room and node")
+    parser.add_argument("--rooms", type=int, default=4, help="rooms with all participants on one node, per node")
+    parser.add_argument("--shared", type=int, default=2, help="rooms shared by neighbouring nodes, per node")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--port", type=int, default=5700)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+    sys.stdout = open(os.devnull, "w") # the nodes print every connection
+    run(args.nodes, args.users, args.rooms, args.shared, args.messages, args.port)
+    out.flush()
+    os._exit(0) # the nodes' threads would report every connection that closes on the way out
@@ -0,0 +1,82 @@
+"""Compares the disk size and read latency of room logs with and without compression.
+
+Writes --messages chat-like messages into a room log for each codec, compresses
+its full segments the way the server's Compressor does, then reports the bytes
+on disk per message and how long reading a page of --page-size messages takes:
+from an old, compressed block that is not cached, from one that is, and from
+the recent end of the log, which is never compressed.
+
+    python benchmarks/bench_compression.py --messages 200000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from message_log import MessageLog, Compressor, Segment
+
+WORDS = ("hi hello ok yes no maybe lunch meeting today tomorrow the a is are was will can we you they "
+         "please thanks sure sounds good see later call me when where what why how deploy build test").split()
+BATCH = 10000
+
+
+def populate(directory, messages, segment_bytes, compressor):
+    rng = random.Random(1)
+    log = MessageLog(directory, segment_bytes)
+    pending = []
+    for seq in range(1, messages + 1):
+        record = {"seq": seq, "author": f"user{rng.randrange(50)}", "timestamp": 1700000000 + seq * 7,
+                  "text": " ".join(rng.choices(WORDS, k=rng.randint(3, 15)))}
+        pending.append(json.dumps(record).encode() + b"\n")
+        if len(pending) == BATCH:
+            log.write(pending)
+            pending.clear()
+    log.write(pending)
+    if compressor:
+        for segment in log.segments[:-1]:
+            compressor.compress(log, segment)
+    return log
+
+
+def disk_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def page_time(log, first, page_size, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        log.read(first, first + page_size - 1)
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--segment-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--block-messages", type=int, default=256)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(2)
+    for codec in ("none", "zlib", "lzma"):
+        with tempfile.TemporaryDirectory() as directory:
+            compressor = Compressor(codec, args.block_messages) if codec != "none" else None
+            start = time.perf_counter()
+            log = populate(directory, args.messages, args.segment_bytes, compressor)
+            elapsed = time.perf_counter() - start
+
+            recent = log.last_seq - args.page_size + 1
+            # pages all over the old history, nearly every one misses the block cache
+            cold = sum(page_time(log, rng.randrange(1, recent // 2), args.page_size, 1) for _ in range(200)) / 200
+            warm = page_time(log, recent // 2, args.page_size, 1000)
+            hot = page_time(log, recent, args.page_size, 1000)
+            plain = sum(isinstance(segment, Segment) for segment in log.segments)
+            print(f"{codec:<5} {disk_bytes(directory) / args.messages:6.1f} bytes/message on disk "
+                  f"({len(log.segments) - plain} compressed segments, written in {elapsed:.1f}s)  "
+                  f"page: old {cold * 1e6:.0f}us, old cached {warm * 1e6:.0f}us, recent {hot * 1e6:.0f}us")
+            log.close()
@@ -0,0 +1,126 @@
+"""Measures lock contention when many threads post messages at once.
+
+Runs the server's message path in-process (no sockets): --writers threads each
+post --messages messages, all into one room, then spread over --rooms rooms.
+Every user is logged in with a recorder in place of its outbound queue, and
+afterwards every recorder is checked to have received each room's UPDATEs
+exactly once and in seq order.
+
+The same runs are then repeated with one lock shared by all rooms, to compare
+with a global lock that serializes every room. --switch-interval makes threads
+take turns more often (see sys.setswitchinterval), which is when ordering bugs
+show up.
+
+    python benchmarks/bench_contention.py --writers 32 --rooms 32 --messages 2000 --switch-interval 0.000001
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from server import Server
+from config import ServerConfig
+from room import Room
+from user import User
+
+
+class BenchServer(Server):
+
+    def run_server(self):
+        pass # requests are made by calling the server directly
+
+
+class Recorder:
+    """Stands in for a user's OutboundQueue and keeps every frame."""
+
+    def __init__(self):
+        self.frames = []
+
+    def put(self, frame):
+        self.frames.append(frame)
+        return True
+
+
+def setup(history_dir, users, rooms, global_lock):
+    config = ServerConfig(history_dir=history_dir, message_durability="enqueue", history_compression="none",
+                          user_message_rate=0, broadcast_message_rate=0, large_room_message_rate=0, room_message_rate=0)
+    server = BenchServer("127.0.0.1", 0, config)
+    usernames = [f"writer{i}" for i in range(users)]
+    for username in usernames:
+        server.add_registered_user(User(username, "pw"))
+    room_names = ["Broadcast"]
+    for i in range(1, rooms):
+        room = Room(f"room{i}")
+        server.add_room(room)
+        for username in usernames:
+            server.add_participant(room, username)
+        room_names.append(room.name)
+    if global_lock:
+        lock = threading.Lock()
+        for room in server.rooms_by_id:
+            room.lock = lock
+
+    recorders = {}
+    for username in usernames:
+        user = server.logged_in_users[username] = User(username, "pw")
+        user.outbound = recorders[username] = Recorder()
+    return server, usernames, room_names, recorders
+
+
+def run(writers, rooms, messages, global_lock=False):
+    with tempfile.TemporaryDirectory() as history_dir:
+        server, usernames, room_names, recorders = setup(history_dir, writers, rooms, global_lock)
+        start_line = threading.Barrier(writers + 1)
+
+        def post(index):
+            username = usernames[index]
+            room_name = room_names[index % len(room_names)]
+            start_line.wait()
+            for i in range(messages):
+                server.send_message_to_room(username, room_name, f"message {i} from {username}")
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(writers)]
+        for t in threads:
+            t.start()
+        start_line.wait()
+        start = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        # every recorder must have each room's UPDATEs as seq 1, 2, 3, ...
+        errors = 0
+        for recorder in recorders.values():
+            last_seq = {}
+            for frame in recorder.frames:
+                _, room_name, _, seq, _ = frame[4:].decode().split("|", 4)
+                if int(seq) != last_seq.get(room_name, 0) + 1:
+                    errors += 1
+                last_seq[room_name] = int(seq)
+        server.log_committer.close()
+
+        total = writers * messages
+        print(f"  rooms={rooms:<4} {'global lock' if global_lock else 'room locks '}  "
+              f"{total / elapsed:10,.0f} msg/s  {sum(len(r.frames) for r in recorders.values()) / elapsed:12,.0f} UPDATE/s  "
+              f"out of order: {errors}")
+        return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--rooms", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--switch-interval", type=float, default=sys.getswitchinterval())
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+    sys.setswitchinterval(args.switch_interval)
+
+    print(f"{args.writers} writers, {args.messages} messages each")
+    for rooms, global_lock in ((1, False), (args.rooms, False), (1, True), (args.rooms, True)):
+        run(args.writers, rooms, args.messages, global_lock)
@@ -0,0 +1,43 @@
+"""Compares the message durability modes of the server.
+
+Runs the load of bench_engines.py once per --message-durability mode, with the
+message logs in a fresh directory (on the disk under test, see --dir), and
+prints SEND_MESSAGE throughput and reply latency side by side.
+
+    python benchmarks/bench_durability.py --engine threads --users 20 --messages 50
+    python benchmarks/bench_durability.py --dir /mnt/ssd/tmp --commit-interval 0.002
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_engines import run
+
+MODES = ("enqueue", "write", "fsync")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--port", type=int, default=5700)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--pipelined", action="store_true")
+    parser.add_argument("--commit-interval", type=float, default=0.0)
+    parser.add_argument("--dir", default=None, help="where to put the message logs, a temporary directory by default")
+    args = parser.parse_args()
+
+    results = {}
+    for i, mode in enumerate(MODES):
+        with tempfile.TemporaryDirectory(dir=args.dir) as history_dir:
+            server_args = ["--history-dir", history_dir, "--message-durability", mode,
+                           "--message-commit-interval", str(args.commit_interval)]
+            results[mode] = run(args.engine, args.port + i, args.users, args.messages,
+                                pipelined=args.pipelined, extra_args=server_args)
+
+    print()
+    print(f"{'durability':>10} {'msg/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode, result in results.items():
+        print(f"{mode:>10} {result['msg/s']:>9,.0f} {result['p50'] * 1000:>8.2f} {result['p99'] * 1000:>8.2f}")
@@ -0,0 +1,174 @@
+"""Load generator for comparing the server engines.
+
+Starts server.py in a subprocess with the chosen engine, registers and logs in
+a number of users (each with a command and a LISTEN connection), then has every
+user post messages into the Broadcast room and waits until every participant
+has received every UPDATE.
+
+    python benchmarks/bench_engines.py --engine threads --users 50 --messages 20
+    python benchmarks/bench_engines.py --engine asyncio --users 50 --messages 20
+
+--pipelined tags every SEND_MESSAGE with a request ID and keeps all of a
+user's messages in flight instead of waiting for each reply.
+
+Arguments it does not know are passed on to server.py, so
+
+    python benchmarks/bench_engines.py --engine threads --users 200 --messages 20 --message-durability fsync
+
+runs the same load against a server that acknowledges a message once its log
+has been fsynced.
+
+--stalled adds users whose LISTEN connection is never read from, to see how
+much a client with a full TCP window slows down everybody else.
+"""
+import os
+import sys
+import time
+import uuid
+import socket
+import argparse
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import framing
+from pipeline import PipelinedChannel
+
+
+def send_all(sock, msg):
+    framing.send_frame(sock, msg.encode())
+
+
+def receive(sock):
+    return framing.recv_text(sock)
+
+
+def connect(port):
+    return socket.create_connection(("127.0.0.1", port))
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connect(port).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+# the load is a flood on purpose, limits given in extra_args still apply (the last of a flag wins)
+NO_RATE_LIMITS = ["--user-message-rate", "0", "--broadcast-message-rate", "0",
+                  "--large-room-message-rate", "0", "--room-message-rate", "0"]
+
+
+def start_server(engine, port, extra_args=()):
+    cmd = [sys.executable, os.path.join(ROOT, "server.py"), "--engine", engine,
+           "--port", str(port), "--log-level", "ERROR", *NO_RATE_LIMITS, *extra_args]
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return proc
+
+
+def login_users(port, count):
+    prefix = uuid.uuid4().hex[:6]
+    users = []
+    for i in range(count):
+        username = f"bench_{prefix}_{i}"
+        command = connect(port)
+        send_all(command, f"REGISTER|{username}|pw")
+        receive(command)
+        send_all(command, f"LOGIN|{username}|pw")
+        if "successful" not in receive(command):
+            raise RuntimeError(f"login failed for {username}")
+        listening = connect(port)
+        send_all(listening, f"LISTEN|{username}")
+        receive(listening)
+        users.append((username, command, listening))
+    return users
+
+
+def run(engine, port, users, messages, stalled=0, pipelined=False, extra_args=()):
+    proc = start_server(engine, port, extra_args)
+    try:
+        sessions = login_users(port, users)
+        stalled_sessions = login_users(port, stalled)
+        for _, _, listening in stalled_sessions:
+            listening.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        expected = users * messages
+        received = [0] * users
+
+        def listen(index, sock):
+            try:
+                while True:
+                    if receive(sock).startswith("UPDATE|"):
+                        received[index] += 1
+            except (EOFError, OSError):
+                pass # server went away
+
+        def post(username, sock, latencies):
+            if pipelined:
+                channel = PipelinedChannel(sock)
+                start = time.perf_counter()
+                replies = [channel.request(f"SEND_MESSAGE|Broadcast|message {i} from {username}")
+                           for i in range(messages)]
+                for reply in replies:
+                    reply.get()
+                    latencies.append(time.perf_counter() - start)
+                return
+
+            for i in range(messages):
+                start = time.perf_counter()
+                send_all(sock, f"SEND_MESSAGE|Broadcast|message {i} from {username}")
+                receive(sock)
+                latencies.append(time.perf_counter() - start)
+
+        for index, (_, _, listening) in enumerate(sessions):
+            threading.Thread(target=listen, args=(index, listening), daemon=True).start()
+
+        latencies = []
+        start = time.perf_counter()
+        posters = [threading.Thread(target=post, args=(username, command, latencies))
+                   for username, command, _ in sessions]
+        for t in posters:
+            t.start()
+        for t in posters:
+            t.join()
+
+        # frames may be dropped by the outbound queues, so stop once delivery stops making progress
+        delivered, last_progress = -1, time.perf_counter()
+        while delivered < users * expected and time.perf_counter() - last_progress < 2.0:
+            if sum(received) != delivered:
+                delivered, last_progress = sum(received), time.perf_counter()
+            time.sleep(0.005)
+        elapsed = last_progress - start
+
+        latencies.sort()
+        result = {
+            "msg/s": users * messages / elapsed,
+            "UPDATE/s": delivered / elapsed,
+            "p50": latencies[len(latencies) // 2],
+            "p99": latencies[int(len(latencies) * 0.99)],
+        }
+        print(f"engine={engine} users={users} stalled={stalled} messages/user={messages} pipelined={pipelined}")
+        print(f"  sent {users * messages} messages, delivered {delivered} of {users * expected} UPDATEs in {elapsed:.3f}s")
+        print(f"  {result['msg/s']:,.0f} msg/s in, {result['UPDATE/s']:,.0f} UPDATE/s out")
+        print(f"  SEND_MESSAGE reply latency p50={result['p50'] * 1000:.2f}ms p99={result['p99'] * 1000:.2f}ms")
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--stalled", type=int, default=0)
+    parser.add_argument("--pipelined", action="store_true")
+    args, server_args = parser.parse_known_args()
+    run(args.engine, args.port, args.users, args.messages, args.stalled, args.pipelined, server_args)
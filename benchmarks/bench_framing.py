@@ -0,0 +1,113 @@
+"""Microbenchmark of the framing layer against the previous str-concatenating implementation.
+
+Streams frames of several sizes through a socketpair. The other end of the
+pair runs in a separate process doing raw reads or writes, so each number only
+contains the cost of the side being measured.
+
+    python benchmarks/bench_framing.py
+"""
+import os
+import sys
+import time
+import socket
+import struct
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import framing
+
+SIZES = [32, 1024, 64 * 1024, 1024 * 1024]
+TOTAL_BYTES = 64 * 1024 * 1024
+
+
+# the implementation framing.py replaced, kept here as the baseline
+def old_send_all(sock, msg):
+    fullmsg = struct.pack("!i", len(msg)) + msg.encode()
+    sock.sendall(fullmsg)
+
+
+def old_receive(sock):
+    length = struct.unpack("!i", old_recv_all(sock, 4))[0]
+    return old_recv_all(sock, length).decode()
+
+
+def old_recv_all(sock, length):
+    data = ""
+    while len(data) < length:
+        more = sock.recv(length - len(data)).decode()
+        if not more:
+            raise EOFError("Socket closed %d bytes into a %d-byte message" % (len(data), length))
+        data += more
+    return data.encode()
+
+
+def new_send_all(sock, msg):
+    framing.send_frame(sock, msg.encode())
+
+
+def new_receive(sock):
+    return framing.recv_text(sock, max_frame_size=max(SIZES))
+
+
+def raw_writer(sock, frame, count):
+    batch = frame * max(1, (256 * 1024) // len(frame))
+    per_batch = len(batch) // len(frame)
+    for _ in range(count // per_batch):
+        sock.sendall(batch)
+    for _ in range(count % per_batch):
+        sock.sendall(frame)
+
+
+def raw_reader(sock, total):
+    buffer = bytearray(1 << 20)
+    while total > 0:
+        total -= sock.recv_into(buffer)
+
+
+def pair():
+    a, b = socket.socketpair()
+    for sock in (a, b):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    return a, b
+
+
+def measure_receive(receive, size, count):
+    ours, theirs = pair()
+    frame = struct.pack("!i", size) + b"x" * size
+    peer = multiprocessing.Process(target=raw_writer, args=(theirs, frame, count))
+    peer.start()
+    start = time.perf_counter()
+    for _ in range(count):
+        receive(ours)
+    elapsed = time.perf_counter() - start
+    peer.join()
+    return elapsed
+
+
+def measure_send(send, size, count):
+    ours, theirs = pair()
+    msg = "x" * size
+    peer = multiprocessing.Process(target=raw_reader, args=(theirs, (size + 4) * count))
+    peer.start()
+    start = time.perf_counter()
+    for _ in range(count):
+        send(ours, msg)
+    peer.join()
+    return time.perf_counter() - start
+
+
+def main():
+    multiprocessing.set_start_method("fork")
+    print(f"{'side':>5} {'frame size':>11} {'old frames/s':>14} {'new frames/s':>14} {'old MB/s':>10} {'new MB/s':>10}")
+    for side, old, new, measure in (("recv", old_receive, new_receive, measure_receive),
+                                    ("send", old_send_all, new_send_all, measure_send)):
+        for size in SIZES:
+            count = min(TOTAL_BYTES // size, 500_000)
+            results = [count / measure(impl, size, count) for impl in (old, new)]
+            print(f"{side:>5} {size:>11} {results[0]:>14,.0f} {results[1]:>14,.0f} "
+                  f"{results[0] * size / 1e6:>10,.1f} {results[1] * size / 1e6:>10,.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Measures login throughput and what a login storm does to message fan-out.
+
+Starts server.py in a subprocess, logs in --listeners users with a LISTEN
+connection and has one of them post a message every --interval seconds,
+measuring how long each takes to come back as an UPDATE on the listeners.
+That is done once on a quiet server and once while --storm clients log in
+and out as fast as the server lets them, which is when the password hashing
+(see credentials.py) competes with fan-out for the CPU.
+
+    python benchmarks/bench_logins.py --engine threads --storm 32 --seconds 5
+    python benchmarks/bench_logins.py --engine asyncio --storm 32 --password-hash-workers 1
+
+Arguments it does not know are passed on to server.py, like in bench_engines.py.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bench_engines import start_server, login_users, connect, send_all, receive
+
+
+# registered, not logged in, one per storm client so that no login is refused as a duplicate
+def register_users(port, count):
+    prefix = uuid.uuid4().hex[:6]
+    usernames = [f"storm_{prefix}_{i}" for i in range(count)]
+    sock = connect(port)
+    for username in usernames:
+        send_all(sock, f"REGISTER|{username}|pw")
+        receive(sock)
+    sock.close()
+    return usernames
+
+
+def measure_fanout(sessions, seconds, interval):
+    """Posts for the given time, returns the UPDATE latencies seen by the listeners."""
+    latencies = []
+    sent = {} # message text: when it was sent
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def listen(sock):
+        try:
+            while not stop.is_set():
+                frame = receive(sock)
+                if frame.startswith("UPDATE|"):
+                    arrived = time.perf_counter()
+                    text = frame.split("|", 4)[4]
+                    with lock:
+                        latencies.append(arrived - sent[text])
+        except (EOFError, OSError):
+            pass
+
+    listeners = [threading.Thread(target=listen, args=(listening,), daemon=True) for _, _, listening in sessions]
+    for t in listeners:
+        t.start()
+
+    _, command, _ = sessions[0]
+    deadline = time.perf_counter() + seconds
+    i = 0
+    while time.perf_counter() < deadline:
+        text = f"probe {i}"
+        with lock:
+            sent[text] = time.perf_counter()
+        send_all(command, f"SEND_MESSAGE|Broadcast|{text}")
+        receive(command)
+        i += 1
+        time.sleep(interval)
+    time.sleep(0.5) # for the last UPDATEs
+    stop.set()
+    with lock:
+        return sorted(latencies)
+
+
+def storm(port, username, stop, counts):
+    """Logs the user in and out over and over until stop is set."""
+    while not stop.is_set():
+        sock = connect(port)
+        try:
+            start = time.perf_counter()
+            send_all(sock, f"LOGIN|{username}|pw")
+            reply = receive(sock)
+            if "successful" in reply:
+                counts["logins"] += 1
+                counts["seconds"] += time.perf_counter() - start
+                send_all(sock, "LOGOUT")
+                receive(sock)
+            elif "busy" in reply:
+                counts["busy"] += 1
+            else:
+                counts["failed"] += 1
+        except (EOFError, OSError):
+            counts["failed"] += 1
+        finally:
+            sock.close()
+
+
+def percentiles(latencies):
+    if not latencies:
+        return "no UPDATEs"
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    return f"p50={p50:.2f}ms p99={p99:.2f}ms over {len(latencies)} UPDATEs"
+
+
+def run(engine, port, listeners, clients, seconds, interval, extra_args=()):
+    proc = start_server(engine, port, extra_args)
+    try:
+        sessions = login_users(port, listeners)
+        stormers = register_users(port, clients)
+        print(f"engine={engine} listeners={listeners} storm clients={clients} {' '.join(extra_args)}")
+        print(f"  quiet:      fan-out {percentiles(measure_fanout(sessions, seconds, interval))}")
+
+        stop = threading.Event()
+        counts = {"logins": 0, "busy": 0, "failed": 0, "seconds": 0.0}
+        threads = [threading.Thread(target=storm, args=(port, username, stop, counts), daemon=True)
+                   for username in stormers]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        latencies = measure_fanout(sessions, seconds, interval)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        print(f"  login storm: fan-out {percentiles(latencies)}")
+        print(f"  {counts['logins'] / elapsed:,.1f} logins/s, "
+              f"{counts['seconds'] / max(1, counts['logins']) * 1000:.1f}ms per login, "
+              f"{counts['busy']} refused as busy, {counts['failed']} failed")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--port", type=int, default=5650)
+    parser.add_argument("--listeners", type=int, default=20)
+    parser.add_argument("--storm", type=int, default=32, help="clients logging in and out during the second run")
+    parser.add_argument("--seconds", type=float, default=5.0, help="of each run")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between two posted messages")
+    args, server_args = parser.parse_known_args()
+    run(args.engine, args.port, args.listeners, args.storm, args.seconds, args.interval, server_args)
@@ -0,0 +1,99 @@
+"""Measures the memory a stored message takes in each representation.
+
+Builds --messages messages of one room from raw SEND_MESSAGE payloads (so that,
+as in the server, every author name arrives as a string of its own) and
+reports the bytes traced by tracemalloc per message that stay allocated:
+
+    before     Message objects as they used to be, with a __dict__ and a datetime
+    slots      Message objects with __slots__, an int timestamp and interned names
+    records    the hot window of RoomHistory, encoded JSON records
+    columnar   the hot window of RoomHistory with columnar=True
+
+and the time it takes to read a page of history from the two hot windows.
+
+    python benchmarks/bench_memory.py --messages 100000
+"""
+import os
+import sys
+import gc
+import time
+import argparse
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from message import Message
+from history import RoomHistory
+
+
+class LegacyMessage:
+
+    def __init__(self, room_name, author_name, text):
+        self.room_name = room_name
+        self.timestamp = datetime.now()
+        self.author_name = author_name
+        self.text = text
+
+
+def build_objects(cls, payloads):
+    messages = []
+    for payload in payloads:
+        _, room_name, author_name, text = payload.decode().split("|", 3)
+        messages.append(cls(room_name, author_name, text))
+    return messages
+
+
+def build_history(payloads, columnar):
+    history = RoomHistory("Broadcast", columnar=columnar)
+    for payload in payloads:
+        _, room_name, author_name, text = payload.decode().split("|", 3)
+        history.append(Message(room_name, author_name, text))
+    return history
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build()
+        gc.collect()
+        return kept, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def page_time(history, page_size, rounds=1000):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        history.page(page_size)
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--authors", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    payloads = [f"SEND_MESSAGE|Broadcast|user{i % args.authors}|message number {i} with some typical chat text".encode()
+                for i in range(args.messages)]
+
+    builds = {
+        "before": lambda: build_objects(LegacyMessage, payloads),
+        "slots": lambda: build_objects(Message, payloads),
+        "records": lambda: build_history(payloads, columnar=False),
+        "columnar": lambda: build_history(payloads, columnar=True),
+    }
+    print(f"{args.messages} messages, {args.authors} authors")
+    baseline = None
+    for name, build in builds.items():
+        kept, size = measure(build)
+        per_message = size / args.messages
+        baseline = baseline or per_message
+        line = f"  {name:<9} {per_message:7.1f} bytes/message ({per_message / baseline:.0%} of before)"
+        if isinstance(kept, RoomHistory):
+            line += f", page of {args.page_size} in {page_time(kept, args.page_size) * 1e6:.1f}us"
+        print(line)
+        del kept
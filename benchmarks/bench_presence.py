@@ -0,0 +1,139 @@
+"""Measures presence traffic during mass reconnects.
+
+Runs the server's login path in-process (no sockets): --users users in rooms
+of --room-size, all logged in and listening, each with a recorder in place of
+its outbound queue. Then:
+
+- reconnect: every user logs out and straight back in, as after a restart of
+  a proxy or a network blip;
+- outage: every user logs out, a window passes, every user logs back in.
+
+For each, it prints the logins and logouts, how many of them were still
+changes when their window was sent, the PRESENCE events and the entries in
+them, next to the events an event per contact per change would have taken.
+
+    python benchmarks/bench_presence.py --users 2000 --room-size 20 --window 0.25
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from server import Server
+from config import ServerConfig
+from room import Room
+from user import User
+
+out = sys.stdout
+
+
+class BenchServer(Server):
+
+    def run_server(self):
+        pass # requests are made by calling the server directly
+
+
+class Recorder:
+    """Stands in for a user's OutboundQueue and keeps every frame."""
+
+    def __init__(self):
+        self.frames = []
+
+    def put(self, frame):
+        self.frames.append(frame)
+        return True
+
+    def close(self):
+        pass
+
+
+def setup(history_dir, users, room_size, window):
+    config = ServerConfig(history_dir=history_dir, history_compression="none", presence_window=window)
+    server = BenchServer("127.0.0.1", 0, config)
+    usernames = [f"user{i}" for i in range(users)]
+    for username in usernames:
+        server.add_registered_user(User(username, "pw"))
+    for start in range(0, users, room_size):
+        room = Room(f"room{start // room_size}")
+        server.add_room(room)
+        for username in usernames[start:start + room_size]:
+            server.add_participant(room, username)
+    return server, usernames
+
+
+def log_in(server, username, recorder):
+    server.accept_login(User(username, "pw"))
+    server.logged_in_users[username].outbound = recorder
+    server.presence.snapshot(username)
+
+
+def online_contacts(server, username):
+    return sum(1 for contact in server.contacts(username) if contact in server.presence.online)
+
+
+# until the window of the last change has been sent
+def wait_for_flush(server):
+    time.sleep(server.config.presence_window * 2)
+
+
+def main(users, room_size, window):
+    with tempfile.TemporaryDirectory() as history_dir:
+        server, usernames = setup(history_dir, users, room_size, window)
+        recorders = {username: Recorder() for username in usernames}
+        for username in usernames:
+            log_in(server, username, recorders[username])
+        wait_for_flush(server)
+
+        print(f"{users} users in rooms of {room_size}, window {window}s", file=out)
+        # every user in turn: out and back in
+        for recorder in recorders.values():
+            recorder.frames.clear()
+        before = server.presence.stats()
+        one_by_one = 0
+        for username in usernames:
+            one_by_one += 2 * online_contacts(server, username)
+            server.release_login(username)
+            log_in(server, username, recorders[username])
+        wait_for_flush(server)
+        report("reconnect", server, recorders, before, one_by_one)
+
+        # everybody out, a window later everybody back in
+        for recorder in recorders.values():
+            recorder.frames.clear()
+        before = server.presence.stats()
+        one_by_one = 0
+        for username in usernames:
+            one_by_one += online_contacts(server, username)
+            server.release_login(username)
+        wait_for_flush(server)
+        for username in usernames:
+            one_by_one += online_contacts(server, username)
+            log_in(server, username, recorders[username])
+        wait_for_flush(server)
+        report("outage", server, recorders, before, one_by_one)
+
+
+def report(label, server, recorders, before, one_by_one):
+    after = server.presence.stats()
+    events = [json.loads(bytes(frame[4:]).decode()[len("PRESENCE|"):])
+              for recorder in recorders.values() for frame in recorder.frames]
+    entries = sum(len(event["online"]) + len(event["offline"]) for event in events)
+    print(f"  {label:9} {after['changes'] - before['changes']:6} logins and logouts, "
+          f"{after['reported'] - before['reported']:6} reported, {len(events):6} events with {entries:7} entries "
+          f"(snapshots included), {one_by_one:7} events one per contact and change", file=out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--room-size", type=int, default=20)
+    parser.add_argument("--window", type=float, default=0.25, help="seconds, see ServerConfig.presence_window")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    sys.stdout = open(os.devnull, "w") # the server prints as it starts
+    main(args.users, args.room_size, args.window)
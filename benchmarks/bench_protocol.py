@@ -0,0 +1,93 @@
+"""Compares the text protocol with binary protocol v2 (protocol_v2.py).
+
+For the two messages that dominate traffic, the SEND_MESSAGE request and the
+UPDATE push, measures serialize and parse cost and the bytes on the wire
+(including the 4 byte frame header).
+
+    python benchmarks/bench_protocol.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import framing
+import protocol_v2 as v2
+from pipeline import split_request_id
+
+ROOM = "Study group: networking"
+AUTHOR = "andrej"
+ROOM_ID, AUTHOR_ID, SEQ = 42, 7, 1234
+ROOMS_BY_ID = {ROOM_ID: ROOM}
+USERS_BY_ID = {AUTHOR_ID: AUTHOR}
+TEXTS = {
+    "short": "ok",
+    "typical": "Did anyone finish the second lab exercise yet?",
+    "long": "lorem ipsum dolor sit amet " * 40,
+}
+NUMBER = 200_000
+
+
+def text_send_message(text):
+    return f"SEND_MESSAGE|{ROOM}|{text}".encode()
+
+
+def text_parse_request(payload):
+    _, msg = split_request_id(payload.decode())
+    return msg.split("|")
+
+
+def binary_send_message(text):
+    return v2.encode_op_id(v2.SEND_MESSAGE, ROOM_ID, text)
+
+
+def binary_parse_request(payload):
+    opcode, args = v2.decode_request(payload)
+    return [v2.ACTIONS[opcode], ROOMS_BY_ID[args[0]], args[1]]
+
+
+def text_update(text):
+    return f"UPDATE|{ROOM}|{AUTHOR}|{SEQ}|{text}".encode()
+
+
+def text_parse_update(payload):
+    return payload.decode().split("|")
+
+
+def binary_update(text):
+    return v2.encode_update(ROOM_ID, AUTHOR_ID, SEQ, text)
+
+
+def binary_parse_update(payload):
+    _, (room_id, author_id, seq, text) = v2.decode_server_frame(payload)
+    return ROOMS_BY_ID[room_id], USERS_BY_ID[author_id], seq, text
+
+
+def cost(fn, arg):
+    return min(timeit.repeat(lambda: fn(arg), number=NUMBER, repeat=3)) / NUMBER * 1e9
+
+
+def main():
+    cases = (
+        ("SEND_MESSAGE", text_send_message, text_parse_request, binary_send_message, binary_parse_request),
+        ("UPDATE", text_update, text_parse_update, binary_update, binary_parse_update),
+    )
+    print(f"{'message':>12} {'text':>8} {'protocol':>8} {'serialize ns':>13} {'parse ns':>9} {'wire bytes':>11}")
+    for name, *impls in cases:
+        for label, text in TEXTS.items():
+            for protocol, serialize, parse in (("text", *impls[:2]), ("v2", *impls[2:])):
+                payload = serialize(text)
+                assert parse(payload)[-1] == text
+                wire = len(framing.encode_frame(payload))
+                print(f"{name:>12} {label:>8} {protocol:>8} {cost(serialize, text):>13,.0f} "
+                      f"{cost(parse, payload):>9,.0f} {wire:>11}")
+
+    print()
+    print("text with '|' inside a message:")
+    broken = "a | b"
+    print(f"  text protocol parses to {text_parse_request(text_send_message(broken))[2:]!r}")
+    print(f"  v2 parses to {binary_parse_request(binary_send_message(broken))[2:]!r}")
+
+
+if __name__ == "__main__":
+    main()
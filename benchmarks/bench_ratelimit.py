@@ -0,0 +1,143 @@
+"""Measures the rate limits on SEND_MESSAGE: what a check costs and what a flood costs.
+
+First the bucket check on its own (see ratelimit.py): the time per
+RateLimits.take() with one user and room and with --buckets of each, and the
+memory blocks still allocated after a million checks.
+
+Then the server's message path in-process (no sockets): a room of --room-size
+participants, all logged in with a counter in place of their outbound queue.
+One flooder posts as fast as it can for --seconds while --talkers others post
+one message every --interval seconds, with the server's default limits and with
+none. It prints the messages posted and refused, and the UPDATEs the room's
+participants were sent.
+
+    python benchmarks/bench_ratelimit.py --room-size 500 --talkers 20 --seconds 2
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import contextlib
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from server import Server
+from config import ServerConfig
+from ratelimit import RateLimits, RateLimited, BROADCAST, LARGE, SMALL
+from room import Room
+from user import User
+
+NO_LIMITS = {"user_message_rate": 0, "broadcast_message_rate": 0, "large_room_message_rate": 0, "room_message_rate": 0}
+
+
+class BenchServer(Server):
+
+    def run_server(self):
+        pass # requests are made by calling the server directly
+
+
+class Counter:
+    """Stands in for a user's OutboundQueue and counts the frames."""
+
+    def __init__(self):
+        self.frames = 0
+
+    def put(self, frame):
+        self.frames += 1
+        return True
+
+    def close(self):
+        pass
+
+
+def measure_checks(buckets, checks=1_000_000):
+    # limits no check reaches, so that every take() goes all the way through
+    limits = RateLimits((1e12, 1e12), {BROADCAST: (1e12, 1e12), LARGE: (1e12, 1e12), SMALL: (1e12, 1e12)})
+    rooms = [Room(f"room{i}") for i in range(buckets)]
+    usernames = [f"user{i}" for i in range(buckets)]
+    for username, room in zip(usernames, rooms):
+        limits.take(username, room) # makes the buckets
+
+    pairs = [(usernames[i % buckets], rooms[i % buckets]) for i in range(checks)]
+    take = limits.take
+    blocks = sys.getallocatedblocks()
+    start = time.perf_counter()
+    for username, room in pairs:
+        take(username, room)
+    elapsed = time.perf_counter() - start
+    grown = sys.getallocatedblocks() - blocks
+    print(f"  {buckets:7} users and rooms: {elapsed / checks * 1e9:6.0f} ns per check, "
+          f"{grown} blocks more allocated after {checks:,} checks")
+
+
+def flood(room_size, talkers, seconds, interval, limited):
+    overrides = {} if limited else NO_LIMITS
+    with tempfile.TemporaryDirectory() as history_dir:
+        config = ServerConfig(history_dir=history_dir, message_durability="enqueue", history_compression="none",
+                              **overrides)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull): # the server prints as it starts
+            server = BenchServer("127.0.0.1", 0, config)
+        usernames = [f"user{i}" for i in range(room_size)]
+        room = Room("crowded")
+        server.add_room(room)
+        counters = []
+        for username in usernames:
+            server.add_registered_user(User(username, "pw"))
+            server.add_participant(room, username)
+            user = server.logged_in_users[username] = User(username, "pw")
+            user.outbound = Counter()
+            counters.append(user.outbound)
+
+        counts = {"posted": 0, "refused": 0, "talker posted": 0, "talker refused": 0}
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def post(username, pause, prefix):
+            while not stop.is_set():
+                try:
+                    server.send_message_to_room(username, room.name, f"message from {username}")
+                    outcome = "posted"
+                except RateLimited:
+                    outcome = "refused"
+                with lock:
+                    counts[prefix + outcome] += 1
+                if pause:
+                    time.sleep(pause)
+
+        threads = [threading.Thread(target=post, args=(usernames[0], 0, ""))]
+        threads += [threading.Thread(target=post, args=(username, interval, "talker "))
+                    for username in usernames[1:talkers + 1]]
+        for t in threads:
+            t.start()
+        time.sleep(seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        server.log_committer.close()
+
+        updates = sum(counter.frames for counter in counters)
+        print(f"  {'default limits' if limited else 'no limits':14}  flooder {counts['posted']:7,} posted "
+              f"{counts['refused']:9,} refused, talkers {counts['talker posted']:5,} posted "
+              f"{counts['talker refused']:5,} refused, {updates / seconds:12,.0f} UPDATE/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buckets", type=int, default=100_000)
+    parser.add_argument("--room-size", type=int, default=500)
+    parser.add_argument("--talkers", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between two messages of a talker")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print("bucket checks")
+    for buckets in (1, args.buckets):
+        measure_checks(buckets)
+
+    print(f"one flooder and {args.talkers} talkers in a room of {args.room_size}, {args.seconds}s")
+    for limited in (False, True):
+        flood(args.room_size, args.talkers, args.seconds, args.interval, limited)
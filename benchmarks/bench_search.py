@@ -0,0 +1,72 @@
+"""Measures SEARCH over a room with a long history.
+
+Writes --messages messages into a room log (made of words drawn from a
+vocabulary with a skewed distribution, so that some words are in most messages
+and others in a handful), then opens the room the way the server does and
+reports how long building the search index takes and how long pages of
+matches take for rare, common and combined terms.
+
+    python benchmarks/bench_search.py --messages 1000000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from itertools import accumulate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from message_log import MessageLog
+from history import RoomHistory
+
+BATCH = 10000
+
+
+def populate(directory, messages, vocabulary, words_per_message):
+    words = [f"word{i}" for i in range(vocabulary)]
+    weights = list(accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+    rng = random.Random(1)
+    log = MessageLog(directory)
+    pending = []
+    for seq in range(1, messages + 1):
+        text = " ".join(rng.choices(words, cum_weights=weights, k=words_per_message))
+        pending.append(json.dumps({"seq": seq, "author": "bench", "timestamp": 0, "text": text}).encode() + b"\n")
+        if len(pending) == BATCH:
+            log.write(pending)
+            pending.clear()
+    log.write(pending)
+    log.close()
+
+
+def timed(function, rounds=1):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = function()
+    return result, (time.perf_counter() - start) / rounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--words", type=int, default=8, help="words per message")
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        _, elapsed = timed(lambda: populate(directory, args.messages, args.vocabulary, args.words))
+        print(f"wrote {args.messages} messages in {elapsed:.1f}s")
+
+        history = RoomHistory("bench", MessageLog(directory), max_messages=1000)
+        _, elapsed = timed(history.build_index)
+        print(f"built the index of {len(history.index.postings)} tokens in {elapsed:.1f}s")
+
+        for query in ["word0", "word10", "word1000", "word40000", "word0 word1", "word5 word500", "word100 word40000"]:
+            postings = min(len(history.index.postings.get(term, ())) for term in query.split())
+            (records, cursor), first = timed(lambda: history.search(query, args.page_size), rounds=20)
+            _, older = timed(lambda: history.search(query, args.page_size, cursor), rounds=20) if cursor else (None, 0)
+            print(f"  {query!r:<22} {postings:>8} postings  {len(records):>3} hits  "
+                  f"first page {first * 1000:.2f}ms  next page {older * 1000:.2f}ms")
@@ -0,0 +1,97 @@
+"""Measures how long the server takes to start on top of stored state.
+
+Fills a history directory with users, rooms and --messages messages (written
+straight into the SQLite store and the room logs, the way the server writes
+them), then starts server.py on it and on an empty directory and reports the
+load time the server prints and the time until it accepts connections.
+
+    python benchmarks/bench_startup.py --messages 1000000 --rooms 10 --users 1000
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_engines import wait_for_port
+from store import Store
+from message_log import MessageLog, room_log_dir
+from message import Message
+from room import Room
+from user import User
+
+BATCH = 10000
+
+
+def populate(history_dir, users, rooms, messages):
+    store = Store(os.path.join(history_dir, "chat.db")).start()
+    members = []
+    for uid in range(users):
+        user = User(f"user{uid}", "pw")
+        user.uid = uid
+        store.add_user(user)
+        members.append(user)
+
+    logs = []
+    for rid in range(rooms):
+        room = Room("Broadcast" if rid == 0 else f"room{rid}", [])
+        room.rid = rid
+        store.add_room(room)
+        if rid:
+            for user in members[rid % users::rooms]:
+                store.add_member(room, user)
+        logs.append((room.name, MessageLog(room_log_dir(history_dir, room.name)), []))
+    store.flush()
+    store.close()
+
+    for i in range(messages):
+        room_name, log, pending = logs[i % rooms]
+        message = Message(room_name, f"user{i % users}", f"message number {i} with some typical chat text")
+        message.seq = i // rooms + 1
+        pending.append(json.dumps(message.toJSON()).encode() + b"\n")
+        if len(pending) == BATCH:
+            log.write(pending)
+            pending.clear()
+    for _, log, pending in logs:
+        log.write(pending)
+        log.close()
+
+
+def start(history_dir, port):
+    cmd = [sys.executable, "-u", os.path.join(ROOT, "server.py"), "--port", str(port),
+           "--history-dir", history_dir, "--log-level", "ERROR"]
+    begin = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        wait_for_port(port, timeout=60)
+        ready = time.perf_counter() - begin
+        return ready, proc.stdout.readline().strip()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=5800)
+    parser.add_argument("--dir", default=None, help="where to create the history directories, a temporary directory by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as empty, tempfile.TemporaryDirectory(dir=args.dir) as full:
+        begin = time.perf_counter()
+        populate(full, args.users, args.rooms, args.messages)
+        print(f"wrote {args.messages:,} messages in {args.rooms} rooms for {args.users} users "
+              f"in {time.perf_counter() - begin:.1f}s")
+
+        for name, history_dir, port in (("empty", empty, args.port), ("stored", full, args.port + 1)):
+            ready, line = start(history_dir, port)
+            print(f"{name:>7}: accepting connections after {ready * 1000:.0f} ms")
+            print(f"         {line}")
@@ -1,6 +1,6 @@
 import sys
+import queue
 import socket
-import struct
 import threading
 import logging
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit, QTextEdit, QLabel, QComboBox, QListWidget, QInputDialog
@@ -8,22 +8,30 @@ from PyQt5.QtCore import Qt, QTimer
 from user import User
 from room import Room
 from message import Message
-import pickle
+import framing
+from pipeline import PipelinedChannel, LockstepReply
+import json
+from datetime import datetime
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 class ChatClient(QWidget):
-    def __init__(self):
+    def __init__(self, pipelined=False):
         super().__init__()
         self.user = None
+        self.pipelined = pipelined # tag requests with IDs and keep several in flight (see pipeline.py)
+        self.channel = None
         self.client_socket = None
         self.listening_socket = None
         self.server_host = '127.0.0.1'
         self.server_port = 5555
         self.rooms = ["Broadcast"]
         self.current_room = "Broadcast"
-        self.messages = []
+        self.messages = {} # room_name: messages received so far, oldest first
+        self.history_before = {} # room_name: cursor of the next older page of history, None when there is none
+        self.unread = {} # room_name: messages in the room that have not been seen
+        self.online = set() # usernames of the contacts that are online, kept up to date by PRESENCE events
 
         self.init_ui()
         self.manage_socket()
@@ -58,12 +66,14 @@ class ChatClient(QWidget):
         toolbar_layout = QHBoxLayout()
         self.room_selector = QComboBox()
         self.refresh_rooms_button = QPushButton("Refresh") # refresh rooms and messages
+        self.older_messages_button = QPushButton("Older Messages")
         self.create_room_button = QPushButton("Create Room")
         self.add_participants_button = QPushButton("Add Participants")
         self.logout_button = QPushButton("Logout")
 
         toolbar_layout.addWidget(self.room_selector)
         toolbar_layout.addWidget(self.refresh_rooms_button)
+        toolbar_layout.addWidget(self.older_messages_button)
         toolbar_layout.addWidget(self.create_room_button)
         toolbar_layout.addWidget(self.add_participants_button)
         toolbar_layout.addWidget(self.logout_button)
@@ -91,9 +101,10 @@ class ChatClient(QWidget):
         self.register_button.clicked.connect(self.register)
         self.logout_button.clicked.connect(self.logout)
         self.refresh_rooms_button.clicked.connect(lambda: self.get_rooms(force=True))
+        self.older_messages_button.clicked.connect(self.load_older_messages)
         self.create_room_button.clicked.connect(self.create_room)
         self.add_participants_button.clicked.connect(self.add_participants)
-        self.room_selector.currentTextChanged.connect(self.select_render_room)
+        self.room_selector.currentIndexChanged.connect(lambda index: self.select_render_room(self.room_selector.itemData(index)))
         self.send_button.clicked.connect(self.send_message)
         self.message_input.returnPressed.connect(self.send_message)
 
@@ -130,6 +141,8 @@ class ChatClient(QWidget):
         if "successful" in response:
             logger.debug(f"Server responded with successful: {response}")
             self.user = User(username, password, self.client_socket)
+            if self.pipelined:
+                self.channel = PipelinedChannel(self.client_socket)
             self.show_chat_view()
             self.get_rooms()
             threading.Thread(target=self.listen).start()
@@ -149,20 +162,42 @@ class ChatClient(QWidget):
             return
         
         while True:
-            msg = self.receive(self.listening_socket).split("|")
+            frame = self.receive(self.listening_socket)
+            if frame.startswith("PRESENCE|"):
+                presence = json.loads(frame[len("PRESENCE|"):])
+                self.online.update(presence["online"])
+                self.online.difference_update(presence["offline"])
+                logger.debug(f"Contacts online: {sorted(self.online)}")
+                continue
+
+            msg = frame.split("|", 4)
             if msg[0] != "UPDATE":
                 continue
 
             room_name = msg[1]
             if room_name != self.current_room:
-                continue
+                self.unread[room_name] = self.unread.get(room_name, 0) + 1
+                self.update_room_label(room_name)
+
+            room_messages = self.messages.get(room_name)
+            if room_messages is None:
+                continue # history not loaded yet, SELECT_ROOM will fetch it
 
             author_username = msg[2]
-            message = msg[3]
+            seq = int(msg[3])
+            message = msg[4]
+            last_seq = room_messages[-1].seq if room_messages else 0
+            if seq != last_seq + 1:
+                # already have it, or UPDATEs were dropped, the next SELECT_ROOM fills the gap
+                logger.debug(f"UPDATE {seq} in {room_name} does not follow {last_seq}")
+                continue
+
             messageObj = Message(room_name, author_username, message)
-            messages = [messageObj]
+            messageObj.seq = seq
+            room_messages.append(messageObj)
 
-            self.update_chat_display(messages, clear=False)
+            if room_name == self.current_room:
+                self.update_chat_display([messageObj], clear=False)
 
     def register(self):
         username = self.username_input.text()
@@ -188,16 +223,24 @@ class ChatClient(QWidget):
             self.show_error("Registration failed. Please try a different username.")
 
     def logout(self):
-        self.send_all(self.client_socket, "LOGOUT")
-        try:    
-            response = self.client_socket.recv(1024).decode('utf-8')
+        self.mark_read(self.current_room)
+        try:
+            if self.channel:
+                # tagged like the READ before it, so the server handles it after the READ
+                response = self.channel.request("LOGOUT").text()
+            else:
+                self.send_all(self.client_socket, "LOGOUT")
+                response = self.client_socket.recv(1024).decode('utf-8')
             logger.debug(f"Server response: {response}")
         except Exception as e:
             logger.error(f"Exception occurred: {e}\n")
+        # the pipelined reader owns the socket, closing it is all that is left to do
+        self.channel = None
         
         self.client_socket.close()
         self.manage_socket()
         self.user = None
+        self.messages, self.history_before, self.unread, self.online = {}, {}, {}, set()
         self.show_auth_view()
 
     def show_auth_view(self):
@@ -211,9 +254,11 @@ class ChatClient(QWidget):
     def get_rooms(self, force=False):
         try:
             logger.debug(f"IN GET ROOMS ROOM NAME IS {self.current_room}\n")
-            self.send_all(self.client_socket, "SEND_ROOMS")
+            reply = self.request("SEND_ROOMS|unread")
             logger.debug("Receiving rooms from server...")
-            self.rooms = self.receive(self.client_socket).split("|")
+            self.unread = json.loads(reply.text()) # room name: unread messages, in the order of the rooms
+            self.rooms = list(self.unread)
+            reply.done()
             logger.debug(f"Received rooms from server: {self.rooms}")
             self.update_room_selector()
         except Exception as e:
@@ -224,36 +269,94 @@ class ChatClient(QWidget):
     def update_room_selector(self):
         current_room = self.current_room
         self.room_selector.clear()
-        self.room_selector.addItems(self.rooms) # prebrishuva self.current_room
+        for room_name in self.rooms: # prebrishuva self.current_room
+            self.room_selector.addItem(self.room_label(room_name), room_name)
         if current_room in self.rooms:
-            self.room_selector.setCurrentText(current_room)
+            self.room_selector.setCurrentIndex(self.room_selector.findData(current_room))
+
+    def room_label(self, room_name):
+        unread = self.unread.get(room_name, 0)
+        return f"{room_name} ({unread})" if unread else room_name
+
+    def update_room_label(self, room_name):
+        index = self.room_selector.findData(room_name)
+        if index >= 0:
+            self.room_selector.setItemText(index, self.room_label(room_name))
+
+    # tells the server how far the room has been seen, for the unread counts of the next login
+    def mark_read(self, room_name):
+        known = self.messages.get(room_name)
+        if not known:
+            return
+        if self.channel:
+            self.channel.request(f"READ|{room_name}|{known[-1].seq}", expect_reply=False)
+        else:
+            self.send_all(self.client_socket, f"READ|{room_name}|{known[-1].seq}")
 
     def select_render_room(self, room_name):
         if not room_name:
             return
 
-        self.send_all(self.client_socket, f"SELECT_ROOM|{room_name}")
-        logger.debug(f"Sent action: SELECT_ROOM|{room_name}")
+        if room_name != self.current_room:
+            # the messages that came in while the room we are leaving was shown have been seen
+            self.mark_read(self.current_room)
 
-        response = self.receive(self.client_socket)
+        # only ask for what came after the newest message we already have
+        known = self.messages.get(room_name, [])
+        since = known[-1].seq if known else 0
+        reply = self.request(f"SELECT_ROOM|{room_name}|{since}")
+        logger.debug(f"Sent action: SELECT_ROOM|{room_name}|{since}")
+
+        response = reply.text()
         if "SUCCESSFULLY" not in response:
             self.show_error("Access Denied!")
         else:
-            self.current_room = room_name
             self.show_info("Successfully joined room!")
-            room_messages = self.get_room_messages(room_name)
-            self.update_chat_display(room_messages)
+            new_messages, before = self.get_room_messages(reply)
+            if known and before is None:
+                # the listening thread may have appended some of them in the meantime
+                new_messages = [message for message in new_messages if message.seq > known[-1].seq]
+                self.messages[room_name] = known + new_messages
+            else:
+                # first visit, or more than a page was missed: start over from the newest page
+                self.messages[room_name] = new_messages
+                self.history_before[room_name] = before
+
+            if room_name == self.current_room and known and before is None:
+                self.update_chat_display(new_messages, clear=False)
+            else:
+                self.update_chat_display(self.messages[room_name])
+            self.current_room = room_name
+            self.unread[room_name] = 0
+            self.update_room_label(room_name)
+        reply.done()
+
+    # only the newest page comes with SELECT_ROOM, older pages are fetched on demand
+    def load_older_messages(self):
+        room_name = self.current_room
+        before = self.history_before.get(room_name)
+        if before is None:
+            self.show_info("No older messages.")
+            return
+
+        reply = self.request(f"HISTORY|{room_name}|{before}")
+        older, self.history_before[room_name] = self.get_room_messages(reply)
+        reply.done()
+        self.messages[room_name] = older + self.messages[room_name]
+        self.update_chat_display(self.messages[room_name])
 
-    def get_room_messages(self, room_name):
-        serialized_messages = self.client_socket.recv(2048)
-        messages = pickle.loads(serialized_messages)
-        return messages
+    # reads one page of history, returns its messages oldest first and the cursor of the next older page
+    def get_room_messages(self, reply):
+        page = json.loads(reply.text())
+        messages = [Message.fromJSON(page["room"], data) for data in page["messages"]]
+        messages.reverse() # pages come newest first
+        return messages, page["before"]
 
     def update_chat_display(self, messages, clear=True):
         if clear == True:
             self.chat_display.clear()
         for message in messages:
-            self.chat_display.append(f"<b>{message.author_name}</b> ({message.timestamp.strftime('%c')}): {message.text}")
+            self.chat_display.append(f"<b>{message.author_name}</b> ({datetime.fromtimestamp(message.timestamp).strftime('%c')}): {message.text}")
 
     def send_message(self):
         message = self.message_input.text()
@@ -261,20 +364,59 @@ class ChatClient(QWidget):
             return
 
         msg = f"SEND_MESSAGE|{self.current_room}|{message}"
+        if self.channel:
+            # the message comes back as an UPDATE on the listening socket, no need to wait or refresh,
+            # the reply is only looked at once it is in, to put a refused message back (see check_sent)
+            reply = self.channel.request(msg)
+            logger.debug(f"Message sent: {msg}")
+            self.message_input.clear()
+            self.check_sent(reply, message)
+            return
+
         self.send_all(self.client_socket, msg)
         logger.debug(f"Message sent: {msg}")
 
         response = self.receive(self.client_socket)
         logger.debug(f"Received response after sending Message: {response}")
+        if response.startswith("RATE_LIMITED|"):
+            self.rate_limited(response, message) # the message stays in the input to be sent again
+            return
         
         self.message_input.clear()
         self.select_render_room(self.current_room)  # Refresh messages
 
+    # the reply of a pipelined SEND_MESSAGE, polled from the GUI thread so that it never waits for it
+    def check_sent(self, reply, message):
+        try:
+            response = reply.text(timeout=0)
+        except queue.Empty:
+            QTimer.singleShot(50, lambda: self.check_sent(reply, message))
+            return
+        except ConnectionError:
+            return # the connection is gone, the reader thread has forgotten the reply
+        reply.done()
+        logger.debug(f"Received response after sending Message: {response}")
+        if response.startswith("RATE_LIMITED|"):
+            self.rate_limited(response, message)
+
+    # the message was not sent: it goes back into the input, unless something new has been typed there
+    def rate_limited(self, response, message):
+        limit = json.loads(response[len("RATE_LIMITED|"):])
+        self.show_error(f"Slow down! Try again in {limit['retry_after']:.1f} seconds.")
+        if not self.message_input.text():
+            self.message_input.setText(message)
+
     def create_room(self):
         room_name, ok = QInputDialog.getText(self, "Create Room", "Enter room name:")
         if ok and room_name:
             logger.debug(f"Sending 'CREATE_ROOM' and room_name to server...")
-            self.send_all(self.client_socket, f"CREATE_ROOM|{room_name}")
+            if self.channel:
+                # pipelined requests may run in parallel, wait for the room to exist before listing rooms
+                reply = self.channel.request(f"CREATE_ROOM|{room_name}")
+                reply.get()
+                reply.done()
+            else:
+                self.send_all(self.client_socket, f"CREATE_ROOM|{room_name}")
             logger.debug(f"CREATE_ROOM and room_name sent.")
             self.get_rooms(force=True)
 
@@ -283,14 +425,19 @@ class ChatClient(QWidget):
             self.show_error("Cannot add participants to Broadcast room.")
             return
 
-        self.send_all(self.client_socket, f"ADD_PARTICIPANTS|{self.current_room}")
-        registered_users = self.receive(self.client_socket).split("|")
+        reply = self.request(f"ADD_PARTICIPANTS|{self.current_room}")
+        registered_users = reply.text().split("|")
+        reply.done()
         logger.debug(f"Received registered_users from server: {registered_users}")
 
         participants, ok = QInputDialog.getItem(self, "Add Participants", 
                                                 "Select users to add:", 
                                                 registered_users, 0, True)
-        if ok and participants:
+        if self.channel:
+            # pipelined requests cannot be continued, the chosen users go out in a request of their own
+            if ok and participants:
+                self.channel.request(f"ADD_PARTICIPANTS|{self.current_room}|{participants}", expect_reply=False)
+        elif ok and participants:
             self.send_all(self.client_socket, participants)
             logger.debug(f"Sent participants to server: {participants}")
         else:
@@ -301,23 +448,18 @@ class ChatClient(QWidget):
         self.client_socket.close()
         self.client_socket = self.create_socket()
 
+    # sends a request of the logged in user, returns something to read its reply frames from
+    def request(self, msg):
+        if self.channel:
+            return self.channel.request(msg)
+        self.send_all(self.client_socket, msg)
+        return LockstepReply(self.client_socket)
+
     def send_all(self, sock, msg):
-        fullmsg = struct.pack("!i", len(msg)) + msg.encode()
-        sock.sendall(fullmsg)
+        framing.send_frame(sock, msg.encode())
 
     def receive(self, sock):
-        length = struct.unpack("!i", self.recv_all(sock, 4))[0]
-        message = self.recv_all(sock, length).decode()
-        return message
-
-    def recv_all(self, sock, length):
-        data = b""
-        while len(data) < length:
-            more = sock.recv(length - len(data))
-            if not more:
-                raise EOFError("Socket closed %d bytes into a %d-byte message" % (len(data), length))
-            data += more
-        return data
+        return framing.recv_text(sock)
 
     def show_error(self, message):
         # In a real application, you'd use QMessageBox for errors
@@ -329,6 +471,6 @@ class ChatClient(QWidget):
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
-    client = ChatClient()
+    client = ChatClient(pipelined="--pipelined" in sys.argv)
     client.show()
     sys.exit(app.exec_())
\ No newline at end of file
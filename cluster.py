@@ -0,0 +1,234 @@
+"""Cluster mode: several server nodes, possibly on different hosts, serving one chat.
+
+    python server.py --port 5555 --history-dir n0 --cluster 127.0.0.1:7000,127.0.0.1:7001 --cluster-index 0
+    python server.py --port 5556 --history-dir n1 --cluster 127.0.0.1:7000,127.0.0.1:7001 --cluster-index 1
+
+Every node is given the peer addresses of all nodes (the same list, in the same
+order) and its own index in it, and the nodes connect to each other over TCP
+(PeerMesh). A client connects to any node, with both its command and its
+LISTEN connection.
+
+Users, rooms, memberships and presence (who is logged in on which node) are
+kept on every node (see replica.Replica): a change is published, node 0 puts
+the published changes in order and every node applies them in that order, and
+writes them to its own store. That traffic is small and every node needs it.
+
+Messages are not sent everywhere. Every room has an owner, node rid % nodes,
+which numbers its messages, writes its log and relays each message to the nodes
+that have a connection of one of the room's participants, and only to those
+(interest, see replica.OwnedRooms). The other nodes keep a copy of the room that only numbers its
+messages and is only up to date while they are interested. Pages and searches
+are made by the owner. A message posted on another node is forwarded to the
+room's owner and acknowledged once the owner's log has it.
+
+Read cursors move on the node the user is logged in on and reach the others
+with the logout. All nodes start together, and a node that loses a link to
+another stops, since it could not catch up on what it missed.
+"""
+import json
+import time
+import socket
+import struct
+import logging
+import threading
+from queue import SimpleQueue
+import framing
+from replica import OwnedRooms
+from server import Server
+from async_server import AsyncServer
+
+logger = logging.getLogger(__name__)
+
+COORDINATOR = 0 # index of the node that orders published changes
+CONNECT_TIMEOUT = 30.0 # seconds a node keeps trying to reach the others at startup
+DESTINATION = struct.Struct("!i") # index of the node a link comes from, its first frame
+MAX_MESSAGE_SIZE = 256 << 20 # replies with log records (see replica.RemoteLog) can be large
+BATCH_BYTES = 1 << 20 # a frame is not filled up past this, a single larger entry goes out alone
+
+# what an entry of a frame between nodes is
+PUBLISH = "P" # a change for the coordinator to put in order
+PUBLISHED = "E" # a change, in order
+DIRECT = "D" # a request or answer for this node alone
+
+
+def parse_addresses(addresses):
+    return [(host, int(port)) for host, port in (address.rsplit(":", 1) for address in addresses.split(","))]
+
+
+# removes and returns the entries (encoded) at the front of the list, up to BATCH_BYTES of them
+def take_batch(entries):
+    size = count = 0
+    for entry in entries:
+        if count and size + len(entry) > BATCH_BYTES:
+            break
+        size += len(entry)
+        count += 1
+    batch = entries[:count]
+    del entries[:count]
+    return batch
+
+
+class PeerMesh:
+    """The links between the nodes of a cluster.
+
+    Every node listens on its own address and connects to every other one, so
+    two nodes have a link each way, each written by one and read by the other.
+    Frames are JSON lists of (kind, message) entries: whatever is queued for a
+    link while its last frame is being written goes out together in the next
+    one, up to BATCH_BYTES, so relays are batched as soon as there are
+    more than the link keeps up with one by one.
+
+    publish() hands the message to the coordinator, which sends it on to every
+    node, itself included, in the order it got them. send() goes to one node.
+    Messages are handed to on_message(message, published) on the threads
+    reading the links.
+    """
+
+    def __init__(self, index, addresses, on_message):
+        self.index = index
+        self.on_message = on_message
+        self.order_lock = threading.Lock() # on the coordinator, held while a change is sent to every node
+        self.failures = SimpleQueue()
+        self.stats_lock = threading.Lock()
+        self.frames_received = 0
+        self.received = {} # kind of message: how many came in
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(addresses[index])
+        self.listener.listen(len(addresses))
+        self.links = {peer: PeerLink(self.index, peer, address, self.failures)
+                      for peer, address in enumerate(addresses) if peer != index}
+
+
+    def publish(self, message):
+        if self.index == COORDINATOR:
+            self.order(message)
+        else:
+            self.links[COORDINATOR].put((PUBLISH, message))
+
+
+    def order(self, message):
+        with self.order_lock:
+            for link in self.links.values():
+                link.put((PUBLISHED, message))
+            self.on_message(message, True)
+
+
+    def send(self, index, message):
+        if index == self.index:
+            self.on_message(message, False)
+        else:
+            self.links[index].put((DIRECT, message))
+
+
+    # accepts the links from the other nodes and returns (raising) once one of the links fails
+    def run(self):
+        for _ in range(len(self.links)):
+            sock, _ = self.listener.accept()
+            peer = DESTINATION.unpack(framing.recv_frame(sock, MAX_MESSAGE_SIZE))[0]
+            threading.Thread(target=self.read, args=(peer, sock), name=f"peer-{peer}", daemon=True).start()
+        self.listener.close()
+        raise self.failures.get()
+
+
+    def read(self, peer, sock):
+        try:
+            while True:
+                entries = json.loads(bytes(framing.recv_frame(sock, MAX_MESSAGE_SIZE)))
+                with self.stats_lock:
+                    self.frames_received += 1
+                    for _, message in entries:
+                        self.received[message[0]] = self.received.get(message[0], 0) + 1
+                for kind, message in entries:
+                    if kind == PUBLISH:
+                        self.order(message)
+                    else:
+                        self.on_message(message, kind == PUBLISHED)
+        except Exception as e:
+            self.failures.put(ConnectionError(f"Link from node {peer} failed: {e}"))
+
+
+    def stats(self):
+        with self.stats_lock:
+            return {"frames received": self.frames_received, "received": dict(self.received),
+                    "frames sent": sum(link.frames_sent for link in self.links.values()),
+                    "entries sent": sum(link.entries_sent for link in self.links.values())}
+
+
+class PeerLink:
+    """Outgoing link to one node: put() queues an entry, a sender thread writes what is queued as frames.
+
+    Entries are encoded as they are queued, so frames can be cut at
+    BATCH_BYTES: a backlog never makes a frame the other node refuses as
+    larger than MAX_MESSAGE_SIZE.
+    """
+
+    def __init__(self, index, peer, address, failures):
+        self.peer = peer
+        self.failures = failures
+        self.entries = []
+        self.cond = threading.Condition()
+        self.frames_sent = 0
+        self.entries_sent = 0
+
+        # the other nodes are starting as well
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                self.sock = socket.create_connection(address)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        framing.send_frame(self.sock, DESTINATION.pack(index))
+        threading.Thread(target=self.run, name=f"link-{peer}", daemon=True).start()
+
+
+    def put(self, entry):
+        entry = json.dumps(entry).encode()
+        with self.cond:
+            self.entries.append(entry)
+            self.cond.notify()
+
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.entries)
+                    batch = take_batch(self.entries)
+                framing.send_frame(self.sock, b"[" + b", ".join(batch) + b"]")
+                self.frames_sent += 1
+                self.entries_sent += len(batch)
+        except Exception as e:
+            self.failures.put(ConnectionError(f"Link to node {self.peer} failed: {e}"))
+
+
+class ClusterNode(OwnedRooms):
+    """One node of a cluster, see the top of this module.
+
+    Rooms are owned and relayed as replica.OwnedRooms does it, over a PeerMesh,
+    and every node writes its own store.
+    """
+
+    def __init__(self, host, port, config, index, addresses):
+        mesh = PeerMesh(index, addresses, self.on_bus_message)
+        super().__init__(host, port, config, index, len(addresses), mesh)
+
+
+class ThreadedClusterNode(ClusterNode, Server):
+    pass
+
+
+class AsyncClusterNode(ClusterNode, AsyncServer):
+    pass
+
+
+ENGINES = {"threads": ThreadedClusterNode, "asyncio": AsyncClusterNode}
+
+
+def run_node(engine, host, port, config, index, addresses):
+    ENGINES[engine](host, port, config, index, parse_addresses(addresses))
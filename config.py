@@ -0,0 +1,75 @@
+class ServerConfig:
+    """Tunables of the server. Defaults live on the class, override any of them by keyword."""
+
+    # connections the server takes on (see admission.py), more are told so and closed
+    listen_backlog = 128 # connections the kernel holds until they are accepted
+    max_connections = 10000 # command and LISTEN connections
+    max_unauthenticated = 1000 # connections that have not logged in (or sent LISTEN) yet
+    auth_timeout = 30.0 # seconds a connection has to log in (or send LISTEN)
+
+    # largest frame a client may send (see framing.py), a larger one closes the connection
+    max_frame_size = 1 << 20 # bytes
+
+    # threads handling requests that carry a request ID (see pipeline.py), one connection at a time each, threaded engine only
+    pipeline_workers = 8
+    pipeline_depth = 64 # tagged requests of one connection waiting for those threads, the connection is not read past that
+
+    # per-connection outbound queue in front of the LISTEN socket (see outbound.py)
+    outbound_queue_size = 1000 # frames
+    outbound_queue_bytes = 8 << 20 # bytes, the queue is full at whichever limit it reaches first; also the
+                                   # most replies either engine lets pile up unread on a pipelined command connection
+    outbound_policy = "drop_oldest" # drop_oldest, disconnect or mark_lagging
+
+    # passwords are stored as salted hashes, made and checked on threads of their own (see credentials.py)
+    password_hash = "scrypt" # scrypt or pbkdf2_sha256
+    password_hash_cost = None # scrypt n or PBKDF2 iterations, the scheme's default when not set
+    password_hash_workers = 2
+    login_concurrency = 32 # logins and registrations being hashed or waiting for it, more are refused as busy
+
+    # logins and logouts are sent to the users' contacts together, once per window (see presence.py)
+    presence_window = 0.25 # seconds
+
+    # SEND_MESSAGE takes a token from the author's bucket and one from the room's (see ratelimit.py), a message
+    # finding either empty is refused as RATE_LIMITED; rates are messages per second, 0 for no limit
+    user_message_rate = 10.0 # every user, over all rooms
+    user_message_burst = 30 # messages above the rate a full bucket lets through at once
+    broadcast_message_rate = 20.0 # the Broadcast room, from all its participants together
+    broadcast_message_burst = 50
+    large_room_size = 100 # participants from which a room is a large one
+    large_room_message_rate = 50.0
+    large_room_message_burst = 100
+    room_message_rate = 200.0 # every other room
+    room_message_burst = 400
+
+    # messages per page of room history, newest first (see Server.send_history_page)
+    history_page_size = 50
+
+    # newest messages of a room kept in memory (see history.py), 0 for no bound; all of them are in the log
+    history_hot_messages = 1000
+    history_hot_bytes = 0
+    history_hot_layout = "records" # records: as encoded JSON, columnar: packed into arrays, smaller but slower pages
+
+    # message logs of the rooms (see message_log.py), a temporary directory (gone after a restart) when not set
+    history_dir = None
+    history_segment_bytes = 16 * 1024 * 1024
+
+    # full segments of the logs are rewritten as compressed blocks in the background (see message_log.Compressor)
+    history_compression = "zlib" # zlib, lzma or none
+    history_block_messages = 256 # messages per compressed block
+    history_block_cache = 64 # decompressed blocks kept in memory, shared by all rooms
+
+    # messages are written to the logs in the background, in batches (see message_log.LogCommitter)
+    message_durability = "write" # SEND_MESSAGE is acknowledged once the message is: enqueue(d), write(ten) or fsync(ed)
+    message_commit_interval = 0.0 # seconds a batch waits to fill up, with 0 it holds whatever came in during the last commit
+    message_commit_batch = 1000 # records that are committed without waiting for the interval
+
+    # SQLite database of users, rooms and memberships (see store.py), chat.db in history_dir when not set
+    store_path = None
+    store_commit_interval = 0.05 # seconds a write may wait to be committed with others
+    store_batch_size = 500 # writes that are committed right away without waiting for the interval
+
+    def __init__(self, **overrides):
+        for name, value in overrides.items():
+            if not hasattr(ServerConfig, name):
+                raise TypeError(f"Unknown server config option: {name}")
+            setattr(self, name, value)
@@ -0,0 +1,138 @@
+"""Password hashing.
+
+Passwords are stored as salted hashes from a deliberately slow key derivation
+function, scrypt (the default) or PBKDF2-HMAC-SHA256, in the form
+
+    scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+    pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>
+
+so a hash is verified with the parameters it was made with, whatever the
+server is configured with now. A stored password without a scheme is a
+plaintext one from before hashing, it is verified as such and replaced by a
+hash on the user's next login (see Server.end_login).
+
+Hashing takes tens of milliseconds of CPU on purpose, so it never runs on a
+connection's thread or the event loop but on the threads of a CredentialPool.
+hashlib releases the GIL while it derives a key, so those threads do not hold
+up the rest of the server.
+"""
+import os
+import hmac
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SCRYPT = "scrypt"
+PBKDF2 = "pbkdf2_sha256"
+SCHEMES = (SCRYPT, PBKDF2)
+
+DEFAULT_COST = {SCRYPT: 1 << 14, PBKDF2: 600_000} # scrypt n, PBKDF2 iterations
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+class CredentialsBusy(RuntimeError):
+    """Raised instead of queueing a hash once the pool's limit is reached."""
+
+
+def hash_password(password, scheme=SCRYPT, cost=None):
+    cost = cost or DEFAULT_COST[scheme]
+    salt = os.urandom(SALT_BYTES)
+    if scheme == SCRYPT:
+        key = derive_scrypt(password, salt, cost, SCRYPT_R, SCRYPT_P)
+        return f"{SCRYPT}${cost}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${key.hex()}"
+    if scheme == PBKDF2:
+        key = derive_pbkdf2(password, salt, cost)
+        return f"{PBKDF2}${cost}${salt.hex()}${key.hex()}"
+    raise ValueError(f"Unknown password hash scheme: {scheme}")
+
+
+def verify_password(password, stored):
+    scheme, *fields = stored.split("$")
+    if scheme == SCRYPT and len(fields) == 5:
+        n, r, p, salt, key = fields
+        derived = derive_scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    elif scheme == PBKDF2 and len(fields) == 3:
+        iterations, salt, key = fields
+        derived = derive_pbkdf2(password, bytes.fromhex(salt), int(iterations))
+    else:
+        return hmac.compare_digest(password.encode(), stored.encode()) # plaintext, stored before hashing
+    return hmac.compare_digest(derived, bytes.fromhex(key))
+
+
+def is_hashed(stored):
+    return stored.split("$", 1)[0] in SCHEMES
+
+
+def derive_scrypt(password, salt, n, r, p):
+    # 128 * n * r bytes of memory, with some headroom over OpenSSL's 32 MiB default limit
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_BYTES,
+                          maxmem=256 * n * r + (1 << 20))
+
+
+def derive_pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations, KEY_BYTES)
+
+
+class CredentialPool:
+    """Hashes and verifies passwords on a few threads of its own.
+
+    hash() and verify() return futures. At most `limit` of them may be queued
+    or running at once: past that they raise CredentialsBusy right away, so a
+    burst of logins is told to retry instead of piling up behind each other.
+    """
+
+    def __init__(self, scheme=SCRYPT, cost=None, workers=2, limit=32):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Unknown password hash scheme: {scheme}")
+        self.scheme = scheme
+        self.cost = cost
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="credentials")
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+
+        # counters
+        self.hashed = 0
+        self.verified = 0
+        self.refused = 0
+        self.busy_seconds = 0.0
+
+
+    def hash(self, password):
+        return self.submit(hash_password, password, self.scheme, self.cost)
+
+
+    def verify(self, password, stored):
+        return self.submit(verify_password, password, stored)
+
+
+    def submit(self, derive, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.refused += 1
+            raise CredentialsBusy("Too many logins at once")
+        future = self.executor.submit(self.run, derive, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+
+    def run(self, derive, *args):
+        start = time.perf_counter()
+        try:
+            return derive(*args)
+        finally:
+            with self.lock:
+                if derive is hash_password:
+                    self.hashed += 1
+                else:
+                    self.verified += 1
+                self.busy_seconds += time.perf_counter() - start
+
+
+    def stats(self):
+        with self.lock:
+            return {"hashed": self.hashed, "verified": self.verified, "refused": self.refused,
+                    "busy_seconds": self.busy_seconds}
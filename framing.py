@@ -0,0 +1,118 @@
+import struct
+import threading
+
+# Every frame on the wire is a 4 byte big-endian length followed by that many bytes of UTF-8 payload.
+HEADER = struct.Struct("!i")
+MAX_FRAME_SIZE = 1 << 20 # 1 MiB, frames announcing more than this are rejected
+
+# frames up to this size are read into a buffer that is kept and reused by the receiving thread
+REUSED_BUFFER_SIZE = 64 * 1024
+
+# Below this size a plain recv() into a new bytes object is cheaper than recv_into() plus the
+# memoryview bookkeeping, and gluing header and payload together is cheaper than a vectored send.
+SMALL_FRAME_SIZE = 16 * 1024
+
+_local = threading.local()
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+def encode_frame(payload):
+    """Returns header and payload as one immutable buffer, for frames that get queued or reused."""
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload):
+    """Writes one frame without copying the payload into a combined buffer."""
+    header = HEADER.pack(len(payload))
+    if len(payload) < SMALL_FRAME_SIZE:
+        sock.sendall(header + payload)
+    elif hasattr(sock, "sendmsg"):
+        send_buffers(sock, [header, payload])
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def send_buffers(sock, buffers):
+    """Writes all buffers with as few sendmsg() calls as the kernel allows."""
+    buffers = [memoryview(buf) for buf in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # drop what was written, a partial write leaves a tail of one buffer
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def recv_into_exactly(sock, view, received=0):
+    while received < len(view):
+        more = sock.recv_into(view[received:])
+        if not more:
+            raise EOFError("Socket closed %d bytes into a %d-byte message" % (received, len(view)))
+        received += more
+
+
+def recv_frame(sock, max_frame_size=MAX_FRAME_SIZE):
+    """Reads one frame and returns its payload.
+
+    Payloads are read with recv_into() into a buffer owned by the calling thread
+    and returned as a memoryview that is only valid until the thread reads its
+    next frame. Small payloads are returned as bytes, for them a single recv() is
+    cheaper than any buffer bookkeeping. Nothing past the end of the frame is
+    read from the socket, so raw reads can still follow a frame.
+    """
+    try:
+        header, buffer = _local.header, _local.buffer
+    except AttributeError:
+        header = _local.header = bytearray(HEADER.size)
+        buffer = _local.buffer = bytearray(REUSED_BUFFER_SIZE)
+
+    # the first read almost always returns everything, only partial reads take the slow path
+    received = sock.recv_into(header)
+    if received < HEADER.size:
+        recv_into_exactly(sock, memoryview(header), received)
+    length = HEADER.unpack(header)[0]
+    check_frame_size(length, max_frame_size)
+
+    if length < SMALL_FRAME_SIZE:
+        payload = sock.recv(length)
+        if len(payload) == length:
+            return payload
+        buffer[:len(payload)] = payload
+        received = len(payload)
+    else:
+        if length > len(buffer):
+            buffer = bytearray(length)
+        received = sock.recv_into(buffer, length)
+
+    view = memoryview(buffer)[:length]
+    if received < length:
+        recv_into_exactly(sock, view, received)
+    return view
+
+
+def recv_text(sock, max_frame_size=MAX_FRAME_SIZE):
+    # decoding the whole payload at once keeps multi-byte characters split across recv() calls intact
+    payload = recv_frame(sock, max_frame_size)
+    if type(payload) is bytes:
+        return payload.decode()
+    return str(payload, "utf-8")
+
+
+async def read_frame(reader, max_frame_size=MAX_FRAME_SIZE):
+    """asyncio counterpart of recv_frame(), returns the payload as bytes."""
+    length = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+    check_frame_size(length, max_frame_size)
+    return await reader.readexactly(length)
+
+
+def check_frame_size(length, max_frame_size=MAX_FRAME_SIZE):
+    if length < 0 or length > max_frame_size:
+        raise FrameTooLarge(f"Frame of {length} bytes exceeds the limit of {max_frame_size} bytes")
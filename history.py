@@ -0,0 +1,286 @@
+import sys
+import json
+import logging
+import threading
+from array import array
+from collections import deque
+from itertools import islice
+from message_log import DONE
+from search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+
+class IndexNotReady(Exception):
+    """The search index of the room is still being built."""
+
+    def __init__(self, room_name):
+        super().__init__(f"The search index of {room_name} is being built")
+        self.room_name = room_name
+
+
+class RoomHistory:
+    """Messages of one room, numbered from 1.
+
+    Every message is written through to the room's MessageLog. The newest ones
+    (the hot window) are also kept in memory as their encoded JSON record,
+    bounded by count and/or by size in bytes, 0 meaning no bound. Pages that
+    reach past the hot window are read from the log, so the memory a room takes
+    does not grow with its history. Without a log every message stays in memory.
+
+    Pages are lists of JSON records (bytes), ready to be sent as they are.
+    The hot window holds them as they are (RecordWindow) or, with columnar,
+    packed into arrays (ColumnarWindow), which takes less memory per message
+    but has to encode the records of every page again.
+
+    The search index is built from the log in the background, on the indexer
+    the server hands in (start_index(), once the log is open), and kept up to
+    date by append() from then on. Until it is built, search() raises
+    IndexNotReady rather than reading the log on the request path.
+    """
+
+    INDEX_CHUNK = 65536 # records read from the log at a time while building the search index
+
+    def __init__(self, room_name, log=None, max_messages=0, max_bytes=0, columnar=False, indexer=None):
+        self.room_name = room_name
+        self.hot = ColumnarWindow() if columnar else RecordWindow()
+        self.hot_bytes = 0
+        self.max_messages = max_messages if log else 0
+        self.max_bytes = max_bytes if log else 0
+        self.log = log
+        self.last_seq = log.last_seq if log else 0 # numbering goes on where a reopened log ends
+        self.lock = threading.Lock()
+        self.index = None # SearchIndex, once built
+        self.index_lock = threading.Lock() # held while the index is built
+        self.indexer = indexer # executor the index is built on
+
+
+    def __len__(self):
+        return self.last_seq
+
+
+    def append(self, message):
+        """Gives the message the next sequence number of the room and stores it.
+
+        Returns the future of the log append (see message_log.LogCommitter).
+        A log that failed raises LogUnwritable and the message is not numbered.
+        """
+        with self.lock:
+            message.seq = self.last_seq + 1
+            record = encode_record(message)
+            durable = self.log.append(record + b"\n") if self.log else DONE
+            self.last_seq = message.seq
+            self.hot_bytes += self.hot.append(message, record)
+            if self.index is not None:
+                self.index.add(message.seq, message.text)
+            self.trim()
+        return durable
+
+
+    # drops the oldest messages from memory until the hot window is within its bounds, only
+    # records the log has already written are dropped, so that pages can still find the others
+    def trim(self):
+        written = self.log.last_seq if self.log else 0
+        while len(self.hot) > 1 and self.last_seq - len(self.hot) + 1 <= written and (
+                (self.max_messages and len(self.hot) > self.max_messages)
+                or (self.max_bytes and self.hot_bytes > self.max_bytes)):
+            self.hot_bytes -= self.hot.popleft()
+
+
+    def page(self, limit, before=None, since=0):
+        """Returns (records, cursor) for up to limit messages, newest first.
+
+        The messages are those with since < seq < before. cursor is the "before"
+        of the next older page, None when no older message above since is left.
+        """
+        with self.lock:
+            end = self.last_seq if before is None else max(0, min(before - 1, self.last_seq))
+            # the page is seq start + 1 .. end, empty when since is at or past end (a client, or a
+            # copy of the room in another process, may know of messages this one has not numbered yet)
+            start = min(max(since, end - limit, 0), end)
+            first_hot = self.last_seq - len(self.hot) + 1
+            first = max(start + 1, first_hot)
+            hot = self.hot.records(first - first_hot, max(0, end - first_hot + 1), first)
+
+        # older records come from the log, which does its own locking
+        records = self.log.read(start + 1, min(end, first_hot - 1)) if self.log else []
+        records.extend(hot)
+        records.reverse()
+        return records, (start + 1 if records and start > since else None)
+
+
+    # records first..last, oldest first
+    def read(self, first, last):
+        with self.lock:
+            last = min(last, self.last_seq)
+            first_hot = self.last_seq - len(self.hot) + 1
+            start = max(first, first_hot)
+            hot = self.hot.records(start - first_hot, max(start - first_hot, last - first_hot + 1), start)
+        records = self.log.read(first, min(last, first_hot - 1)) if self.log else []
+        records.extend(hot)
+        return records
+
+
+    def search(self, query, limit, before=None):
+        """Returns (records, cursor) for up to limit messages containing every word of query, newest first.
+
+        Like page(), cursor is the "before" of the next page, None when no older match is left.
+        Raises IndexNotReady while the index is being built.
+        """
+        if self.index is None:
+            raise IndexNotReady(self.room_name)
+        with self.lock:
+            seqs, cursor = self.index.search(query, limit, before)
+        return self.fetch(seqs), cursor
+
+
+    # records of the given seqs, in that order
+    def fetch(self, seqs):
+        with self.lock:
+            first_hot = self.last_seq - len(self.hot) + 1
+            hot = {seq: self.hot.records(seq - first_hot, seq - first_hot + 1, seq)[0] for seq in seqs if seq >= first_hot}
+        # a page of hits is small, each one is a single index lookup in the log
+        return [hot[seq] if seq in hot else self.log.read(seq, seq)[0] for seq in seqs]
+
+
+    def start_index(self):
+        if self.indexer:
+            self.indexer.submit(self.build_in_background)
+
+
+    # on the indexer, a room whose log cannot be read stays unsearchable and the log says why
+    def build_in_background(self):
+        try:
+            self.build_index()
+        except Exception as e:
+            logger.error(f"Could not index {self.room_name} for search: {e}")
+
+
+    def build_index(self):
+        with self.index_lock:
+            if self.index is not None:
+                return
+            index = SearchIndex()
+            # what the log holds is read without blocking appends to the room ...
+            written = self.log.last_seq if self.log else 0
+            for first in range(index.last_seq + 1, written + 1, self.INDEX_CHUNK):
+                self.index_records(index, self.log.read(first, min(written, first + self.INDEX_CHUNK - 1)))
+            # ... the rest is caught up with appends held off, from then on append() keeps the index up to date
+            with self.lock:
+                first_hot = self.last_seq - len(self.hot) + 1
+                if index.last_seq + 1 < first_hot:
+                    self.index_records(index, self.log.read(index.last_seq + 1, first_hot - 1))
+                start = index.last_seq + 1
+                self.index_records(index, self.hot.records(start - first_hot, len(self.hot), start))
+                self.index = index
+            logger.debug(f"Indexed {index.last_seq} messages of {self.room_name} for search")
+
+
+    @staticmethod
+    def index_records(index, records):
+        for record in records:
+            data = json.loads(record)
+            index.add(data["seq"], data["text"])
+
+
+def encode_record(message):
+    return json.dumps(message.toJSON()).encode()
+
+
+# the hot window of a RoomHistory: append() and popleft() return the bytes the message takes in the window,
+# records(i, j, seq) returns the records i..j-1 (oldest first, 0 being the oldest held), seq is that of record i
+
+class RecordWindow:
+    """Keeps the encoded records, pages are slices of them."""
+
+    def __init__(self):
+        self.items = deque()
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, message, record):
+        self.items.append(record)
+        return sys.getsizeof(record)
+
+    def popleft(self):
+        return sys.getsizeof(self.items.popleft())
+
+    # pages are mostly the newest records, walk the deque from whichever end is closer
+    def records(self, i, j, seq):
+        n = len(self.items)
+        if i > n - j:
+            records = list(islice(reversed(self.items), max(0, n - j), n - i))
+            records.reverse()
+            return records
+        return list(islice(self.items, i, j))
+
+
+class ColumnarWindow:
+    """Keeps one column per field instead of one object per message.
+
+    Timestamps and author ids are machine integers in arrays, the texts are
+    concatenated, UTF-8 encoded, in one bytearray with an array of their end
+    offsets, and authors are numbered within the window. Sequence numbers are
+    not stored, the window holds consecutive ones. That is about 20 bytes plus
+    the text per message, where an encoded record takes its text, the JSON
+    around it and a bytes object of its own.
+    """
+
+    FIELDS = array("q").itemsize + array("I").itemsize + array("Q").itemsize
+
+    def __init__(self):
+        self.timestamps = array("q")
+        self.authors = array("I")
+        self.ends = array("Q") # ends[i]: offset in text where the text of message i ends
+        self.text = bytearray()
+        self.names = [] # author id: name
+        self.name_ids = {}
+        self.head = 0 # messages before head have been dropped, they are cut off in compact()
+
+    def __len__(self):
+        return len(self.timestamps) - self.head
+
+    def append(self, message, record):
+        author = self.name_ids.get(message.author_name)
+        if author is None:
+            author = self.name_ids[message.author_name] = len(self.names)
+            self.names.append(message.author_name)
+        text = message.text.encode()
+        self.timestamps.append(message.timestamp)
+        self.authors.append(author)
+        self.text += text
+        self.ends.append(len(self.text))
+        return self.FIELDS + len(text)
+
+    def popleft(self):
+        start = self.ends[self.head - 1] if self.head else 0
+        size = self.FIELDS + self.ends[self.head] - start
+        self.head += 1
+        if self.head >= 1024 and self.head * 2 >= len(self.timestamps):
+            self.compact()
+        return size
+
+    # drops the columns of the messages before head at once, so that popleft() does not shift them one at a time
+    def compact(self):
+        cut = self.ends[self.head - 1]
+        del self.text[:cut]
+        self.ends = array("Q", [end - cut for end in self.ends[self.head:]])
+        del self.timestamps[:self.head]
+        del self.authors[:self.head]
+        self.head = 0
+
+    def records(self, i, j, seq):
+        records = []
+        i, j = self.head + i, self.head + min(j, len(self))
+        start = self.ends[i - 1] if i else 0
+        for k in range(i, j):
+            end = self.ends[k]
+            records.append(json.dumps({
+                "seq": seq,
+                "author": self.names[self.authors[k]],
+                "timestamp": self.timestamps[k],
+                "text": self.text[start:end].decode(),
+            }).encode())
+            start, seq = end, seq + 1
+        return records
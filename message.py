@@ -1,6 +1,6 @@
 import sys
+import time
 import logging
-from datetime import datetime
 
 # initialize logger for debugging
 logger = logging.getLogger(__name__)
@@ -9,10 +9,27 @@ logging.basicConfig(level=logging.DEBUG) # DEBUG or ERROR
 
 class Message:
 
+    # no per-message __dict__; room and author names are interned, so all messages of a room share one string
+    __slots__ = ("room_name", "timestamp", "author_name", "text", "seq")
+
     def __init__(self, room_name, author_name, text):
-        self.room_name = room_name
-        self.timestamp = datetime.now()
-        self.author_name = author_name
+        self.room_name = sys.intern(room_name)
+        self.timestamp = int(time.time()) # seconds since the epoch
+        self.author_name = sys.intern(author_name)
         self.text = text
-        
-    
\ No newline at end of file
+        self.seq = None # position in the room, assigned by Room.add_message
+
+    def toJSON(self):
+        return {
+            "seq": self.seq,
+            "author": self.author_name,
+            "timestamp": self.timestamp,
+            "text": self.text,
+        }
+
+    @classmethod
+    def fromJSON(cls, room_name, data):
+        message = cls(room_name, data["author"], data["text"])
+        message.seq = data["seq"]
+        message.timestamp = int(data["timestamp"])
+        return message
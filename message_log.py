@@ -0,0 +1,578 @@
+"""Append-only, segmented message log of one room.
+
+A room's log is a directory of segments named after the sequence number of
+their first message:
+
+    00000000000000000001.log   one JSON record per line, oldest first
+    00000000000000000001.idx   sparse index, see below
+    00000000000000524289.log   ...
+
+A new segment is started once the current one reaches segment_bytes. Every
+INDEX_INTERVAL-th record of a segment has its byte position written to the
+segment's .idx file (an array of unsigned 64 bit integers), so finding a
+record takes one index lookup and at most INDEX_INTERVAL - 1 newline searches.
+
+Reads go through mmap and return the raw records. Only the records a page
+needs are copied out of the page cache, no Message objects are built for them.
+Opening a log reads the index files and scans only the records after the last
+index entry of each segment (at most INDEX_INTERVAL - 1), so a restart costs
+the same however many messages are stored. A record cut short by a crash is
+dropped.
+
+Appends are handed to a LogCommitter, which writes them in the background in
+batches; see there for when an append counts as done. A log that fails to
+write (or fsync) takes no more appends (LogUnwritable): the records after a
+lost one would get other sequence numbers in the log than in the room. It
+comes back on the next start, from what reached the disk.
+
+Once a segment is full it is never written again. With a Compressor, such
+segments are rewritten in the background as compressed blocks of
+block_messages records each:
+
+    00000000000000000001.blk   compressed blocks, their offsets, a trailer
+
+and the .log/.idx pair is deleted once the .blk is on disk. Reading a record
+of a compressed segment decompresses its block, the most recently read blocks
+are kept decompressed in a BlockCache. The segment being appended to, where
+the recent history is, is never compressed.
+"""
+import os
+import lzma
+import mmap
+import zlib
+import struct
+import logging
+import threading
+from array import array
+from collections import OrderedDict, deque
+from urllib.parse import quote
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+INDEX_INTERVAL = 64 # records per index entry
+SEGMENT_BYTES = 16 * 1024 * 1024
+
+# when the future returned for an append completes
+ENQUEUE = "enqueue" # right away, the record is written later (lost if the process dies first)
+WRITE = "write" # once the record is written to the file (lost if the machine dies before the OS writes it out)
+FSYNC = "fsync" # once the file is fsync()ed
+DURABILITY_MODES = (ENQUEUE, WRITE, FSYNC)
+
+DONE = Future() # for appends that are already as durable as they need to be
+DONE.set_result(None)
+
+
+# name: (id stored in the trailer, compress, decompress)
+CODECS = {
+    "zlib": (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+}
+DECOMPRESS = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+TRAILER = struct.Struct("!QQIB") # position of the block offsets, records, records per block, codec id
+
+
+def room_log_dir(history_dir, room_name):
+    """Directory of a room's log, named after the room so that it is found again after a restart."""
+    return os.path.join(history_dir, "room-" + quote(room_name, safe=""))
+
+
+def sync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LogUnwritable(Exception):
+    """Raised for an append to a log that failed to write, and by the write that failed."""
+
+    def __init__(self, directory, error):
+        super().__init__(f"The log in {directory} takes no more appends, a write failed: {error}")
+        self.error = error
+
+
+class Segment:
+
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        base = os.path.join(directory, f"{first_seq:020d}")
+        self.log_path = base + ".log"
+        self.index_path = base + ".idx"
+        self.index = array("Q") # index[k]: byte position of record first_seq + k * INDEX_INTERVAL
+        self.count = 0 # records in the segment
+        self.size = 0
+        self.map = None # mmap of the first map_size bytes
+        self.map_size = 0
+        self.log_file = None
+        self.index_file = None
+
+
+    @property
+    def last_seq(self):
+        return self.first_seq + self.count - 1
+
+
+    # opens an existing segment, recounting its records from the last index entry that is still valid
+    def recover(self):
+        self.size = os.path.getsize(self.log_path)
+        data = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            self.index.frombytes(data[:len(data) - len(data) % self.index.itemsize])
+        while self.index and self.index[-1] >= self.size:
+            self.index.pop()
+
+        position = self.index[-1] if self.index else 0
+        self.count = max(0, len(self.index) - 1) * INDEX_INTERVAL
+        if self.size:
+            with open(self.log_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                while (newline := m.find(b"\n", position)) >= 0:
+                    if self.count % INDEX_INTERVAL == 0 and len(self.index) == self.count // INDEX_INTERVAL:
+                        self.index.append(position)
+                    position = newline + 1
+                    self.count += 1
+        # the last entry may point at the incomplete record
+        del self.index[(self.count + INDEX_INTERVAL - 1) // INDEX_INTERVAL:]
+
+        if position < self.size:
+            logger.warning(f"Dropping {self.size - position} bytes of an incomplete record at the end of {self.log_path}")
+            os.truncate(self.log_path, position)
+            self.size = position
+        # normally the index is intact and this is all a restart costs
+        if self.index.tobytes() != data:
+            with open(self.index_path, "wb") as f:
+                f.write(self.index.tobytes())
+        return self
+
+
+    def open_for_append(self):
+        self.log_file = open(self.log_path, "ab")
+        self.index_file = open(self.index_path, "ab")
+        return self
+
+
+    # buffered, the record is readable once flush() returns
+    def append(self, record):
+        if self.count % INDEX_INTERVAL == 0:
+            self.index.append(self.size)
+            self.index_file.write(self.index[-1:].tobytes())
+        self.log_file.write(record)
+        self.count += 1
+        self.size += len(record)
+
+
+    def flush(self):
+        self.log_file.flush()
+        self.index_file.flush()
+
+
+    # the index is rebuilt from the log on recovery, so only the log itself needs to reach the disk
+    def sync(self):
+        os.fsync(self.log_file.fileno())
+
+
+    def close_for_append(self):
+        for f in (self.log_file, self.index_file):
+            if f:
+                f.close()
+        self.log_file = self.index_file = None
+
+
+    # byte position where record seq starts, seq may be one past the last record
+    def position(self, seq, view):
+        offset = seq - self.first_seq
+        if offset >= self.count:
+            return self.size
+        position = self.index[offset // INDEX_INTERVAL]
+        for _ in range(offset % INDEX_INTERVAL):
+            position = view.find(b"\n", position) + 1
+        return position
+
+
+    # an mmap covering at least the first size bytes, the log only grows so older maps stay valid
+    def mapping(self):
+        if self.map_size < self.size:
+            with open(self.log_path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.map_size = len(self.map)
+        return self.map
+
+
+    # called with the log locked, returns a function that reads records first..last without it
+    def reader(self, first, last):
+        view = self.mapping()
+        start = self.position(first, view)
+        end = self.position(last + 1, view)
+        return lambda: view[start:end].splitlines()
+
+
+    def remove(self):
+        for path in (self.log_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class CompressedSegment:
+    """A full segment rewritten as compressed blocks, read only."""
+
+    def __init__(self, path, cache):
+        self.path = path
+        self.first_seq = int(os.path.basename(path)[:-4])
+        self.cache = cache
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        position, self.count, self.block_messages, codec_id = TRAILER.unpack_from(self.map, len(self.map) - TRAILER.size)
+        self.decompress = DECOMPRESS[codec_id]
+        self.offsets = array("Q") # offsets[n]: where block n starts, the last entry is where the blocks end
+        self.offsets.frombytes(self.map[position:len(self.map) - TRAILER.size])
+
+
+    @property
+    def last_seq(self):
+        return self.first_seq + self.count - 1
+
+
+    @staticmethod
+    def write(path, records, codec, block_messages):
+        """Writes records (without newlines) as a compressed segment, atomically."""
+        codec_id, compress, _ = CODECS[codec]
+        offsets = array("Q", [0])
+        with open(path + ".tmp", "wb") as f:
+            for i in range(0, len(records), block_messages):
+                f.write(compress(b"\n".join(records[i:i + block_messages])))
+                offsets.append(f.tell())
+            f.write(offsets.tobytes())
+            f.write(TRAILER.pack(offsets[-1], len(records), block_messages, codec_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        # the rename has to be on disk before the uncompressed segment is deleted
+        sync_directory(os.path.dirname(path))
+
+
+    def block(self, n, cache=True):
+        key = (self.path, n)
+        records = self.cache.get(key)
+        if records is None:
+            records = self.decompress(self.map[self.offsets[n]:self.offsets[n + 1]]).split(b"\n")
+            if cache:
+                self.cache.put(key, records)
+        return records
+
+
+    def reader(self, first, last):
+        return lambda: self.read(first, last)
+
+
+    def read(self, first, last):
+        first_block = (first - self.first_seq) // self.block_messages
+        last_block = (last - self.first_seq) // self.block_messages
+        # a page touches one or two blocks, longer reads (building a search index) would only flush the cache
+        cache = last_block - first_block < 2
+        records = []
+        for n in range(first_block, last_block + 1):
+            records.extend(self.block(n, cache))
+        skip = first - self.first_seq - first_block * self.block_messages
+        return records[skip:skip + last - first + 1]
+
+
+class BlockCache:
+    """The most recently read blocks of compressed segments, decompressed, shared by all logs."""
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.blocks = OrderedDict() # (path, block number): records
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            records = self.blocks.get(key)
+            if records is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.blocks.move_to_end(key)
+            return records
+
+    def put(self, key, records):
+        with self.lock:
+            self.blocks[key] = records
+            self.blocks.move_to_end(key)
+            while len(self.blocks) > self.capacity:
+                self.blocks.popitem(last=False)
+
+
+class MessageLog:
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, committer=None, compressor=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.committer = committer
+        self.compressor = compressor
+        self.cache = compressor.cache if compressor else BlockCache()
+        self.new_segment = False # the directory changed since the last sync()
+        self.lock = threading.Lock()
+        self.error = None # LogUnwritable, once a write or sync failed
+        os.makedirs(directory, exist_ok=True)
+
+        names = os.listdir(directory)
+        for name in names:
+            if name.endswith(".tmp"): # a compression that did not finish
+                os.remove(os.path.join(directory, name))
+        compressed = {int(name[:-4]): CompressedSegment(os.path.join(directory, name), self.cache)
+                      for name in names if name.endswith(".blk")}
+        segments = dict(compressed)
+        for first_seq in (int(name[:-4]) for name in names if name.endswith(".log")):
+            segment = Segment(directory, first_seq)
+            if first_seq in compressed: # compressed, but not deleted yet
+                segment.remove()
+            else:
+                segments[first_seq] = segment.recover()
+        self.segments = [segments[first_seq] for first_seq in sorted(segments)]
+        if not self.segments or isinstance(self.segments[-1], CompressedSegment):
+            self.segments.append(Segment(directory, self.segments[-1].last_seq + 1 if self.segments else 1))
+        self.segments[-1].open_for_append()
+        self.written_seq = self.segments[-1].last_seq
+
+        if compressor:
+            for segment in self.segments[:-1]:
+                if isinstance(segment, Segment):
+                    compressor.submit(self, segment)
+
+
+    # of the last record that has been written, and can be read; a write that failed half way does not count
+    @property
+    def last_seq(self):
+        return self.written_seq
+
+
+    def append(self, record):
+        """Appends one line of encoded JSON, it gets the next sequence number.
+
+        Returns a future that completes once the record is as durable as the
+        committer's mode asks for. Without a committer the record is written
+        right away. Raises LogUnwritable, taking nothing, once a write failed.
+        """
+        if self.error:
+            raise self.error
+        if self.committer:
+            return self.committer.submit(self, record)
+        self.write([record])
+        return DONE
+
+
+    def write(self, records):
+        with self.lock:
+            if self.error:
+                raise self.error
+            try:
+                active = self.segments[-1]
+                for record in records:
+                    if active.size >= self.segment_bytes:
+                        # a full segment is never written again, get it to the disk before letting go of it
+                        active.flush()
+                        active.sync()
+                        active.close_for_append()
+                        if self.compressor:
+                            self.compressor.submit(self, active)
+                        active = Segment(self.directory, active.last_seq + 1).open_for_append()
+                        self.segments.append(active)
+                        self.new_segment = True
+                    active.append(record)
+                active.flush()
+            except Exception as e:
+                raise self.fail(e)
+            self.written_seq = active.last_seq
+
+
+    def sync(self):
+        with self.lock:
+            if self.error:
+                raise self.error
+            try:
+                self.segments[-1].sync()
+                if self.new_segment:
+                    sync_directory(self.directory)
+                    self.new_segment = False
+            except Exception as e:
+                raise self.fail(e)
+
+
+    # called with the lock held, the log takes nothing from now on
+    def fail(self, e):
+        self.error = LogUnwritable(self.directory, e)
+        return self.error
+
+
+    def read(self, first, last):
+        """Returns the records first..last (inclusive), oldest first, without their newlines."""
+        records = []
+        if first > last:
+            return records
+        with self.lock:
+            readers = [s.reader(max(first, s.first_seq), min(last, s.last_seq))
+                       for s in self.segments if s.count and s.first_seq <= last and s.last_seq >= first]
+
+        for read in readers:
+            records.extend(read())
+        return records
+
+
+    # swaps a full segment for its compressed copy, readers still holding the old one keep their mmap
+    def replace(self, segment, compressed):
+        with self.lock:
+            self.segments[self.segments.index(segment)] = compressed
+        try:
+            segment.remove()
+        except OSError as e:
+            logger.warning(f"Could not remove {segment.log_path} after compressing it: {e}")
+
+
+    def close(self):
+        with self.lock:
+            self.segments[-1].close_for_append()
+
+
+class Compressor:
+    """Rewrites full segments as compressed blocks, from one background thread for all logs."""
+
+    def __init__(self, codec="zlib", block_messages=256, cache_blocks=64):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown compression codec: {codec}")
+        self.codec = codec
+        self.block_messages = block_messages
+        self.cache = BlockCache(cache_blocks)
+        self.queue = deque() # (log, segment)
+        self.cond = threading.Condition()
+
+
+    def start(self):
+        threading.Thread(target=self.run, name="log-compressor", daemon=True).start()
+        return self
+
+
+    def submit(self, log, segment):
+        with self.cond:
+            self.queue.append((log, segment))
+            self.cond.notify()
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.queue)
+                log, segment = self.queue.popleft()
+            try:
+                self.compress(log, segment)
+            except OSError as e:
+                logger.error(f"Could not compress {segment.log_path}: {e}")
+
+
+    def compress(self, log, segment):
+        with open(segment.log_path, "rb") as f:
+            records = f.read(segment.size).splitlines()
+        path = os.path.join(log.directory, f"{segment.first_seq:020d}.blk")
+        CompressedSegment.write(path, records, self.codec, self.block_messages)
+        log.replace(segment, CompressedSegment(path, self.cache))
+        logger.debug(f"Compressed {segment.log_path}: {segment.size} -> {os.path.getsize(path)} bytes")
+
+
+class LogCommitter:
+    """Writes the appends of every room log from one background thread.
+
+    Appends are queued and written in batches: a batch is taken once
+    batch_size records are waiting or interval seconds after its first record
+    arrived (right away with interval 0, the batch then holds whatever came in
+    during the previous commit), so one write() per log and, in FSYNC mode, one
+    fsync() per log cover all of it (group commit). The future of an
+    append completes according to durability, see DURABILITY_MODES.
+    """
+
+    def __init__(self, durability=WRITE, interval=0.0, batch_size=1000):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.durability = durability
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.pending = [] # (log, record, future)
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # counters
+        self.batches = 0
+        self.records = 0
+
+
+    def start(self):
+        threading.Thread(target=self.run, name="log-committer", daemon=True).start()
+        return self
+
+
+    def submit(self, log, record):
+        future = DONE if self.durability == ENQUEUE else Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Log committer is closed")
+            self.pending.append((log, record, future))
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.cond.notify()
+        return future
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                # give the batch a moment to fill up
+                self.cond.wait_for(lambda: len(self.pending) >= self.batch_size or self.closed, timeout=self.interval)
+                batch, self.pending = self.pending, []
+                closed = self.closed
+
+            if batch:
+                self.commit(batch)
+            if closed:
+                break
+
+
+    # a log that fails only fails the futures of its own records, whatever it raised
+    def commit(self, batch):
+        by_log = {}
+        for log, record, future in batch:
+            records, futures = by_log.setdefault(log, ([], []))
+            records.append(record)
+            futures.append(future)
+
+        errors = {}
+        for log, (records, _) in by_log.items():
+            try:
+                log.write(records)
+                if self.durability == FSYNC:
+                    log.sync()
+            except Exception as e:
+                logger.error(f"Could not commit {len(records)} log records: {e}")
+                errors[log] = e
+
+        self.batches += 1
+        self.records += len(batch)
+        for log, (_, futures) in by_log.items():
+            error = errors.get(log)
+            for future in futures:
+                if future is DONE:
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+
+    # writes out what is queued and stops the thread
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
@@ -0,0 +1,296 @@
+import socket
+import asyncio
+import logging
+import threading
+from collections import deque
+import framing
+
+logger = logging.getLogger(__name__)
+
+# what to do when a frame arrives for a full queue
+DROP_OLDEST = "drop_oldest" # make room by dropping the oldest queued frame
+DISCONNECT = "disconnect" # give up on the client and close its connection
+MARK_LAGGING = "mark_lagging" # drop new frames until the queue drains, then tell the client it lagged
+POLICIES = (DROP_OLDEST, DISCONNECT, MARK_LAGGING)
+
+# most frames handed to one sendmsg() call, stays well below IOV_MAX (1024 on Linux)
+MAX_BATCH = 256
+
+# seconds finish() leaves a client to read what is still queued before its connection is closed anyway
+FINISH_TIMEOUT = 10.0
+
+
+class KeptFrame(bytes):
+    """A frame no policy drops, for what the frames after it depend on (the DEFINE frames of protocol v2).
+
+    It is always queued, past the bounds if it has to be. There are few of them,
+    one per room and user a connection is told about.
+    """
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one connection.
+
+    Producers only ever append to the queue, a dedicated writer thread does the
+    (possibly blocking) socket writes. This way a client with a full TCP window
+    only delays itself and never the thread that fans a message out to a room.
+
+    Frames are immutable bytes and may be shared by many queues. Whatever has
+    piled up since the last write goes out in a single sendmsg() call. The
+    queue is full once it holds maxsize frames or max_bytes bytes (0 for no
+    byte limit), whichever comes first. on_disconnect is called when the
+    DISCONNECT policy closes the connection. A KeptFrame is never dropped.
+    """
+
+    def __init__(self, sock, maxsize=1000, policy=DROP_OLDEST, name=None, lagged_notice=None, max_bytes=0,
+                 on_disconnect=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound queue policy: {policy}")
+        self.sock = sock
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.name = name
+        self.lagged_notice = lagged_notice # frame sent once a lagging client has caught up
+        self.on_disconnect = on_disconnect
+
+        self.frames = deque()
+        self.bytes = 0 # in frames
+        self.cond = threading.Condition()
+        self.closed = False
+        self.finishing = False # close once the queue is empty, see finish()
+        self.lagging = False
+
+        # counters
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+
+    def start(self):
+        threading.Thread(target=self.run, name=f"writer-{self.name}", daemon=True).start()
+        return self
+
+
+    def put(self, frame):
+        disconnect = False
+        with self.cond:
+            if self.closed:
+                return False
+
+            kept = type(frame) is KeptFrame
+            if self.lagging and not kept:
+                self.dropped += 1
+                return False
+
+            if self.is_full(frame):
+                if self.policy == DROP_OLDEST:
+                    while self.is_full(frame) and self.drop_oldest():
+                        pass
+
+                elif self.policy == MARK_LAGGING:
+                    if not kept:
+                        logger.warning(f"Outbound queue of {self.name} is full, marking client as lagging")
+                        self.lagging = True
+                        self.dropped += 1
+                        return False
+
+                else:# DISCONNECT
+                    logger.warning(f"Outbound queue of {self.name} is full, disconnecting client")
+                    self.dropped += len(self.frames) + 1
+                    self.frames.clear()
+                    self.bytes = 0
+                    disconnect = True
+
+            if not disconnect:
+                self.frames.append(frame)
+                self.bytes += len(frame)
+                self.enqueued += 1
+                if len(self.frames) > self.max_depth:
+                    self.max_depth = len(self.frames)
+                self.wake()
+
+        if disconnect:
+            self.close()
+            if self.on_disconnect:
+                self.on_disconnect()
+            return False
+        return True
+
+
+    # whether frame does not fit in, called with the lock held
+    def is_full(self, frame):
+        return len(self.frames) >= self.maxsize or (self.max_bytes and self.bytes + len(frame) > self.max_bytes)
+
+
+    # drops the oldest frame that is not a KeptFrame, returns False if there is none, called with the lock held
+    def drop_oldest(self):
+        for i, frame in enumerate(self.frames):
+            if type(frame) is not KeptFrame:
+                del self.frames[i]
+                self.bytes -= len(frame)
+                self.dropped += 1
+                return True
+        return False
+
+
+    # wakes up the writer, called with the lock held
+    def wake(self):
+        self.cond.notify()
+
+
+    # pops up to MAX_BATCH frames to write, called once the queue is known to be non-empty
+    def take(self):
+        with self.cond:
+            frames = self.frames
+            if len(frames) <= MAX_BATCH:
+                batch = list(frames)
+                frames.clear()
+                self.bytes = 0
+            else:
+                batch = [frames.popleft() for _ in range(MAX_BATCH)]
+                self.bytes -= sum(len(frame) for frame in batch)
+
+            if self.lagging and not frames:
+                self.lagging = False
+                if self.lagged_notice:
+                    frames.append(self.lagged_notice)
+                    self.bytes += len(self.lagged_notice)
+            return batch
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.frames and not self.closed and not self.finishing:
+                    self.cond.wait()
+                if self.closed or not self.frames: # closed, or finished with everything written
+                    break
+
+            batch = self.take()
+            try:
+                framing.send_buffers(self.sock, batch)
+                self.sent += len(batch)
+            except OSError as e:
+                logger.debug(f"Writer of {self.name} stopped: {e}")
+                break
+        self.close()
+
+
+    def finish(self):
+        """Closes the connection once the frames queued so far are written, or after FINISH_TIMEOUT."""
+        with self.cond:
+            self.finishing = True
+            self.wake()
+        timer = threading.Timer(FINISH_TIMEOUT, self.close)
+        timer.daemon = True
+        timer.start()
+
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.frames.clear()
+            self.bytes = 0
+            self.wake()
+
+        try:
+            # unblocks a writer that is stuck in sendall()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.frames),
+                "bytes": self.bytes,
+                "max_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "lagging": self.lagging,
+                "closed": self.closed,
+            }
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    """OutboundQueue drained by an asyncio task that respects the transport's flow control.
+
+    Frames may also be put from other threads (a cluster node fans out on
+    the threads reading its links, see cluster.py), the task and the transport are only touched on the loop.
+    Wakeups from other threads are coalesced: while one is on its way to the
+    loop, the frames put meanwhile do not schedule another.
+    """
+
+    def __init__(self, sock, *args, **kwargs):
+        super().__init__(sock, *args, **kwargs)
+        self.wakeup = asyncio.Event()
+        self.wakeup_pending = False # a wakeup was handed to the loop and has not run yet
+        self.loop = None
+
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = self.loop.create_task(self.run_async())
+        return self
+
+
+    def on_loop(self, callback):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self.loop is None or running is self.loop:
+            callback()
+        else:
+            self.loop.call_soon_threadsafe(callback)
+
+
+    def wake(self):
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.on_loop(self.set_wakeup)
+
+
+    def set_wakeup(self):
+        self.wakeup_pending = False
+        self.wakeup.set()
+
+
+    async def run_async(self):
+        writer = self.sock.writer
+        while True:
+            # cleared before looking at the queue, a frame put after the look sets it again
+            self.wakeup.clear()
+            while not self.frames and not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+            if self.closed:
+                break
+
+            batch = self.take()
+            writer.writelines(batch)
+            self.sent += len(batch)
+            try:
+                await writer.drain()
+            except ConnectionError as e:
+                logger.debug(f"Writer of {self.name} stopped: {e}")
+                self.close()
+                break
+
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.frames.clear()
+            self.bytes = 0
+            self.wake()
+        self.on_loop(self.sock.close)
@@ -0,0 +1,199 @@
+"""Pipelined request/response mode.
+
+A client may prefix any request it sends after LOGIN with a request ID:
+
+    #17|SEND_MESSAGE|Broadcast|hello
+
+Every reply frame to that request then carries the same prefix ("#17|SUCCESSFULLY
+SENT MESSAGE!"), so the client can keep many requests in flight on one connection
+and match replies as they arrive, in whatever order the server finishes them.
+Requests without the prefix keep the lockstep behaviour. A connection should tag
+either all of its requests or none of them.
+
+Only the replies may come out of order. The requests of one connection are
+handled one after the other, in the order they were sent (see SerialQueue), so
+two messages typed in quick succession are posted in that order.
+"""
+import logging
+import itertools
+import threading
+import queue
+from collections import deque
+import framing
+
+logger = logging.getLogger(__name__)
+
+TAG = "#"
+
+
+def split_request_id(msg):
+    """Returns (request_id, rest of the request), request_id is None for untagged requests."""
+    if not msg.startswith(TAG):
+        return None, msg
+    request_id, _, rest = msg.partition("|")
+    return request_id[1:], rest
+
+
+class Reply:
+    """Stands in for the client socket while a tagged request is handled.
+
+    Each frame written through it gets the request ID prefixed. On the threaded
+    engine the frames go into outbound, the connection's own queue of replies
+    (an OutboundQueue with the DISCONNECT policy), so a client that does not
+    read its replies holds up its writer thread and not the shared pool the
+    requests run on. Without one they are written to sock right away, which on
+    the asyncio engine never blocks.
+    """
+
+    def __init__(self, sock, request_id, outbound=None):
+        self.sock = sock
+        self.prefix = f"{TAG}{request_id}|".encode()
+        self.outbound = outbound
+
+    def send_frame(self, payload):
+        if self.outbound is None:
+            framing.send_frame(self.sock, self.prefix + payload)
+        elif not self.outbound.put(framing.encode_frame(self.prefix + payload)):
+            raise ConnectionError(f"Replies to {self.outbound.name} are no longer sent, the connection was closed")
+
+    def close(self):
+        self.sock.close()
+
+
+class SerialQueue:
+    """Runs the tagged requests of one connection on a shared pool, one at a time and in the order they came.
+
+    At most one task of the pool drains the queue of a connection, so requests of
+    different connections still run in parallel. It holds at most maxsize
+    requests (0 for no bound): submit() waits for room, so the thread reading
+    the connection stops reading while the client is that far ahead.
+    """
+
+    def __init__(self, pool, maxsize=0):
+        self.pool = pool
+        self.maxsize = maxsize
+        self.calls = deque()
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        self.draining = False
+
+
+    def submit(self, fn, *args):
+        with self.lock:
+            while self.maxsize and len(self.calls) >= self.maxsize:
+                self.room.wait()
+            self.calls.append((fn, args))
+            if self.draining:
+                return
+            self.draining = True
+        self.pool.submit(self.drain)
+
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.calls:
+                    self.draining = False
+                    return
+                fn, args = self.calls.popleft()
+                self.room.notify()
+            fn(*args)
+
+
+class PendingReply:
+    """Reply frames of one in-flight request, in the order the server sent them."""
+
+    def __init__(self, channel, request_id):
+        self.channel = channel
+        self.request_id = request_id
+        self.frames = queue.SimpleQueue()
+
+    def get(self, timeout=None):
+        frame = self.frames.get(timeout=timeout)
+        if frame is None:
+            raise ConnectionError("Connection to the server was closed")
+        return frame
+
+    def text(self, timeout=None):
+        return self.get(timeout).decode()
+
+    # stop collecting frames for this request
+    def done(self):
+        self.channel.forget(self.request_id)
+
+
+class LockstepReply:
+    """Same interface as PendingReply for a connection that is not pipelined."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def get(self, timeout=None):
+        return bytes(framing.recv_frame(self.sock))
+
+    def text(self, timeout=None):
+        return framing.recv_text(self.sock)
+
+    def done(self):
+        pass
+
+
+class PipelinedChannel:
+    """Client side of the pipelined mode.
+
+    request() tags the request, sends it and returns right away, a reader thread
+    hands the replies to the matching PendingReply as they come in.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.ids = itertools.count(1)
+        self.pending = {} # request_id: PendingReply
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        threading.Thread(target=self.run, name="pipelined-reader", daemon=True).start()
+
+
+    def request(self, msg, expect_reply=True):
+        """Sends msg, returns a PendingReply (call done() on it when finished) or None."""
+        request_id = str(next(self.ids))
+        pending = None
+        if expect_reply:
+            pending = PendingReply(self, request_id)
+            with self.lock:
+                self.pending[request_id] = pending
+
+        with self.write_lock:
+            framing.send_frame(self.sock, f"{TAG}{request_id}|{msg}".encode())
+        return pending
+
+
+    def run(self):
+        try:
+            while True:
+                payload = bytes(framing.recv_frame(self.sock))
+                request_id, _, body = payload.partition(b"|")
+                if not request_id.startswith(TAG.encode()):
+                    logger.debug(f"Dropping untagged frame: {payload[:64]}")
+                    continue
+
+                with self.lock:
+                    pending = self.pending.get(request_id[1:].decode())
+                if pending:
+                    pending.frames.put(body)
+
+        except (EOFError, OSError) as e:
+            logger.debug(f"Pipelined reader stopped: {e}")
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for reply in pending.values():
+                reply.frames.put(None)
+
+
+    def forget(self, request_id):
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,129 @@
+"""Presence: who is online, told to the users who share a room with them.
+
+A user is online from LOGIN to LOGOUT. Users who share a room other than
+Broadcast (which everybody is in) are contacts and see each other's presence:
+right after LISTEN a user gets a PRESENCE event with the contacts that are
+online, after that only what changed.
+
+Changes are not sent as they happen. They are noted and a background thread
+sends them every `window` seconds, one event per contact with everything that
+changed for them in the window. A user who logs out and back in within the
+window (a reconnect) has not changed at all and nobody is told, so a storm of
+reconnects costs little more than the snapshots of the new LISTEN connections,
+and every other change costs one entry per contact instead of an event per
+contact per change.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Presence:
+    """The online users and the changes to report.
+
+    contacts(username) returns the users who see username's presence,
+    deliver(recipient, online, offline) sends one PRESENCE event (a list of
+    usernames that came online and one of those that went offline) and returns
+    False if the recipient has no LISTEN connection to send it to.
+    """
+
+    def __init__(self, contacts, deliver, window=0.25):
+        self.contacts = contacts
+        self.deliver = deliver
+        self.window = window
+
+        self.online = set()
+        self.changed = {} # username: whether the user was online when their contacts were last told
+        self.lock = threading.Lock() # around online and changed
+        self.flush_lock = threading.Lock() # held while events go out, keeps a snapshot and a delta in order
+        self.cond = threading.Condition(self.lock)
+        self.closed = False
+
+        # counters
+        self.changes = 0 # logins and logouts
+        self.reported = 0 # of them still changes at the end of their window
+        self.events = 0
+
+
+    def start(self):
+        threading.Thread(target=self.run, name="presence", daemon=True).start()
+        return self
+
+
+    def set_online(self, username):
+        self.set(username, True)
+
+
+    def set_offline(self, username):
+        self.set(username, False)
+
+
+    def set(self, username, online):
+        with self.cond:
+            was = username in self.online
+            if was == online:
+                return
+            if online:
+                self.online.add(username)
+            else:
+                self.online.discard(username)
+            self.changes += 1
+            self.changed.setdefault(username, was)
+            if len(self.changed) == 1:
+                self.cond.notify()
+
+
+    # the first event of a LISTEN connection, the contacts that are online right now
+    def snapshot(self, username):
+        with self.flush_lock:
+            online = sorted(contact for contact in self.contacts(username) if contact in self.online)
+            if online and self.deliver(username, online, []):
+                self.events += 1
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.changed or self.closed)
+                # the window starts with its first change
+                self.cond.wait_for(lambda: self.closed, timeout=self.window)
+                if self.closed:
+                    break
+            self.flush()
+
+
+    # sends what changed since the last flush, one event per contact
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                changed, self.changed = self.changed, {}
+                came = [username for username, was in changed.items() if not was and username in self.online]
+                went = [username for username, was in changed.items() if was and username not in self.online]
+                self.reported += len(came) + len(went)
+
+            events = {} # recipient: (came online, went offline)
+            for state, usernames in ((0, came), (1, went)):
+                for username in usernames:
+                    for contact in self.contacts(username):
+                        if contact in self.online:
+                            events.setdefault(contact, ([], []))[state].append(username)
+
+            for recipient, (online, offline) in events.items():
+                try:
+                    if self.deliver(recipient, online, offline):
+                        self.events += 1
+                except Exception as e:
+                    logger.error(f"Could not send presence to {recipient}: {e}")
+
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+    def stats(self):
+        with self.lock:
+            return {"online": len(self.online), "changes": self.changes, "reported": self.reported,
+                    "events": self.events}
@@ -0,0 +1,246 @@
+"""Compact binary protocol, version 2.
+
+A client opts in by sending the text frame "HELLO|2" before REGISTER/LOGIN/LISTEN.
+The server answers "HELLO|2" and from then on every frame on that connection is
+binary; a server that does not know the version answers "HELLO|1" and the
+connection keeps using the text protocol. Clients that never send HELLO are
+not affected.
+
+Frames still use the length prefix of framing.py. The payload starts with a
+one byte opcode followed by the fields of that opcode: ids are unsigned 32 bit
+integers, strings that are not the last field carry a 16 bit length, and the
+last string field simply runs to the end of the frame.
+
+Rooms and users are referred to by integer ids. The first time the server
+mentions an id on a connection it sends a DEFINE_ROOM / DEFINE_USER frame with
+the name first, clients keep the mapping for the rest of the connection. The
+DEFINE frames are never dropped from a LISTEN connection's outbound queue, so
+no UPDATE arrives for an id the client was not told about. A request with a
+room id the server does not know is answered "Access Denied!", like a text
+request naming an unknown room, and unknown user ids are skipped.
+
+    client -> server                      server -> client
+    REGISTER          str16 user, password   REPLY        text
+    LOGIN             str16 user, password   ROOMS        id...
+    LISTEN            user                   USERS        id...
+    SEND_ROOMS        [unread]               UPDATE       room id, author id, seq, text
+    SELECT_ROOM       room id[, since]       DEFINE_ROOM  id, name
+    SEND_MESSAGE      room id, text          DEFINE_USER  id, name
+    CREATE_ROOM       name                   UNREAD       (room id, count)...
+    ADD_PARTICIPANTS  room id, user id...
+    LOGOUT
+    HISTORY           room id, before
+    SEARCH            room id, before, query
+    READ              room id, seq           PRESENCE     count, user id...
+
+PRESENCE goes to the LISTEN connection, of its user ids the first count came
+online and the rest went offline (see presence.py).
+
+SEND_ROOMS followed by a byte 1 answers with UNREAD instead of ROOMS, the
+number of unread messages of each of the user's rooms.
+
+ADD_PARTICIPANTS without user ids answers with the USERS that can still be
+added, with user ids it adds them and answers with a REPLY.
+
+Pages of room history (after SELECT_ROOM, or for HISTORY) and SEARCH results
+are REPLY frames holding the same JSON document as on the text protocol.
+SEARCH with room id ALL_ROOMS searches every room of the user, before 0 asks
+for the newest matches.
+"""
+import struct
+import threading
+import framing
+from outbound import KeptFrame
+
+VERSION = 2
+HELLO = "HELLO"
+
+# client -> server
+REGISTER = 1
+LOGIN = 2
+LISTEN = 3
+SEND_ROOMS = 4
+SELECT_ROOM = 5
+SEND_MESSAGE = 6
+CREATE_ROOM = 7
+ADD_PARTICIPANTS = 8
+LOGOUT = 9
+HISTORY = 10
+SEARCH = 11
+READ = 12
+
+ALL_ROOMS = 0xFFFFFFFF # room id of a SEARCH over every room
+
+# server -> client
+REPLY = 0x80
+ROOMS = 0x81
+USERS = 0x82
+UPDATE = 0x83
+DEFINE_ROOM = 0x84
+DEFINE_USER = 0x85
+UNREAD = 0x86
+PRESENCE = 0x87
+
+ACTIONS = {
+    REGISTER: "REGISTER",
+    LOGIN: "LOGIN",
+    LISTEN: "LISTEN",
+    SEND_ROOMS: "SEND_ROOMS",
+    SELECT_ROOM: "SELECT_ROOM",
+    SEND_MESSAGE: "SEND_MESSAGE",
+    CREATE_ROOM: "CREATE_ROOM",
+    ADD_PARTICIPANTS: "ADD_PARTICIPANTS",
+    LOGOUT: "LOGOUT",
+    HISTORY: "HISTORY",
+    SEARCH: "SEARCH",
+    READ: "READ",
+}
+
+OP = struct.Struct("!B")
+OP_ID = struct.Struct("!BI")
+OP_ID_ID = struct.Struct("!BII")
+OP_ID_ID_ID = struct.Struct("!BIII")
+OP_LEN = struct.Struct("!BH")
+ID = struct.Struct("!I")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+# ENCODING
+
+def encode_credentials(opcode, username, password):
+    username = username.encode()
+    return OP_LEN.pack(opcode, len(username)) + username + password.encode()
+
+
+def encode_op(opcode):
+    return OP.pack(opcode)
+
+
+def encode_op_text(opcode, text):
+    return OP.pack(opcode) + text.encode()
+
+
+def encode_op_id(opcode, id, text=""):
+    return OP_ID.pack(opcode, id) + text.encode()
+
+
+def encode_op_ids(opcode, ids, first=None):
+    head = OP.pack(opcode) if first is None else OP_ID.pack(opcode, first)
+    return head + struct.pack(f"!{len(ids)}I", *ids)
+
+
+def encode_update(room_id, author_id, seq, text):
+    return OP_ID_ID_ID.pack(UPDATE, room_id, author_id, seq) + text.encode()
+
+
+# DECODING
+
+def decode_request(payload):
+    """Splits a client request into (opcode, args), ids stay integers."""
+    if not payload:
+        raise ProtocolError("Empty frame")
+    parse = REQUEST_PARSERS.get(payload[0])
+    if parse is None:
+        raise ProtocolError(f"Unknown opcode {payload[0]}")
+    return payload[0], parse(bytes(payload))
+
+
+def parse_credentials(payload):
+    end = OP_LEN.size + OP_LEN.unpack_from(payload)[1]
+    return payload[OP_LEN.size:end].decode(), payload[end:].decode()
+
+
+def parse_room_and_ids(payload):
+    return OP_ID.unpack_from(payload)[1], *decode_ids(payload, OP_ID.size)
+
+
+# one parser per request opcode, a dict lookup is cheaper than a chain of comparisons
+REQUEST_PARSERS = {
+    REGISTER: parse_credentials,
+    LOGIN: parse_credentials,
+    LISTEN: lambda payload: (payload[1:].decode(),),
+    CREATE_ROOM: lambda payload: (payload[1:].decode(),),
+    SEND_ROOMS: lambda payload: ("unread",) if payload[1:2] == b"\x01" else (),
+    LOGOUT: lambda payload: (),
+    SELECT_ROOM: parse_room_and_ids,
+    SEND_MESSAGE: lambda payload: (OP_ID.unpack_from(payload)[1], payload[OP_ID.size:].decode()),
+    ADD_PARTICIPANTS: parse_room_and_ids,
+    HISTORY: lambda payload: OP_ID_ID.unpack_from(payload)[1:],
+    SEARCH: lambda payload: (*OP_ID_ID.unpack_from(payload)[1:], payload[OP_ID_ID.size:].decode()),
+    READ: lambda payload: OP_ID_ID.unpack_from(payload)[1:],
+}
+
+
+def decode_ids(payload, offset):
+    count = (len(payload) - offset) // ID.size
+    return struct.unpack_from(f"!{count}I", payload, offset)
+
+
+def decode_server_frame(payload):
+    """Splits a server frame into (opcode, args), the counterpart of the encoders above for clients."""
+    opcode = payload[0]
+    if opcode == UPDATE:
+        _, room_id, author_id, seq = OP_ID_ID_ID.unpack_from(payload)
+        return opcode, (room_id, author_id, seq, payload[OP_ID_ID_ID.size:].decode())
+    if opcode == REPLY:
+        return opcode, (payload[1:].decode(),)
+    if opcode in (ROOMS, USERS):
+        return opcode, decode_ids(payload, 1)
+    if opcode == UNREAD:
+        ids = decode_ids(payload, 1)
+        return opcode, tuple(zip(ids[::2], ids[1::2]))
+    if opcode == PRESENCE:
+        count = OP_ID.unpack_from(payload)[1]
+        ids = decode_ids(payload, OP_ID.size)
+        return opcode, (ids[:count], ids[count:])
+    if opcode in (DEFINE_ROOM, DEFINE_USER):
+        return opcode, (OP_ID.unpack_from(payload)[1], payload[OP_ID.size:].decode())
+    raise ProtocolError(f"Unknown opcode {opcode}")
+
+
+class BinarySocket:
+    """A connection that negotiated protocol v2.
+
+    Handed to the request handlers in place of the socket; text replies written
+    through it go out as REPLY frames. It also remembers which room and user
+    ids the client has already been told about.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.known_rooms = set()
+        self.known_users = set()
+        self.lock = threading.Lock() # held around definitions() and queueing the frame that needs them
+
+    def send_frame(self, payload):
+        framing.send_frame(self.sock, OP.pack(REPLY) + payload)
+
+    def send_binary(self, payload):
+        framing.send_frame(self.sock, payload)
+
+    # returns the DEFINE frames (encoded, ready to queue) for ids the client has not seen yet; an id
+    # counts as known from here on, so the frames are KeptFrames, which no outbound queue drops
+    def definitions(self, rooms=(), users=()):
+        frames = []
+        for room_id, name in rooms:
+            if room_id not in self.known_rooms:
+                self.known_rooms.add(room_id)
+                frames.append(KeptFrame(framing.encode_frame(encode_op_id(DEFINE_ROOM, room_id, name))))
+        for user_id, name in users:
+            if user_id not in self.known_users:
+                self.known_users.add(user_id)
+                frames.append(KeptFrame(framing.encode_frame(encode_op_id(DEFINE_USER, user_id, name))))
+        return frames
+
+    # passthrough so the connection can still be used as a plain socket
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,159 @@
+"""Rate limits on SEND_MESSAGE, per user and per room.
+
+A message costs the server one UPDATE per participant of its room, so one
+chatty client in a large room (Broadcast above all) costs everybody. Every
+SEND_MESSAGE therefore takes a token from the author's bucket and one from the
+room's before it is numbered and fanned out; when either is empty the message
+is refused with
+
+    RATE_LIMITED|{"scope": "user" or "room", "room": name, "retry_after": seconds}
+
+and nothing else happens. A bucket holds up to `burst` tokens and fills up at
+`rate` tokens per second, a rate of 0 is no limit. Users share one limit, rooms
+have the limit of their class: Broadcast, large rooms (large_room_size
+participants or more) and the other rooms.
+
+The buckets of a cluster are those of the node the request came in on: a
+user's limit holds as it is, a room takes its limit from each node (see
+cluster.py).
+"""
+import time
+import threading
+
+USER = "user"
+ROOM = "room"
+
+# room classes
+BROADCAST = "broadcast"
+LARGE = "large"
+SMALL = "small"
+ROOM_CLASSES = (BROADCAST, LARGE, SMALL)
+
+
+class RateLimited(Exception):
+    """Raised instead of posting a message while the author's or the room's bucket is empty."""
+
+    def __init__(self, scope, room_name, retry_after):
+        super().__init__(f"{scope} rate limit reached in {room_name}")
+        self.scope = scope
+        self.room_name = room_name
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Up to burst tokens, refilled at rate tokens per second.
+
+    take() is a few float operations on the bucket's own slots under its lock:
+    no dict, list or object is made for it, whatever the number of buckets.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp", "lock")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+        self.lock = threading.Lock()
+
+
+    # takes a token, returns 0.0 if there was one, else the seconds until there is
+    def take(self, now):
+        with self.lock:
+            tokens = self.tokens + (now - self.stamp) * self.rate
+            if tokens > self.burst:
+                tokens = self.burst
+            self.stamp = now
+            if tokens >= 1.0:
+                self.tokens = tokens - 1.0
+                return 0.0
+            self.tokens = tokens
+            return (1.0 - tokens) / self.rate
+
+
+    # returns a token taken for a message that was refused after all
+    def give_back(self):
+        with self.lock:
+            self.tokens = min(self.tokens + 1.0, self.burst)
+
+
+    def set_limit(self, rate, burst):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+
+class RateLimits:
+    """The buckets of the users and the rooms, and the counters of the messages they refused.
+
+    user_limit and every entry of room_limits (room class: limit) are a
+    (rate, burst) pair. Buckets are made on a user's or a room's first message
+    and kept, a room's is changed in place when the room changes class.
+    """
+
+    def __init__(self, user_limit, room_limits, large_room_size=100):
+        self.user_rate, self.user_burst = user_limit
+        self.room_limits = dict(room_limits)
+        self.large_room_size = large_room_size
+        self.users = {} # username: TokenBucket
+        self.rooms = {} # room name: TokenBucket
+        self.lock = threading.Lock() # around making buckets and the counters
+
+        # counters
+        self.limited = {USER: 0, ROOM: 0}
+        self.limited_by_class = dict.fromkeys(ROOM_CLASSES, 0)
+
+
+    def room_class(self, room):
+        if room.name == "Broadcast":
+            return BROADCAST
+        if len(room.participants) >= self.large_room_size:
+            return LARGE
+        return SMALL
+
+
+    # takes a token from the author's bucket and one from the room's, raises RateLimited if either is empty
+    def take(self, username, room):
+        now = time.monotonic()
+        user_bucket = None
+        if self.user_rate:
+            user_bucket = self.users.get(username) or self.add_bucket(self.users, username, self.user_rate, self.user_burst, now)
+            wait = user_bucket.take(now)
+            if wait:
+                self.refuse(USER, None)
+                raise RateLimited(USER, room.name, wait)
+
+        room_class = self.room_class(room)
+        rate, burst = self.room_limits[room_class]
+        if rate:
+            room_bucket = self.rooms.get(room.name) or self.add_bucket(self.rooms, room.name, rate, burst, now)
+            if room_bucket.rate != rate or room_bucket.burst != burst:
+                room_bucket.set_limit(rate, burst)
+            wait = room_bucket.take(now)
+            if wait:
+                if user_bucket:
+                    user_bucket.give_back() # the message is not sent, it does not count against the author
+                self.refuse(ROOM, room_class)
+                raise RateLimited(ROOM, room.name, wait)
+
+
+    # stamped with the now of the take() it is made for, a later one would start the bucket short of burst
+    def add_bucket(self, buckets, key, rate, burst, now):
+        with self.lock:
+            if key not in buckets:
+                buckets[key] = TokenBucket(rate, burst, now)
+            return buckets[key]
+
+
+    def refuse(self, scope, room_class):
+        with self.lock:
+            self.limited[scope] += 1
+            if room_class:
+                self.limited_by_class[room_class] += 1
+
+
+    def stats(self):
+        with self.lock:
+            return {"users": len(self.users), "rooms": len(self.rooms), "limited": dict(self.limited),
+                    "limited_by_class": dict(self.limited_by_class)}
@@ -0,0 +1,607 @@
+"""State kept in step between the nodes of a cluster (see cluster.py).
+
+Every node keeps a copy of the server's state: users, rooms and their
+participants, who is logged in and read cursors. A request that changes any of
+it is not applied where it came in. It is published on the bus that connects
+the nodes and every node applies it, the one it came in on included, in the
+order the bus delivers it. All copies go through the same changes in the same
+order, so they agree on ids and whether a name is taken, and a node only
+replies once its own copy has applied the change. The asyncio engine awaits
+that instead of waiting for it, so the event loop goes on serving the node's
+other connections meanwhile.
+
+Read cursors are the exception: they move often and only matter to the user's
+own requests, so they move on the node the user is logged in on and reach the
+others (and the store) with the logout.
+
+Messages are not applied everywhere (see OwnedRooms). Every room is owned by
+one node, which numbers its messages, writes its log and relays each message
+to the nodes that hold a connection of one of the room's participants. Pages
+and searches of the other rooms are made by their owners over the bus
+(RemoteLog).
+"""
+import os
+import asyncio
+import logging
+import threading
+import itertools
+from queue import SimpleQueue
+from concurrent.futures import Future, wait
+from message_log import DONE
+from history import RoomHistory, IndexNotReady
+from message import Message
+from room import Room
+from user import User
+
+logger = logging.getLogger(__name__)
+
+LOGIN_WAIT = 1.0 # seconds a LISTEN waits for the LOGIN it follows to be applied on its node
+
+
+class Replica:
+    """Mixin that keeps a copy of the server's state in step with other processes over a bus.
+
+    The methods of Server that change the registry or who is logged in publish
+    the change on the bus instead, unless they are called by the thread
+    applying what comes from the bus (or while the process starts up), in which
+    case they do what Server does. The request handlers stay the same as in a
+    single process. cluster.ClusterNode builds on this (through OwnedRooms),
+    the bus being a cluster.PeerMesh.
+    """
+
+    def __init__(self, host, port, config, index, processes, bus):
+        self.index = index
+        self.processes = processes
+        self.serving = False # until every process is ready, changes are made locally
+        self.ready = set() # processes that are ready to serve
+        self.applied = 0 # published changes applied so far, processes that applied as many are in the same state
+        self.applied_cond = threading.Condition()
+        self.calls = {} # request id: Future of a change this process published, or of a request to another one
+        self.logins = {} # username: Future completed once the user's login is applied here, for a LISTEN waiting on it
+        self.request_ids = itertools.count()
+        self.changes = SimpleQueue()
+
+        self.bus = bus
+        threading.Thread(target=self.listen_bus, name="bus", daemon=True).start()
+        self.applier = threading.Thread(target=self.apply_changes, name="bus-apply", daemon=True)
+        self.applier.start()
+        super().__init__(host, port, config)
+
+
+    # nothing is accepted before every process has loaded its state
+    def run_server(self):
+        self.bus.publish(["ready", self.index, None])
+        with self.applied_cond:
+            self.applied_cond.wait_for(lambda: len(self.ready) == self.processes)
+        self.serving = True
+        super().run_server()
+
+
+    # THE BUS
+    def listen_bus(self):
+        try:
+            self.bus.run()
+        except Exception as e:
+            logger.error(f"Process {self.index} lost the bus: {e}")
+        os._exit(1) # without the bus this process's state can only fall behind the others'
+
+
+    # called by the threads reading the bus: published changes are queued for the applier, which may
+    # block on locks, requests and answers to this process are handled right away (receive_<kind>)
+    def on_bus_message(self, message, published):
+        if published:
+            self.changes.put(message)
+        else:
+            getattr(self, "receive_" + message[0])(*message[1:])
+
+
+    def apply_changes(self):
+        while True:
+            kind, origin, request_id, *args = self.changes.get()
+            result = error = None
+            try:
+                result = getattr(self, "apply_" + kind)(origin, request_id, *args)
+            except Exception as e:
+                logger.exception(f"Process {self.index} could not apply {kind}: {e}")
+                error = str(e)
+            with self.applied_cond:
+                self.applied += 1
+                self.applied_cond.notify_all()
+            if origin == self.index and request_id is not None:
+                self.resolve(request_id, result, error)
+
+
+    def is_local(self):
+        return not self.serving or threading.current_thread() is self.applier
+
+
+    # waits until this process has applied as many changes as another one had when it sent something
+    def catch_up(self, applied):
+        with self.applied_cond:
+            self.applied_cond.wait_for(lambda: self.applied >= applied)
+
+
+    # publishes a change, the future completes with its result once this process has applied it
+    def publish(self, kind, *args):
+        request_id = next(self.request_ids)
+        future = self.calls[request_id] = Future()
+        self.bus.publish([kind, self.index, request_id, *args])
+        return future
+
+
+    # sends a request to one process, the future completes with what it answers (see answer())
+    def request(self, index, kind, *args):
+        request_id = next(self.request_ids)
+        future = self.calls[request_id] = Future()
+        self.bus.send(index, [kind, self.index, request_id, self.applied, *args])
+        return future
+
+
+    def answer(self, origin, request_id, error=None, result=None):
+        error = str(error) if error else None
+        if origin == self.index:
+            self.resolve(request_id, result, error)
+        else:
+            self.bus.send(origin, ["done", request_id, error, result])
+
+
+    def receive_done(self, request_id, error, result):
+        self.resolve(request_id, result, error)
+
+
+    def resolve(self, request_id, result, error=None):
+        future = self.calls.pop(request_id, None)
+        if future is None:
+            return
+        if error:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(result)
+
+
+    def apply_ready(self, origin, request_id):
+        self.ready.add(origin)
+
+
+    # CHANGES, published by the process the request came in on and applied by all
+    def add_room(self, room, persist=True):
+        if self.is_local():
+            return super().add_room(room, persist)
+        return self.publish("add_room", room.name).result()
+
+
+    async def add_room_async(self, room):
+        return await asyncio.wrap_future(self.publish("add_room", room.name))
+
+
+    def apply_add_room(self, origin, request_id, room_name):
+        return self.add_room(Room(room_name))
+
+
+    def add_registered_user(self, user, persist=True):
+        if self.is_local():
+            return super().add_registered_user(user, persist)
+        return self.publish("add_registered_user", user.username, user.password).result()
+
+
+    async def add_registered_user_async(self, user):
+        return await asyncio.wrap_future(self.publish("add_registered_user", user.username, user.password))
+
+
+    def apply_add_registered_user(self, origin, request_id, username, password):
+        return self.add_registered_user(User(username, password, None))
+
+
+    def add_participant(self, room, username):
+        if self.is_local():
+            return super().add_participant(room, username)
+        self.publish("add_participant", room.name, username).result()
+
+
+    async def add_participant_async(self, room, username):
+        await asyncio.wrap_future(self.publish("add_participant", room.name, username))
+
+
+    def apply_add_participant(self, origin, request_id, room_name, username):
+        self.add_participant(self.rooms[room_name], username)
+
+
+    def accept_login(self, user):
+        if self.is_local():
+            return super().accept_login(user)
+        return self.accepted_here(user, self.publish("accept_login", user.username).result())
+
+
+    async def accept_login_async(self, user):
+        return self.accepted_here(user, await asyncio.wrap_future(self.publish("accept_login", user.username)))
+
+
+    # every process made a User of its own, only the one the login came in on has the connection
+    def accepted_here(self, user, accepted):
+        if accepted:
+            applied = self.logged_in_users.get(user.username)
+            if applied:
+                applied.socket, applied.address = user.socket, user.address
+        return accepted
+
+
+    def apply_accept_login(self, origin, request_id, username):
+        accepted = self.accept_login(User(username, None))
+        with self.applied_cond:
+            waiting = self.logins.pop(username, None)
+        if waiting:
+            waiting.set_result(True)
+        return accepted
+
+
+    # a plaintext password replaced by its hash (see Server.rehash_password), nobody waits for it
+    def set_password(self, username, password):
+        if self.is_local():
+            return super().set_password(username, password)
+        self.publish("set_password", username, password)
+
+
+    def apply_set_password(self, origin, request_id, username, password):
+        self.set_password(username, password)
+
+
+    # the cursors that moved while the user was logged in go along with the logout
+    def release_login(self, username):
+        if self.is_local():
+            return super().release_login(username)
+        self.publish("release_login", username, self.registered_users[username].cursors.items()).result()
+
+
+    async def release_login_async(self, username):
+        await asyncio.wrap_future(self.publish("release_login", username, self.registered_users[username].cursors.items()))
+
+
+    def apply_release_login(self, origin, request_id, username, cursors):
+        for rid, seq in cursors:
+            self.mark_read(username, self.rooms_by_id[rid], seq)
+        self.release_login(username)
+
+
+    # the LISTEN connection may arrive before the LOGIN it follows has been applied here
+    def add_listening_socket(self, username, client_socket):
+        login = self.login_applied(username)
+        wait([login], timeout=LOGIN_WAIT)
+        self.forget_login(username, login)
+        super().add_listening_socket(username, client_socket)
+
+
+    async def add_listening_socket_async(self, username, client_socket):
+        login = self.login_applied(username)
+        await asyncio.wait([asyncio.wrap_future(login)], timeout=LOGIN_WAIT)
+        self.forget_login(username, login)
+        super().add_listening_socket(username, client_socket)
+
+
+    # a future that completes once the user's login has been applied here
+    def login_applied(self, username):
+        with self.applied_cond:
+            if username in self.logged_in_users:
+                login = Future()
+                login.set_result(True)
+                return login
+            return self.logins.setdefault(username, Future())
+
+
+    # after a LISTEN that waited in vain, for a user that may never log in
+    def forget_login(self, username, login):
+        with self.applied_cond:
+            if not login.done() and self.logins.get(username) is login:
+                del self.logins[username]
+
+
+    # READS OF OLDER HISTORY, from the process whose log has it (see RemoteLog); they wait for the answer,
+    # so the asyncio engine makes them on the request pool (see reads_block)
+    def read_log(self, index, room_name, first, last):
+        return self.request(index, "read_log", room_name, first, last).result()
+
+
+    # (records, cursor) of a search of the room, None while the index of the process that has it is being built
+    def search_log(self, index, room_name, query, limit, before):
+        return self.request(index, "search_log", room_name, query, limit, before).result()
+
+
+    def reads_block(self, username, msg):
+        if msg[0] == "SEARCH":
+            room_names = msg[2:3] or list(self.user_rooms.get(username, ()))
+        else:
+            room_names = msg[1:2]
+        return any(isinstance(self.rooms[room_name].messages.log, RemoteLog)
+                   for room_name in room_names if room_name in self.rooms)
+
+
+    def receive_read_log(self, origin, request_id, applied, room_name, first, last):
+        self.request_pool.submit(self.serve_log_read, origin, request_id, applied, room_name, first, last)
+
+
+    def receive_search_log(self, origin, request_id, applied, room_name, query, limit, before):
+        self.request_pool.submit(self.serve_log_search, origin, request_id, applied, room_name, query, limit, before)
+
+
+    # on the request pool, once this process has applied everything the asking one had
+    def serve_log_search(self, origin, request_id, applied, room_name, query, limit, before):
+        try:
+            self.catch_up(applied)
+            records, cursor = self.rooms[room_name].search(query, limit, before)
+            self.answer(origin, request_id, result=([bytes(record).decode() for record in records], cursor))
+        except IndexNotReady:
+            self.answer(origin, request_id)
+        except Exception as e:
+            logger.error(f"Could not search {room_name} for process {origin}: {e}")
+            self.answer(origin, request_id, error=e)
+
+
+    # on the request pool, once this process has applied everything the asking one had
+    def serve_log_read(self, origin, request_id, applied, room_name, first, last):
+        try:
+            self.catch_up(applied)
+            records = [bytes(record).decode() for record in self.rooms[room_name].messages.read(first, last)]
+            self.answer(origin, request_id, result=records)
+        except Exception as e:
+            logger.error(f"Could not read {first}..{last} of {room_name} for process {origin}: {e}")
+            self.answer(origin, request_id, error=e)
+
+
+class OwnedRooms(Replica):
+    """Mixin on top of Replica for processes that split the messages of the rooms between them.
+
+    Every room has an owner, process rid % processes, which numbers its
+    messages, keeps them (hot window, log, search index) and relays each message
+    to the processes that have a connection of one of the room's participants,
+    and only to those: the process a participant is logged in on (unread counts)
+    and the one holding their LISTEN connection (UPDATEs). Every process knows
+    from presence, memberships and the published LISTENs how many participants
+    of each room have a connection on each process (interest). The other
+    processes keep a copy of the room that only numbers its messages
+    (RemoteHistory) and is only up to date while they are interested: one that
+    becomes interested is sent the room's last seq, and one that missed
+    messages goes on from there. Pages and searches are made by the owner. A
+    message posted on another process is forwarded to the room's owner and
+    acknowledged once the owner's log has it.
+    """
+
+    def __init__(self, host, port, config, index, processes, bus):
+        self.interest = {} # room name: {process index: participants with a connection there}
+        self.homes = {} # username: indexes of the processes the user has a connection on (login, LISTEN)
+        self.syncs = {} # room name: Future completed by the sync the owner sends once this process has become interested
+        super().__init__(host, port, config, index, processes, bus)
+
+
+    def owner(self, room):
+        return room.rid % self.processes
+
+
+    # the owner keeps the room's messages, the other processes only number them (RemoteHistory)
+    def create_history(self, room):
+        if self.owner(room) == self.index:
+            return super().create_history(room)
+        return RemoteHistory(self, self.owner(room), room.name)
+
+
+    # PRESENCE AND INTEREST, applied in order by every process
+    def apply_accept_login(self, origin, request_id, username):
+        accepted = super().apply_accept_login(origin, request_id, username)
+        if accepted:
+            self.homes[username] = set()
+            self.add_home(username, origin)
+        return accepted
+
+
+    # the reply waits for the syncs of the rooms the login made this process interested in: until they
+    # are in, the process's copies of those rooms are behind their owners (unread counts, pages)
+    def accept_login(self, user):
+        accepted = super().accept_login(user)
+        if accepted and not self.is_local():
+            syncs = self.pending_syncs(user.username)
+            if syncs:
+                wait(syncs, timeout=LOGIN_WAIT)
+        return accepted
+
+
+    async def accept_login_async(self, user):
+        accepted = await super().accept_login_async(user)
+        if accepted:
+            syncs = self.pending_syncs(user.username)
+            if syncs:
+                await asyncio.wait([asyncio.wrap_future(sync) for sync in syncs], timeout=LOGIN_WAIT)
+        return accepted
+
+
+    def pending_syncs(self, username):
+        with self.applied_cond:
+            return [self.syncs[room_name] for room_name in self.user_rooms[username] if room_name in self.syncs]
+
+
+    # the UPDATEs of a user go to the process holding their LISTEN connection, which need not be the
+    # one they logged in on; the LISTEN is published behind the login, which has been applied before it
+    def add_listening_socket(self, username, client_socket):
+        if self.index not in self.homes.get(username, ()):
+            self.publish("listen", username).result()
+        super().add_listening_socket(username, client_socket)
+
+
+    async def add_listening_socket_async(self, username, client_socket):
+        if self.index not in self.homes.get(username, ()):
+            await asyncio.wrap_future(self.publish("listen", username))
+        await super().add_listening_socket_async(username, client_socket)
+
+
+    def apply_listen(self, origin, request_id, username):
+        self.add_home(username, origin)
+
+
+    def add_home(self, username, index):
+        homes = self.homes.get(username)
+        if homes is None or index in homes: # not logged in (any more), or interested there already
+            return
+        homes.add(index)
+        for room_name in list(self.user_rooms[username]):
+            self.add_interest(room_name, index, 1)
+
+
+    def apply_release_login(self, origin, request_id, username, cursors):
+        super().apply_release_login(origin, request_id, username, cursors)
+        for index in self.homes.pop(username, ()):
+            for room_name in list(self.user_rooms[username]):
+                self.add_interest(room_name, index, -1)
+
+
+    def apply_add_participant(self, origin, request_id, room_name, username):
+        joined = username not in self.rooms[room_name].participants
+        super().apply_add_participant(origin, request_id, room_name, username)
+        if joined and username in self.rooms[room_name].participants:
+            for index in self.homes.get(username, ()):
+                self.add_interest(room_name, index, 1)
+
+
+    # counts the participants of the room with a connection on process index; the owner tells a process that has just
+    # become interested where the room is at, under the room's lock so that it comes before any relay of a newer message
+    def add_interest(self, room_name, index, delta):
+        counts = self.interest.setdefault(room_name, {})
+        counts[index] = counts.get(index, 0) + delta
+        if counts[index] <= 0:
+            del counts[index]
+        elif counts[index] == delta:
+            room = self.rooms[room_name]
+            if self.owner(room) == self.index and index != self.index:
+                with room.lock:
+                    self.bus.send(index, ["sync", self.applied, room_name, len(room.messages)])
+            elif index == self.index and self.owner(room) != self.index:
+                with self.applied_cond:
+                    self.syncs.setdefault(room_name, Future())
+
+
+    def receive_sync(self, applied, room_name, last_seq):
+        self.catch_up(applied)
+        room = self.rooms[room_name]
+        with room.lock:
+            if len(room.messages) != last_seq:
+                room.messages.restart_at(last_seq)
+        with self.applied_cond:
+            sync = self.syncs.pop(room_name, None)
+        if sync:
+            sync.set_result(last_seq)
+
+
+    # MESSAGES, numbered by the room's owner and relayed to the interested processes
+    def post_message(self, room, message):
+        owner = self.owner(room)
+        if owner == self.index:
+            return self.post_owned(room, message)
+        return self.request(owner, "post", room.name, message.author_name, message.text, message.timestamp)
+
+
+    def receive_post(self, origin, request_id, applied, room_name, author_username, text, timestamp):
+        try:
+            self.catch_up(applied)
+            message = Message(room_name, author_username, text)
+            message.timestamp = timestamp # as the process it came in on saw it
+            durable = self.post_owned(self.rooms[room_name], message)
+            durable.add_done_callback(lambda done: self.answer(origin, request_id, done.exception()))
+        except Exception as e:
+            logger.error(f"Could not post to {room_name} for process {origin}: {e}")
+            self.answer(origin, request_id, error=e)
+
+
+    # Room.lock is reentrant: Server.post_message takes it again, the relays leave in seq order
+    def post_owned(self, room, message):
+        with room.lock:
+            durable = super().post_message(room, message)
+            relay = None
+            for index in list(self.interest.get(room.name, ())):
+                if index != self.index:
+                    if relay is None:
+                        relay = ["relay", self.applied, room.name, message.seq, message.author_name,
+                                 message.text, message.timestamp]
+                    self.bus.send(index, relay)
+        return durable
+
+
+    def receive_relay(self, applied, room_name, seq, author_username, text, timestamp):
+        self.catch_up(applied)
+        room = self.rooms[room_name]
+        message = Message(room_name, author_username, text)
+        message.timestamp = timestamp
+        with room.lock:
+            if len(room.messages) != seq - 1: # nobody here was interested for a while
+                room.messages.restart_at(seq - 1)
+            super().post_message(room, message)
+
+
+class RemoteHistory(RoomHistory):
+    """Copy of a room kept by a process that does not own it (see OwnedRooms).
+
+    It only numbers the messages, which is all unread counts and UPDATEs need;
+    the owner keeps them. Pages are read from the owner (through its RemoteLog,
+    the hot window stays empty) and searches are made there too, the owner's is
+    the room's only search index.
+    """
+
+    def __init__(self, replica, index, room_name):
+        super().__init__(room_name, RemoteLog(replica, index, room_name, 0))
+
+
+    def append(self, message):
+        with self.lock:
+            self.last_seq += 1
+            self.log.last_seq = message.seq = self.last_seq
+        return DONE
+
+
+    # for a copy that has missed messages (nobody here was interested for a while), numbering goes on after seq
+    def restart_at(self, seq):
+        with self.lock:
+            self.last_seq = self.log.last_seq = seq
+
+
+    def search(self, query, limit, before=None):
+        found = self.log.search(query, limit, before)
+        if found is None:
+            raise IndexNotReady(self.room_name)
+        return found
+
+
+    def start_index(self):
+        pass
+
+
+class RemoteLog:
+    """Takes the place of a room's MessageLog in a process that does not write the room's log.
+
+    Nothing is written here, the process with the log (index) has every
+    message. Records are read, and searched, from that process's copy of the
+    room, which has applied at least as much as this one had when it asked.
+    """
+
+    def __init__(self, replica, index, room_name, last_seq):
+        self.replica = replica
+        self.index = index
+        self.room_name = room_name
+        self.last_seq = last_seq
+
+
+    def append(self, record):
+        self.last_seq += 1
+        return DONE
+
+
+    def read(self, first, last):
+        if first > last:
+            return []
+        return [record.encode() for record in self.replica.read_log(self.index, self.room_name, first, last)]
+
+
+    def search(self, query, limit, before):
+        found = self.replica.search_log(self.index, self.room_name, query, limit, before)
+        if found is None:
+            return None
+        records, cursor = found
+        return [record.encode() for record in records], cursor
+
+
+    def close(self):
+        pass
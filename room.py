@@ -1,6 +1,7 @@
 import sys
 import threading
 import logging
+from history import RoomHistory
 
 # initialize logger for debugging
 logger = logging.getLogger(__name__)
@@ -8,18 +9,31 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG) # DEBUG or ERROR
 
 class Room:
-    
-    # room name
-    name = None
 
-    def __init__(self, name, participants=[]):
-        self.name = name
-        self.participants = participants
-        self.messages = []
+    __slots__ = ("name", "rid", "participants", "messages", "lock")
+
+    def __init__(self, name, participants=()):
+        self.name = sys.intern(name)
+        self.rid = None # numeric id, assigned by the server
+        self.participants = set(participants) # usernames, changed by the server under its registry lock
+        self.lock = threading.RLock() # held by the server while a message is added and fanned out (and relayed, see cluster.py)
+        self.messages = RoomHistory(name) # replaced by a bounded one when the server adds the room
+
+    # gives the message the next sequence number of this room and stores it, returns the future of the write
+    def add_message(self, message):
+        return self.messages.append(message)
+
+    # (JSON records newest first, cursor of the next older page), see RoomHistory.page
+    def history_page(self, limit, before=None, since=0):
+        return self.messages.page(limit, before, since)
+
+    # (JSON records newest first, cursor of the next older page) of the messages containing every word of query
+    def search(self, query, limit, before=None):
+        return self.messages.search(query, limit, before)
 
     def toJSON(self):
         return {
             "name": self.name,
-            "participants": [part.toJSON() for part in self.participants],
+            "participants": sorted(self.participants),
         }
     
\ No newline at end of file
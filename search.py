@@ -0,0 +1,61 @@
+"""Inverted index over the messages of one room.
+
+Every token of a message (a run of letters, digits or underscores, case
+folded) maps to the posting list of the sequence numbers of the messages that
+contain it. Sequence numbers only grow, so appending keeps every posting list
+sorted and a search walks the shortest list of its terms from the newest end,
+checking the others by binary search. A page costs the hits it returns, not
+the length of the history.
+"""
+import re
+from array import array
+from bisect import bisect_left
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return set(TOKEN.findall(text.casefold()))
+
+
+class SearchIndex:
+
+    def __init__(self):
+        self.postings = {} # token: array of seqs, ascending
+        self.last_seq = 0 # of the last message indexed
+
+    def add(self, seq, text):
+        for token in tokenize(text):
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array("I")
+            postings.append(seq)
+        self.last_seq = seq
+
+    def search(self, query, limit, before=None):
+        """Returns (seqs, cursor) for up to limit messages containing every term of query, newest first.
+
+        Only messages with seq < before are considered. cursor is the "before"
+        of the next page, None when there are no more matches.
+        """
+        terms = tokenize(query)
+        lists = [self.postings.get(term) for term in terms]
+        if not lists or None in lists:
+            return [], None
+        lists.sort(key=len)
+        shortest, others = lists[0], lists[1:]
+
+        seqs = []
+        end = len(shortest) if before is None else bisect_left(shortest, before)
+        for i in range(end - 1, -1, -1):
+            seq = shortest[i]
+            if all(contains(postings, seq) for postings in others):
+                if len(seqs) == limit:
+                    return seqs, seqs[-1] # one more match is left
+                seqs.append(seq)
+        return seqs, None
+
+
+def contains(postings, seq):
+    i = bisect_left(postings, seq)
+    return i < len(postings) and postings[i] == seq
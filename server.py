@@ -1,81 +1,266 @@
+import os
 import sys
+import argparse
 import socket
-import struct
 import threading
 import logging
 import traceback
 from user import User
 from room import Room
+from history import RoomHistory, IndexNotReady
+from message_log import MessageLog, LogCommitter, Compressor, LogUnwritable, room_log_dir
+from store import Store
 from message import Message
+from config import ServerConfig
+import framing
+from pipeline import Reply, SerialQueue, split_request_id
+from outbound import OutboundQueue, DISCONNECT
+from presence import Presence
+import credentials
+from credentials import CredentialPool, CredentialsBusy
+import admission
+from admission import Admission
+import ratelimit
+from ratelimit import RateLimits, RateLimited
+from framing import FrameTooLarge
+import protocol_v2
+from protocol_v2 import BinarySocket
 import json
-import pickle
 import copy
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 class Server:
-
-    def __init__(self, host='0.0.0.0', port=5555):
+    """The chat server, threaded engine (see async_server.py for the asyncio one).
+
+    Requests of different connections are handled at the same time (a thread
+    per connection plus the request pool for pipelined requests), so shared
+    state follows these rules:
+
+    - The registry (rooms, rooms_by_id, registered_users, users_by_id,
+      user_rooms, logged_in_users and the participants of every room) is only
+      changed with registry_lock held, and a change that depends on a check
+      (is the name taken, is the user logged in) makes the check under it.
+      Readers do not lock: a single dict or set lookup is atomic, and code that
+      iterates over one of them iterates over a copy (list() and sorted() copy
+      without letting another thread in).
+    - Every room has a lock of its own, held while a message gets its seq and
+      is fanned out, so each participant gets a room's UPDATEs in seq order.
+      Messages to different rooms never wait for each other. RoomHistory also
+      locks its hot window against readers of history pages.
+    - Fanning out only enqueues (see outbound.py). The lock of a BinarySocket
+      keeps its DEFINE frames ahead of the UPDATEs that use them when several
+      rooms fan out to the same connection.
+    - Locks are taken in the order registry_lock, Room.lock, RoomHistory.lock,
+      MessageLog.lock, never the other way around.
+    - Presence changes are noted under registry_lock with the login or logout
+      they come from and sent later by the presence thread (see presence.py),
+      which reads the registry like any other reader.
+    """
+
+    def __init__(self, host='0.0.0.0', port=5555, config=None):
         # initialize logger for debugging
         self.logger = logging.getLogger(__name__)
         #self.logger.addHandler(logging.StreamHandler(sys.stdout))
         logging.basicConfig(level=logging.DEBUG) # DEBUG or ERROR
 
-        self.lock = threading.Lock()
+        self.registry_lock = threading.Lock()
+        self.config = config or ServerConfig()
+        self.request_pool = ThreadPoolExecutor(self.config.pipeline_workers, thread_name_prefix="request")
 
+        start = time.perf_counter()
         self.allocate_resources()
+        self.startup_time = time.perf_counter() - start
 
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(10)
-        print(f"Server started on {self.host}:{self.port}")
+        self.server_socket.listen(self.config.listen_backlog)
+        messages = sum(len(room.messages) for room in self.rooms_by_id)
+        print(f"Server started on {self.host}:{self.port}, loaded {len(self.users_by_id)} users, "
+              f"{len(self.rooms_by_id)} rooms and {messages} messages in {self.startup_time * 1000:.1f} ms")
 
+        self.start_indexing()
         self.run_server()
 
 
     def allocate_resources(self):
-        self.rooms = {}
-        self.broadcast_room = Room("Broadcast") # for broadcasting to all logged in users
-        self.rooms[self.broadcast_room.name] = self.broadcast_room
+        self.history_dir = self.config.history_dir
+        if not self.history_dir:
+            self.history_tempdir = tempfile.TemporaryDirectory(prefix="chat-history-")
+            self.history_dir = self.history_tempdir.name
+        os.makedirs(self.history_dir, exist_ok=True)
+        self.log_committer = LogCommitter(self.config.message_durability, self.config.message_commit_interval,
+                                          self.config.message_commit_batch).start()
+        self.compressor = None
+        if self.config.history_compression != "none":
+            self.compressor = Compressor(self.config.history_compression, self.config.history_block_messages,
+                                         self.config.history_block_cache).start()
+
+        self.credentials = CredentialPool(self.config.password_hash, self.config.password_hash_cost,
+                                          self.config.password_hash_workers, self.config.login_concurrency)
+
+        # users, rooms and memberships are persisted here, requests are served from the dictionaries below
+        self.store = self.create_store()
+        users, rooms, memberships, cursors = self.store.load()
+
+        # one thread builds the search indexes of the rooms, in the background (see start_indexing)
+        self.indexer = ThreadPoolExecutor(1, thread_name_prefix="search-index")
+        self.indexing = False
 
-        self.clients = []  # list to keep track of connected clients
+        self.rooms = {}
+        self.rooms_by_id = [] # room.rid: Room, ids are what protocol v2 puts on the wire
+        self.admission = Admission(self.config.max_connections, self.config.max_unauthenticated) # the open connections
+        self.rate_limits = RateLimits((self.config.user_message_rate, self.config.user_message_burst), {
+            ratelimit.BROADCAST: (self.config.broadcast_message_rate, self.config.broadcast_message_burst),
+            ratelimit.LARGE: (self.config.large_room_message_rate, self.config.large_room_message_burst),
+            ratelimit.SMALL: (self.config.room_message_rate, self.config.room_message_burst),
+        }, self.config.large_room_size)
         # registered users username: User
-        self.registered_users = {
-            "andrej": User("andrej", "123", None),
-            "ivona": User("ivona", "123", None),
-            "demijan": User("demijan", "123", None),
-        }
+        self.registered_users = {}
+        self.users_by_id = [] # user.uid: username
+        self.user_rooms = {} # username: names of the rooms the user is in, Broadcast included
+
+        if rooms:
+            self.restore(users, rooms, memberships, cursors)
+            self.broadcast_room = self.rooms["Broadcast"]
+        else:
+            self.broadcast_room = Room("Broadcast") # for broadcasting to all logged in users
+            self.add_room(self.broadcast_room)
+            for username in ("andrej", "ivona", "demijan"):
+                password = credentials.hash_password("123", self.config.password_hash, self.config.password_hash_cost)
+                self.add_registered_user(User(username, password, None))
+
+        self.store.start()
+        self.logged_in_users = {}  # dictionary to keep track of logged-in users, username: User
+        self.presence = Presence(self.contacts, self.send_presence, self.config.presence_window).start()
 
-        for username in self.registered_users.keys():
-            self.rooms["Broadcast"].participants.append(username)
 
-        self.logged_in_users = {}  # dictionary to keep track of logged-in users, username: User
+    def create_store(self):
+        return Store(self.config.store_path or os.path.join(self.history_dir, "chat.db"),
+                     self.config.store_commit_interval, self.config.store_batch_size)
+
+
+    # rebuilds the in-memory indexes from the store, ids are dense so they come back in the same places
+    def restore(self, users, rooms, memberships, cursors):
+        for rid, name in rooms:
+            self.add_room(Room(name), persist=False)
+        for uid, username, password in users:
+            self.add_registered_user(User(username, password, None), persist=False)
+        for rid, uid in memberships:
+            self.join(self.rooms_by_id[rid], self.users_by_id[uid])
+        for uid, rid, seq in cursors:
+            self.registered_users[self.users_by_id[uid]].cursors.advance(rid, seq)
+        self.logger.info(f"Restored {len(users)} users and {len(rooms)} rooms from {self.store.path}")
+
+
+    # returns False if there already is a room of that name
+    def add_room(self, room, persist=True):
+        with self.registry_lock:
+            if room.name in self.rooms:
+                return False
+            room.rid = len(self.rooms_by_id)
+            room.messages = self.create_history(room)
+            self.rooms_by_id.append(room)
+            self.rooms[room.name] = room
+            if persist:
+                self.store.add_room(room)
+            if self.indexing:
+                room.messages.start_index()
+        return True
+
+
+    def create_history(self, room):
+        return RoomHistory(room.name, self.create_log(room), self.config.history_hot_messages,
+                           self.config.history_hot_bytes, columnar=self.config.history_hot_layout == "columnar",
+                           indexer=self.indexer)
+
+
+    # builds the search index of every room on the indexer, rooms added from then on start theirs right away;
+    # a search never builds one, rooms whose index is not in yet are answered as indexing
+    def start_indexing(self):
+        with self.registry_lock:
+            self.indexing = True
+            rooms = list(self.rooms_by_id)
+        for room in rooms:
+            room.messages.start_index()
+
+
+    def create_log(self, room):
+        return MessageLog(room_log_dir(self.history_dir, room.name), self.config.history_segment_bytes,
+                          self.log_committer, self.compressor)
+
+
+    # every user is in Broadcast, that membership is implied and not stored; returns False if the name is taken
+    def add_registered_user(self, user, persist=True):
+        with self.registry_lock:
+            if user.username in self.registered_users:
+                return False
+            user.uid = len(self.users_by_id)
+            self.users_by_id.append(user.username)
+            self.registered_users[user.username] = user
+            self.user_rooms[user.username] = set()
+            self.join(self.rooms["Broadcast"], user.username)
+            if persist:
+                self.store.add_user(user)
+        return True
+
+
+    def add_participant(self, room, username):
+        user = self.registered_users.get(username)
+        if not user:
+            self.logger.debug(f"Not adding unknown user {username} to {room.name}")
+            return
+        with self.registry_lock:
+            if username in room.participants:
+                return
+            self.join(room, username)
+            self.store.add_member(room, user)
+
+
+    # keeps room.participants and the user's side of it, user_rooms, in step; called with self.registry_lock held
+    def join(self, room, username):
+        room.participants.add(username)
+        self.user_rooms[username].add(room.name)
 
 
     def run_server(self):
         while True:
             client_socket, addr = self.server_socket.accept()
+            reason = self.admission.admit(client_socket)
+            if reason:
+                self.refuse(client_socket, reason)
+                self.cleanup_client(client_socket)
+                continue
             print(f"Client connected: {addr}")
-            self.clients.append(client_socket)
             client_thread = threading.Thread(target=self.handle_auth, args=(client_socket, addr))
             client_thread.start()
 
 
     def handle_auth(self, client_socket, addr):
+        deadline = time.monotonic() + self.config.auth_timeout # for the whole login, not each request
         while True:
             self.logger.debug(f"In while in handle_auth()...")
             try:
-                msg = self.receive(client_socket)
-                action = msg.split("|")[0]
+                self.raw_socket(client_socket).settimeout(max(deadline - time.monotonic(), 0.001))
+                _, msg = self.receive_request(client_socket)
+                action = msg[0]
                 self.logger.debug(f"Client chose action: {action}")
                 
-                if action == "REGISTER":
+                if action == protocol_v2.HELLO:
+                    client_socket = self.negotiate_protocol(client_socket, msg)
+                    continue
+
+                elif action == "REGISTER":
                     self.register(client_socket, msg, addr)
                     continue
 
                 elif action == "LOGIN":
                     username = self.login(client_socket, msg, addr)
                     if username:
+                        self.authenticated(client_socket)
                         self.on_login_success(username, client_socket)
                         break
                     elif username == None:
@@ -85,44 +270,107 @@ class Server:
                         break
 
                 elif action == "LISTEN":
-                    username = msg.split("|")[1]
-                    self.logged_in_users[username].listening_socket = client_socket
-                    self.send_all(client_socket, "SUCCESSFULLY added listening_socket!")
+                    username = msg[1]
+                    self.authenticated(client_socket)
+                    self.add_listening_socket(username, client_socket)
                     break
 
+            except TimeoutError:
+                self.refuse(client_socket, admission.AUTH_TIMEOUT)
+                self.cleanup_client(client_socket)
+                break
+
+            except FrameTooLarge:
+                self.refuse(client_socket, admission.FRAME_TOO_LARGE)
+                self.cleanup_client(client_socket)
+                break
+
+            except (EOFError, ConnectionError):
+                self.logger.debug(f"Client {addr} disconnected before logging in")
+                self.cleanup_client(client_socket)
+                break
 
             except Exception as e:
                 self.logger.error("Exception in handle_auth():")
                 self.logger.exception(e)
-                self.logout(username, client_socket)
+                self.cleanup_client(client_socket)
                 break
 
 
+    # the connection has logged in (or sent LISTEN), it no longer counts against the unauthenticated ones
+    def authenticated(self, client_socket):
+        sock = self.raw_socket(client_socket)
+        sock.settimeout(None)
+        self.admission.authenticated(sock)
+
+
+    # counts the refusal and tells the client, as far as it still listens, before the connection is closed
+    def refuse(self, client_socket, reason):
+        self.admission.refuse(reason)
+        self.logger.warning(f"Closing a connection: {reason}")
+        try:
+            sock = self.raw_socket(client_socket)
+            if isinstance(sock, socket.socket):
+                sock.setblocking(False) # a client that does not read does not get to hold up this thread
+            self.send_all(client_socket, admission.NOTICES[reason])
+        except OSError:
+            pass
+
+
+    # HELLO|<version>, answers with the version the connection will use from now on
+    def negotiate_protocol(self, client_socket, msg):
+        if msg[1] == str(protocol_v2.VERSION):
+            self.send_all(client_socket, f"HELLO|{protocol_v2.VERSION}")
+            return BinarySocket(client_socket)
+        self.send_all(client_socket, "HELLO|1")
+        return client_socket
+
+
+    def add_listening_socket(self, username, client_socket):
+        user = self.logged_in_users[username]
+        if user.outbound: # a new LISTEN connection replaces the previous one
+            self.close_listening_socket(user)
+        # from now on everything for this user goes through its outbound queue, UPDATEs fanned
+        # out before the acknowledgement is written wait in the queue until its writer starts;
+        # the fan-out takes a set outbound to mean listening_socket is the connection it writes
+        user.listening_socket = client_socket
+        user.outbound = self.create_outbound_queue(getattr(client_socket, "sock", client_socket), username)
+        self.send_all(client_socket, "SUCCESSFULLY added listening_socket!")
+        self.presence.snapshot(username)
+        user.outbound.start()
+
+
+    def create_outbound_queue(self, sock, username):
+        return OutboundQueue(sock, self.config.outbound_queue_size, self.config.outbound_policy,
+                             name=username, lagged_notice=self.encode_frame("LAGGED"),
+                             max_bytes=self.config.outbound_queue_bytes)
+
+
     def on_login_success(self, username, client_socket):
+        requests = SerialQueue(self.request_pool, self.config.pipeline_depth) # pipelined requests, handled in order
+        replies = None # their replies, queued for a writer of the connection's own (see pipeline.Reply)
         while True:
             try:
-                msg = self.receive(client_socket).split("|")
+                request_id, msg = self.receive_request(client_socket)
                 self.logger.debug(f"Received msg from client: {msg}")
-                action = msg[0]
-                if action == "SEND_ROOMS":
-                    self.send_rooms(username, client_socket)
 
-                elif action == "SELECT_ROOM":
-                    self.select_room(client_socket, username, msg)
-
-                elif action == "SEND_MESSAGE":
-                    self.send_message(client_socket, username, msg)
+                if request_id is None:
+                    if not self.handle_action(username, client_socket, msg):
+                        break
+                    continue
 
-                elif action == "LOGOUT":
-                    self.logout(username, client_socket)
+                if replies is None:
+                    replies = self.create_reply_queue(client_socket, username).start()
+                reply = Reply(client_socket, request_id, replies)
+                requests.submit(self.handle_pipelined_action, username, reply, msg)
+                if msg[0] == "LOGOUT": # once the requests before it are handled
                     break
-                
-                elif action == "CREATE_ROOM":
-                    self.create_room(username, client_socket, msg)
 
-                elif action == "ADD_PARTICIPANTS":
-                    self.add_participants(username, client_socket, msg)
-                    
+            except FrameTooLarge:
+                self.refuse(client_socket, admission.FRAME_TOO_LARGE)
+                self.logout(username, client_socket)
+                break
+
             except Exception as e:
                 self.logger.error("Exception in on_login_success():")
                 traceback.print_exception(e)
@@ -130,15 +378,142 @@ class Server:
                 break
 
 
+    # past outbound_queue_bytes of unread replies the connection is closed, like on the asyncio engine
+    def create_reply_queue(self, client_socket, username):
+        return OutboundQueue(client_socket, self.config.outbound_queue_size, DISCONNECT,
+                             name=f"{username} (replies)", max_bytes=self.config.outbound_queue_bytes,
+                             on_disconnect=lambda: self.admission.refuse(admission.OUTBOUND_FULL))
+
+
+    def handle_pipelined_action(self, username, reply, msg):
+        try:
+            self.handle_action(username, reply, msg)
+        except ConnectionError as e:
+            self.logger.debug(f"Pipelined {msg[0]} not answered: {e}")
+        except Exception as e:
+            self.logger.error(f"Exception in pipelined {msg[0]}: {e}")
+
+
+    # dispatches one request of a logged in user, returns False once the session is over
+    def handle_action(self, username, client_socket, msg):
+        action = msg[0]
+        if action == "SEND_ROOMS":
+            self.send_rooms(username, client_socket, msg)
+
+        elif action == "SELECT_ROOM":
+            self.select_room(client_socket, username, msg)
+
+        elif action == "HISTORY":
+            self.send_history(client_socket, username, msg)
+
+        elif action == "SEARCH":
+            self.search(client_socket, username, msg)
+
+        elif action == "READ":
+            self.read_room(client_socket, username, msg)
+
+        elif action == "SEND_MESSAGE":
+            self.send_message(client_socket, username, msg)
+
+        elif action == "LOGOUT":
+            self.logout(username, client_socket)
+            return False
+
+        elif action == "CREATE_ROOM":
+            self.create_room(username, client_socket, msg)
+
+        elif action == "ADD_PARTICIPANTS":
+            self.add_participants(username, client_socket, msg)
+
+        return True
+
+
     def select_room(self, client_socket, username, msg):
         room_name = msg[1]
-        if (username not in self.rooms[room_name].participants) and room_name != "Broadcast":
+        if not self.can_access(username, room_name):
             self.send_all(client_socket, "Access Denied!")
             return
 
+        # SELECT_ROOM|room|since only sends what came after the last message the client already has
+        since = int(msg[2]) if len(msg) > 2 else 0
+        room = self.rooms[room_name]
+        last_seq = len(room.messages) # the page has everything up to here
+        page = self.encode_history_page(room, since=since) # before the answer, nothing can fail after it
         self.logger.debug("Sending SUCCESSFULLY JOINED ROOM to client...\n")
         self.send_all(client_socket, "SUCCESSFULLY JOINED ROOM!")
-        self.send_room_messages(client_socket, username, room_name)
+        self.send_bytes(client_socket, page)
+        self.mark_read(username, room, last_seq)
+
+
+    # READ|room|seq, the user has seen the messages of the room up to seq (while it was the selected room)
+    def read_room(self, client_socket, username, msg):
+        room_name = msg[1]
+        if not self.can_access(username, room_name):
+            self.send_all(client_socket, "Access Denied!")
+            return
+
+        room = self.rooms[room_name]
+        self.mark_read(username, room, min(int(msg[2]), len(room.messages)))
+        self.answer_pipelined(client_socket, "SUCCESSFULLY MARKED AS READ!")
+
+
+    # lockstep clients do not wait for an answer to READ and CREATE_ROOM, in pipelined mode every request gets one
+    def answer_pipelined(self, client_socket, answer):
+        if isinstance(client_socket, Reply):
+            self.send_all(client_socket, answer)
+
+
+    # moves the user's read cursor of the room forward, cursors never go back
+    def mark_read(self, username, room, seq):
+        user = self.registered_users[username]
+        if user.cursors.advance(room.rid, seq):
+            self.store.set_cursor(user, room, seq)
+
+
+    # HISTORY|room|before[|limit], the page of messages older than the cursor of the previous page
+    def send_history(self, client_socket, username, msg):
+        room_name = msg[1]
+        if not self.can_access(username, room_name):
+            self.send_all(client_socket, "Access Denied!")
+            return
+
+        limit = int(msg[3]) if len(msg) > 3 else self.config.history_page_size
+        self.send_history_page(client_socket, self.rooms[room_name], int(msg[2]), limit)
+
+
+    # SEARCH|query, the newest matches in every room the user can read
+    # SEARCH|query|room|before[|limit], a page of matches in one room, older than the cursor of the previous page
+    def search(self, client_socket, username, msg):
+        query = msg[1]
+        one_room = len(msg) > 2
+        if one_room:
+            if not self.can_access(username, msg[2]):
+                self.send_all(client_socket, "Access Denied!")
+                return
+            rooms = [self.rooms[msg[2]]]
+            before = int(msg[3]) if len(msg) > 3 and msg[3] else None
+            limit = int(msg[4]) if len(msg) > 4 else None
+        else:
+            rooms = [self.rooms[room_name] for room_name in list(self.user_rooms.get(username, ()))]
+            before = limit = None
+
+        limit = max(1, min(limit or self.config.history_page_size, self.config.history_page_size))
+        pages = []
+        indexing = [] # rooms whose index is still being built, the client can ask again later
+        for room in rooms:
+            try:
+                records, cursor = room.search(query, limit, before)
+            except IndexNotReady:
+                indexing.append(room.name)
+                continue
+            if records or one_room:
+                pages.append(self.encode_page(room, records, cursor))
+        self.send_bytes(client_socket, b'{"query": %s, "results": [%s], "indexing": %s}' % (
+            json.dumps(query).encode(), b", ".join(pages), json.dumps(indexing).encode()))
+
+
+    def can_access(self, username, room_name):
+        return room_name in self.rooms and (username in self.rooms[room_name].participants or room_name == "Broadcast")
 
 
     def send_message(self, client_socket, username, msg):
@@ -147,113 +522,207 @@ class Server:
             message = msg[2]
             self.logger.debug(f"Room name is '{room_name}', and message is '{message}'")
             
-            if self.send_message_to_room(username, room_name, message):
-                self.logger.debug("Sending SUCCESSFULLY SENT MESSAGE to client...")
-                self.send_all(client_socket, "SUCCESSFULLY SENT MESSAGE!")
+            durable = self.send_message_to_room(username, room_name, message)
+            if durable:
+                # the fan-out is already done, only the acknowledgement waits for the log; the next
+                # pipelined request of the connection does not wait for it
+                self.when_durable(durable, lambda error: self.acknowledge_message(client_socket, error),
+                                  wait=not isinstance(client_socket, Reply))
+            else:
+                self.send_all(client_socket, "Access Denied!")
+
+        except RateLimited as e:
+            self.send_all(client_socket, "RATE_LIMITED|" + json.dumps(
+                {"scope": e.scope, "room": e.room_name, "retry_after": round(e.retry_after, 3)}))
+
+        except LogUnwritable as e:
+            self.logger.error(f"Room '{msg[1]}' takes no messages: {e}")
+            self.send_all(client_socket, "Failed to store message!")
 
-                
         except Exception as e:
             self.logger.error(f"Exception in send_message(): {e}")
 
 
+    def acknowledge_message(self, client_socket, error):
+        if error:
+            self.send_all(client_socket, "Failed to store message!")
+            return
+        self.logger.debug("Sending SUCCESSFULLY SENT MESSAGE to client...")
+        self.send_all(client_socket, "SUCCESSFULLY SENT MESSAGE!")
+
+
+    # calls then(error) once the future of a log append completes, error being None on success,
+    # on the request pool unless this thread is to wait for it
+    def when_durable(self, durable, then, wait=True):
+        if wait or durable.done():
+            then(durable.exception())
+            return
+        durable.add_done_callback(lambda done: self.request_pool.submit(then, done.exception()))
+
+
+    # the request handlers below are also the steps of their asyncio counterparts (see async_server.py),
+    # which only wait differently for the registry and the client
     def create_room(self, username, client_socket, msg):
+        room = self.room_to_create(msg)
+        if self.add_room(room):
+            self.add_participant(room, username)
+            self.logger.debug("Room created successfully.\n")
+        self.answer_pipelined(client_socket, "SUCCESSFULLY CREATED ROOM!")
+
+
+    def room_to_create(self, msg):
         room_name = msg[1]
         self.logger.debug(f"Received room_name: {room_name} from client and now creating room...")
-        if room_name not in self.rooms:
-            self.rooms[room_name] = Room(room_name, [username])
-            self.logger.debug("Room created successfully.\n")
+        return Room(room_name)
 
 
     def add_participants(self, username, client_socket, msg):
         try:
             room_name = msg[1]
-            self.logger.debug(f"In add_participants(), self.registered_users = {self.registered_users}")
+            if room_name not in self.rooms:
+                self.send_all(client_socket, "Access Denied!")
+                return
+            new_participants = self.requested_participants(client_socket, msg)
+            if new_participants is None and self.choice_follows(client_socket):
+                new_participants = self.receive(client_socket)
+            self.apply_new_participants(room_name, new_participants)
+            self.answer_named_participants(client_socket, msg)
 
-            registered_users = list(self.registered_users.keys())
+        except Exception as e:
+            self.logger.error(f"Exception in add_participants(): {e}")
 
-            for participant in self.rooms[room_name].participants:
-                self.logger.debug(f"IN FOR LOOP, participant = {participant}")
-                registered_users.remove(participant)
 
-            self.logger.debug(f"FINISHED FOR LOOP")
+    # ADD_PARTICIPANTS|room|user1|user2 names the participants to add in a single request,
+    # ADD_PARTICIPANTS|room is sent the candidates to choose from and gets None
+    def requested_participants(self, client_socket, msg):
+        if len(msg) > 2:
+            return "|".join(msg[2:])
+        self.send_participant_candidates(client_socket, msg[1])
+        return None
 
-            registered_users_str = "|".join(registered_users)
-            self.send_all(client_socket, registered_users_str)
 
-            new_participants = self.receive(client_socket)
-            if not new_participants or new_participants == '':
-                return
-            
-            new_participants = new_participants.split("|")
-            self.logger.debug(f"Received new participants from user: {new_participants}")
+    # a lockstep text client sends the chosen participants in the next frame,
+    # pipelined and v2 clients send them as a request of their own
+    def choice_follows(self, client_socket):
+        return not isinstance(client_socket, (Reply, BinarySocket))
 
-            if new_participants:
-                for participant in new_participants:
-                    self.rooms[room_name].participants.append(participant)
 
-        except Exception as e:
-            self.logger.error(f"Exception in add_participants(): {e}")
-        
-        
-            
+    # only a request that named the participants is answered
+    def answer_named_participants(self, client_socket, msg):
+        if len(msg) > 2:
+            self.send_all(client_socket, "SUCCESSFULLY ADDED PARTICIPANTS!")
+
+
+    # sends the registered users that are not yet in the room
+    def send_participant_candidates(self, client_socket, room_name):
+        self.logger.debug(f"In add_participants(), self.registered_users = {self.registered_users}")
+
+        participants = self.rooms[room_name].participants
+        candidates = [username for username in list(self.registered_users) if username not in participants]
+        self.send_user_list(client_socket, candidates)
+
+
+    def apply_new_participants(self, room_name, new_participants):
+        for participant in self.split_participants(new_participants):
+            self.add_participant(self.rooms[room_name], participant)
+
+
+    def split_participants(self, new_participants):
+        if not new_participants:
+            return []
+
+        new_participants = new_participants.split("|")
+        self.logger.debug(f"Received new participants from user: {new_participants}")
+        return new_participants
+
+
+    # returns None if the author may not post in the room, else the future of the log append;
+    # raises RateLimited, before anything is numbered or fanned out, if the author or the room is over its limit
     def send_message_to_room(self, author_username, room_name, message):
-        if not self.rooms[room_name]:
+        room = self.rooms.get(room_name)
+        if not room:
             return None
         
-        if (author_username not in self.rooms[room_name].participants) and (room_name != "Broadcast"):
+        if (author_username not in room.participants) and (room_name != "Broadcast"):
             return None
-        
-        messageObj = Message(room_name, author_username, message)
-        self.rooms[room_name].messages.append(messageObj)
 
-        for username in self.rooms[room_name].participants:
-            if username in self.logged_in_users:
-                self.send_all(self.logged_in_users[username].listening_socket, f"UPDATE|{room_name}|{author_username}|{message}")
-                # serialized_message = pickle.dumps(messageObj)
-                # self.logged_in_users[username].socket.sendall(serialized_message)
+        self.rate_limits.take(author_username, room)
+        return self.post_message(room, Message(room_name, author_username, message))
 
-        return True
+
+    # appends a message the author may post and fans it out, returns the future of the log append
+    def post_message(self, room, messageObj):
+        room_name, author_username, message = room.name, messageObj.author_name, messageObj.text
+        author_id = self.registered_users[author_username].uid
+
+        # held from taking the seq to the last enqueue, so every participant gets the room's UPDATEs in seq order
+        with room.lock:
+            durable = room.add_message(messageObj)
+
+            # encoded once per protocol, every recipient's queue holds a reference to the same frame
+            text_frame = binary_frame = None
+            for username in list(room.participants): # a copy, participants may be added meanwhile
+                user = self.logged_in_users.get(username)
+                if not user or not user.outbound:
+                    continue
+
+                sock = user.listening_socket
+                if isinstance(sock, BinarySocket):
+                    if binary_frame is None:
+                        binary_frame = framing.encode_frame(protocol_v2.encode_update(room.rid, author_id, messageObj.seq, message))
+                    with sock.lock:
+                        for frame in sock.definitions([(room.rid, room_name)], [(author_id, author_username)]):
+                            self.send_update(user, frame)
+                        self.send_update(user, binary_frame)
+
+                else:
+                    if text_frame is None:
+                        text_frame = self.encode_frame(f"UPDATE|{room_name}|{author_username}|{messageObj.seq}|{message}")
+                    self.send_update(user, text_frame)
+                    # serialized_message = pickle.dumps(messageObj)
+                    # self.logged_in_users[username].socket.sendall(serialized_message)
+
+        self.mark_read(author_username, room, messageObj.seq) # nobody has to be told about their own messages
+        return durable
         
 
-    def send_room_messages(self, client_socket, username, room_name):
-        serialized_messages = pickle.dumps(self.rooms[room_name].messages)
-        client_socket.sendall(serialized_messages)
-        return
-    
+    # only enqueues, the user's writer does the actual send
+    def send_update(self, user, frame):
+        user.outbound.put(frame)
+
+
+    def outbound_stats(self):
+        return {username: user.outbound.stats() for username, user in list(self.logged_in_users.items()) if user.outbound}
+
+
+    def send_history_page(self, client_socket, room, before=None, limit=None, since=0):
+        """Sends one page of the room's history as a JSON frame, newest message first.
+
+        Only the messages of the page are touched, so the cost does not grow with
+        the length of the history. "before" in the reply is the cursor for the
+        next (older) page, null once there is nothing older (than "since") left.
+        """
+        self.send_bytes(client_socket, self.encode_history_page(room, before, limit, since))
+
+
+    def encode_history_page(self, room, before=None, limit=None, since=0):
+        limit = max(1, min(limit or self.config.history_page_size, self.config.history_page_size))
+        records, cursor = room.history_page(limit, before, since)
+        return self.encode_page(room, records, cursor)
+
+
+    # the records are already JSON, they are spliced in as they come from the log
+    def encode_page(self, room, records, cursor):
+        return b'{"room": %s, "messages": [%s], "before": %s}' % (
+            json.dumps(room.name).encode(), b", ".join(records), json.dumps(cursor).encode())
+
 
     def login(self, client_socket, msg, addr):
         try:
-            msg = msg.split("|")
-            username = msg[1]
-            password = msg[2]
-            self.logger.debug(f"Client entered username: {username}, and password: {password}")
-
-            if ((not username) or (not password)):
-                self.send_all(client_socket, "Login failed. Username and Password are required fields!\n")
-                self.logger.debug("Login failed. Username and Password are required fields!\n")
-                return None
-            
-            elif username not in self.registered_users:
-                self.send_all(client_socket, "Login failed. User not found!\n")
-                self.logger.debug("Login failed. User not found!\n")
-                return None
-
-            if self.registered_users[username].password == password:
-                if username not in self.logged_in_users:
-                    self.logged_in_users[username] = User(username, password, socket=client_socket, address=addr)
-                    self.send_all(client_socket, "Login successful!\n")
-                    self.logger.debug("Login successful!\n")
-                    return username
-                
-                else:
-                    self.send_all(client_socket, "Login failed. User is already logged in.\n")
-                    self.logger.debug("Login failed. User already logged in.\n")
-                    return None
-                
-            else:
-                self.send_all(client_socket, "Login failed. Username and Password don't match.\n")
-                self.logger.debug("Login failed. Username and Password don't match.\n")
+            verification = self.begin_login(client_socket, msg)
+            if verification is None:
                 return None
+            return self.end_login(client_socket, msg, addr, verification.result())
 
         except Exception as e:
             self.send_all(client_socket, "Login failed. Ran into exception server-side!")
@@ -261,24 +730,87 @@ class Server:
             return False
 
 
+    # answers what can be answered right away, else returns the future of the password check (see credentials.py)
+    def begin_login(self, client_socket, msg):
+        username = msg[1]
+        password = msg[2]
+        self.logger.debug(f"Client entered username: {username}")
+
+        if ((not username) or (not password)):
+            self.send_all(client_socket, "Login failed. Username and Password are required fields!\n")
+            self.logger.debug("Login failed. Username and Password are required fields!\n")
+            return None
+
+        elif username not in self.registered_users:
+            self.send_all(client_socket, "Login failed. User not found!\n")
+            self.logger.debug("Login failed. User not found!\n")
+            return None
+
+        try:
+            return self.credentials.verify(password, self.registered_users[username].password)
+        except CredentialsBusy:
+            self.send_all(client_socket, "Login failed. Server is busy, try again later.\n")
+            self.logger.debug("Login failed. Too many logins at once.\n")
+            return None
+
+
+    def end_login(self, client_socket, msg, addr, verified):
+        if not verified:
+            self.send_all(client_socket, "Login failed. Username and Password don't match.\n")
+            self.logger.debug("Login failed. Username and Password don't match.\n")
+            return None
+
+        return self.answer_login(client_socket, msg, self.accept_login(User(msg[1], None, socket=client_socket, address=addr)))
+
+
+    # the reply once the login is accepted or not, the asyncio engine awaits accept_login() before it
+    def answer_login(self, client_socket, msg, accepted):
+        username = msg[1]
+        password = msg[2]
+        if accepted:
+            if not credentials.is_hashed(self.registered_users[username].password):
+                self.rehash_password(username, password)
+            self.send_all(client_socket, "Login successful!\n")
+            self.logger.debug("Login successful!\n")
+            return username
+
+        else:
+            self.send_all(client_socket, "Login failed. User is already logged in.\n")
+            self.logger.debug("Login failed. User already logged in.\n")
+            return None
+
+
+    # replaces a plaintext password stored before hashing, in the background; when the pool is busy the next login does
+    def rehash_password(self, username, password):
+        try:
+            hashing = self.credentials.hash(password)
+        except CredentialsBusy:
+            return
+        hashing.add_done_callback(lambda done: self.set_password(username, done.result()))
+
+
+    def set_password(self, username, password):
+        user = self.registered_users[username]
+        user.password = password
+        self.store.set_password(user)
+
+
+    # a user can only be logged in once, returns False if they already are
+    def accept_login(self, user):
+        with self.registry_lock:
+            if user.username in self.logged_in_users:
+                return False
+            self.logged_in_users[user.username] = user
+            self.presence.set_online(user.username)
+        return True
+
+
     def register(self, client_socket, msg, addr):
         try:
-            msg = msg.split("|")
-            username = msg[1]
-            password = msg[2]
-            self.logger.debug(f"Client entered new username: {username}, and new password: {password}")
-
-            if ((not username) or (not password)):
-                self.send_all(client_socket, "Login failed. Username and Password are required fields!\n")
-                self.logger.debug("Login failed. Username and Password are required fields!\n")
+            hashing = self.begin_register(client_socket, msg)
+            if hashing is None:
                 return None
-
-            if username not in self.registered_users:
-                self.registered_users[username] = User(username, password, socket=None, address=addr)
-                self.rooms["Broadcast"].participants.append(username)
-                self.send_all(client_socket, "Registration successful!\n")
-                self.logger.debug("Registration successful!\n")
-                return username
+            return self.end_register(client_socket, msg, addr, hashing.result())
 
         except Exception as e:
             self.send_all(client_socket, "Registration failed. Ran into exception server-side!")
@@ -286,82 +818,332 @@ class Server:
             return False
 
 
-    def broadcast(self, message):
-        print(f"Broadcasting message: {message}")
-        for username, user in self.logged_in_users.items():
-            try:
-                user.socket.send(message.encode())
-                return True
-            except Exception as e:
-                self.logger.error(f"Error sending message to client: {e}")
-                with self.lock:
-                    self.logged_in_users.pop(username)
-                    if socket in self.clients:
-                        self.clients.remove(socket)
-                    socket.close()
-                return False
+    # answers what can be answered right away, else returns the future of the password hash
+    def begin_register(self, client_socket, msg):
+        username = msg[1]
+        password = msg[2]
+        self.logger.debug(f"Client entered new username: {username}")
 
+        if ((not username) or (not password)):
+            self.send_all(client_socket, "Login failed. Username and Password are required fields!\n")
+            self.logger.debug("Login failed. Username and Password are required fields!\n")
+            return None
 
-    def logout(self, username, client_socket):
-        print(f"{username} has disconnected.")
-        client_socket.send(f"Logout successful!".encode())
-        self.broadcast(f"{username} has left the chat.")
+        # checked again when the user is added, this only saves hashing for a name that is taken
+        if username in self.registered_users:
+            self.send_all(client_socket, "Registration failed. Username is taken.\n")
+            return None
+
+        try:
+            return self.credentials.hash(password)
+        except CredentialsBusy:
+            self.send_all(client_socket, "Registration failed. Server is busy, try again later.\n")
+            return None
+
+
+    def end_register(self, client_socket, msg, addr, password_hash):
+        return self.answer_register(client_socket, msg, self.add_registered_user(User(msg[1], password_hash, socket=None, address=addr)))
 
+
+    # the reply once the user is added or not, the asyncio engine awaits add_registered_user() before it
+    def answer_register(self, client_socket, msg, added):
+        username = msg[1]
+        if added:
+            self.send_all(client_socket, "Registration successful!\n")
+            self.logger.debug("Registration successful!\n")
+            return username
+
+        self.send_all(client_socket, "Registration failed. Username is taken.\n")
+        return None
+
+
+    def logout(self, username, client_socket):
+        self.answer_logout(username, client_socket)
         if username:
-            with self.lock:
-                self.logged_in_users.pop(username)
+            self.release_login(username)
 
         self.cleanup_client(client_socket)
 
 
-    def send_rooms(self, username, client_socket):
+    def answer_logout(self, username, client_socket):
+        print(f"{username} has disconnected.")
         try:
-            rooms = ''
-            for room_name, room in self.rooms.items():
-                if (username in room.participants) or (room_name == "Broadcast"):
-                    rooms += f"|{room_name}"
-            
-            rooms = rooms.strip("|")
+            self.send_all(client_socket, "Logout successful!")
+        except OSError:
+            pass # the client is already gone, that is how a session ends without LOGOUT
+
+
+    def release_login(self, username):
+        with self.registry_lock:
+            user = self.logged_in_users.pop(username)
+            self.presence.set_offline(username)
+        if user.outbound:
+            self.close_listening_socket(user)
+
+
+    def close_listening_socket(self, user):
+        user.outbound.close()
+        if user.listening_socket:
+            self.cleanup_client(user.listening_socket)
+
+
+    # users who see each other's presence: those sharing a room other than Broadcast, which everybody is in
+    def contacts(self, username):
+        contacts = set()
+        for room_name in list(self.user_rooms.get(username, ())):
+            if room_name != "Broadcast":
+                contacts.update(list(self.rooms[room_name].participants))
+        contacts.discard(username)
+        return contacts
+
+
+    # a PRESENCE event for the user's LISTEN connection, returns False if they have none here
+    def send_presence(self, username, online, offline):
+        user = self.logged_in_users.get(username)
+        if not user or not user.outbound:
+            return False
+
+        sock = user.listening_socket
+        if isinstance(sock, BinarySocket):
+            users = [(self.registered_users[name].uid, name) for name in online + offline]
+            with sock.lock:
+                for frame in sock.definitions(users=users):
+                    self.send_update(user, frame)
+                self.send_update(user, framing.encode_frame(
+                    protocol_v2.encode_op_ids(protocol_v2.PRESENCE, [uid for uid, _ in users], len(online))))
+        else:
+            self.send_update(user, self.encode_frame("PRESENCE|" + json.dumps({"online": online, "offline": offline})))
+        return True
+
+
+    # SEND_ROOMS lists the user's rooms, SEND_ROOMS|unread also says how many unread messages each has
+    def send_rooms(self, username, client_socket, msg):
+        try:
+            # in the order the rooms were created
+            rooms = sorted(self.user_rooms.get(username, ()), key=lambda room_name: self.rooms[room_name].rid)
+
             self.logger.debug(f"Sending rooms ({rooms}) to user...")
-            self.send_all(client_socket, rooms)
+            if len(msg) > 1 and msg[1] == "unread":
+                cursors = self.registered_users[username].cursors
+                unread = [(self.rooms[name], cursors.unread(self.rooms[name].rid, len(self.rooms[name].messages)))
+                          for name in rooms]
+                self.send_unread_counts(client_socket, unread)
+            else:
+                self.send_room_list(client_socket, rooms)
 
         except Exception as e:
             self.logger.error(f"Exception in send_rooms(): {e}")
 
 
+    # a pipelined connection is closed by its reply queue, once the replies before it (LOGOUT's included) are out
     def cleanup_client(self, client_socket):
-        if client_socket in self.clients:
-            self.clients.remove(client_socket)
-        client_socket.close()
+        replies = getattr(client_socket, "outbound", None)
+        client_socket = self.raw_socket(client_socket)
+        self.admission.release(client_socket)
+        if replies:
+            replies.finish()
+        else:
+            client_socket.close()
+
+
+    # the socket (a StreamSocket on the asyncio engine) under the Reply and BinarySocket wrappers
+    def raw_socket(self, client_socket):
+        while hasattr(client_socket, "sock"):
+            client_socket = client_socket.sock
+        return client_socket
 
 
     # FOR SENDING MESSAGES
     def send_all(self, sock, msg):
-        fullmsg = struct.pack("!i", len(msg)) + msg.encode()
-        sock.sendall(fullmsg)
+        self.send_bytes(sock, msg.encode())
+
+
+    def send_bytes(self, sock, data):
+        if isinstance(sock, (Reply, BinarySocket)):
+            sock.send_frame(data)
+        else:
+            framing.send_frame(sock, data)
+
+
+    def send_room_list(self, sock, room_names):
+        if isinstance(sock, BinarySocket):
+            rooms = [(self.rooms[name].rid, name) for name in room_names]
+            self.send_name_list(sock, protocol_v2.ROOMS, sock.definitions(rooms=rooms), rooms)
+        else:
+            self.send_all(sock, "|".join(room_names))
+
+
+    # (room, unread count) pairs, as a JSON object of room name: count or a v2 UNREAD frame
+    def send_unread_counts(self, sock, unread):
+        if isinstance(sock, BinarySocket):
+            for frame in sock.definitions(rooms=[(room.rid, room.name) for room, _ in unread]):
+                sock.sendall(frame)
+            sock.send_binary(protocol_v2.encode_op_ids(protocol_v2.UNREAD, [n for room, count in unread for n in (room.rid, count)]))
+        else:
+            self.send_all(sock, json.dumps({room.name: count for room, count in unread}))
+
+
+    def send_user_list(self, sock, usernames):
+        if isinstance(sock, BinarySocket):
+            users = [(self.registered_users[name].uid, name) for name in usernames]
+            self.send_name_list(sock, protocol_v2.USERS, sock.definitions(users=users), users)
+        else:
+            self.send_all(sock, "|".join(usernames))
+
+
+    def send_name_list(self, sock, opcode, definitions, entries):
+        for frame in definitions:
+            sock.sendall(frame)
+        sock.send_binary(protocol_v2.encode_op_ids(opcode, [id for id, _ in entries]))
+
+
+    def encode_frame(self, msg):
+        return framing.encode_frame(msg.encode())
     
 
     # FOR RECEIVING MESSAGES
     def receive(self, sock):
-        length = struct.unpack("!i", self.recv_all(sock, 4))[0]
-        message = self.recv_all(sock, length).decode()
-        return message
-    
+        return framing.recv_text(sock, self.config.max_frame_size)
 
-    # HELPER METHOD
-    def recv_all(self, sock, length):
-        data=""
 
-        while len(data) < length:
-            more = sock.recv(length - len(data)).decode()
+    # reads one request and returns (request_id, fields), fields[0] being the action
+    def receive_request(self, sock):
+        if isinstance(sock, BinarySocket):
+            return None, self.parse_binary_request(framing.recv_frame(sock.sock, self.config.max_frame_size))
+        return self.parse_text_request(self.receive(sock))
 
-            if not more:
-                raise EOFError("Socket closed %d bytes into a %d-byte message" %(len(data), length))
-            data += more
-        
-        return data.encode()
+
+    def parse_text_request(self, msg):
+        request_id, msg = split_request_id(msg)
+        return request_id, msg.split("|")
+
+
+    # turns a v2 request into the same fields a text request splits into, ids resolved to names
+    def parse_binary_request(self, payload):
+        opcode, args = protocol_v2.decode_request(payload)
+        action = protocol_v2.ACTIONS[opcode]
+        if opcode in (protocol_v2.SELECT_ROOM, protocol_v2.SEND_MESSAGE, protocol_v2.HISTORY, protocol_v2.READ):
+            return [action, self.room_name_of(args[0]), *args[1:]]
+        if opcode == protocol_v2.ADD_PARTICIPANTS:
+            # like unknown usernames of the text protocol, unknown user ids are skipped
+            return [action, self.room_name_of(args[0]), *(self.users_by_id[uid] for uid in args[1:] if uid < len(self.users_by_id))]
+        if opcode == protocol_v2.SEARCH:
+            room_id, before, query = args
+            if room_id == protocol_v2.ALL_ROOMS:
+                return [action, query]
+            return [action, query, self.room_name_of(room_id), str(before or "")]
+        return [action, *args]
+
+
+    # the name of a room id from the wire, None (a name no room has, so the request is
+    # answered "Access Denied!" like a text request naming an unknown room) for an unknown id
+    def room_name_of(self, rid):
+        return self.rooms_by_id[rid].name if rid < len(self.rooms_by_id) else None
 
 
 if __name__ == "__main__":
-    server = Server()
-    server.run_server()
+    parser = argparse.ArgumentParser(description="Chat Room server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="threads: one thread per connection, asyncio: all connections on one event loop")
+    parser.add_argument("--cluster", help="peer addresses (host:port,host:port,...) of every node of a cluster (see cluster.py)")
+    parser.add_argument("--cluster-index", type=int, default=0, help="this node's place in --cluster")
+    parser.add_argument("--log-level", default="DEBUG", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--listen-backlog", type=int, default=ServerConfig.listen_backlog)
+    parser.add_argument("--max-connections", type=int, default=ServerConfig.max_connections)
+    parser.add_argument("--max-unauthenticated", type=int, default=ServerConfig.max_unauthenticated)
+    parser.add_argument("--auth-timeout", type=float, default=ServerConfig.auth_timeout)
+    parser.add_argument("--max-frame-size", type=int, default=ServerConfig.max_frame_size)
+    parser.add_argument("--pipeline-workers", type=int, default=ServerConfig.pipeline_workers)
+    parser.add_argument("--outbound-queue-size", type=int, default=ServerConfig.outbound_queue_size)
+    parser.add_argument("--outbound-queue-bytes", type=int, default=ServerConfig.outbound_queue_bytes)
+    parser.add_argument("--outbound-policy", choices=["drop_oldest", "disconnect", "mark_lagging"],
+                        default=ServerConfig.outbound_policy)
+    parser.add_argument("--password-hash", choices=list(credentials.SCHEMES), default=ServerConfig.password_hash)
+    parser.add_argument("--password-hash-cost", type=int, default=ServerConfig.password_hash_cost,
+                        help="scrypt n or PBKDF2 iterations, the scheme's default when not given")
+    parser.add_argument("--password-hash-workers", type=int, default=ServerConfig.password_hash_workers)
+    parser.add_argument("--login-concurrency", type=int, default=ServerConfig.login_concurrency,
+                        help="logins and registrations being hashed or waiting for it, more are refused as busy")
+    parser.add_argument("--presence-window", type=float, default=ServerConfig.presence_window,
+                        help="seconds of logins and logouts sent to the users' contacts together")
+    parser.add_argument("--user-message-rate", type=float, default=ServerConfig.user_message_rate,
+                        help="messages per second a user may send, 0 for no limit (see ratelimit.py)")
+    parser.add_argument("--user-message-burst", type=int, default=ServerConfig.user_message_burst)
+    parser.add_argument("--broadcast-message-rate", type=float, default=ServerConfig.broadcast_message_rate)
+    parser.add_argument("--broadcast-message-burst", type=int, default=ServerConfig.broadcast_message_burst)
+    parser.add_argument("--large-room-size", type=int, default=ServerConfig.large_room_size,
+                        help="participants from which a room has the large room rate limit")
+    parser.add_argument("--large-room-message-rate", type=float, default=ServerConfig.large_room_message_rate)
+    parser.add_argument("--large-room-message-burst", type=int, default=ServerConfig.large_room_message_burst)
+    parser.add_argument("--room-message-rate", type=float, default=ServerConfig.room_message_rate)
+    parser.add_argument("--room-message-burst", type=int, default=ServerConfig.room_message_burst)
+    parser.add_argument("--history-page-size", type=int, default=ServerConfig.history_page_size)
+    parser.add_argument("--history-hot-messages", type=int, default=ServerConfig.history_hot_messages)
+    parser.add_argument("--history-hot-bytes", type=int, default=ServerConfig.history_hot_bytes)
+    parser.add_argument("--history-hot-layout", choices=["records", "columnar"], default=ServerConfig.history_hot_layout)
+    parser.add_argument("--history-dir", default=ServerConfig.history_dir,
+                        help="where the message logs are kept, a temporary directory when not given")
+    parser.add_argument("--history-segment-bytes", type=int, default=ServerConfig.history_segment_bytes)
+    parser.add_argument("--history-compression", choices=["zlib", "lzma", "none"], default=ServerConfig.history_compression,
+                        help="how full log segments are compressed")
+    parser.add_argument("--history-block-messages", type=int, default=ServerConfig.history_block_messages)
+    parser.add_argument("--history-block-cache", type=int, default=ServerConfig.history_block_cache)
+    parser.add_argument("--message-durability", choices=["enqueue", "write", "fsync"],
+                        default=ServerConfig.message_durability,
+                        help="when SEND_MESSAGE is acknowledged: once queued, once written to the log, or once fsynced")
+    parser.add_argument("--message-commit-interval", type=float, default=ServerConfig.message_commit_interval)
+    parser.add_argument("--message-commit-batch", type=int, default=ServerConfig.message_commit_batch)
+    parser.add_argument("--store-path", default=ServerConfig.store_path,
+                        help="SQLite database of users, rooms and memberships, chat.db in the history directory when not given")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    config = ServerConfig(
+        listen_backlog=args.listen_backlog,
+        max_connections=args.max_connections,
+        max_unauthenticated=args.max_unauthenticated,
+        auth_timeout=args.auth_timeout,
+        max_frame_size=args.max_frame_size,
+        pipeline_workers=args.pipeline_workers,
+        outbound_queue_size=args.outbound_queue_size,
+        outbound_queue_bytes=args.outbound_queue_bytes,
+        outbound_policy=args.outbound_policy,
+        password_hash=args.password_hash,
+        password_hash_cost=args.password_hash_cost,
+        password_hash_workers=args.password_hash_workers,
+        login_concurrency=args.login_concurrency,
+        presence_window=args.presence_window,
+        user_message_rate=args.user_message_rate,
+        user_message_burst=args.user_message_burst,
+        broadcast_message_rate=args.broadcast_message_rate,
+        broadcast_message_burst=args.broadcast_message_burst,
+        large_room_size=args.large_room_size,
+        large_room_message_rate=args.large_room_message_rate,
+        large_room_message_burst=args.large_room_message_burst,
+        room_message_rate=args.room_message_rate,
+        room_message_burst=args.room_message_burst,
+        history_page_size=args.history_page_size,
+        history_hot_messages=args.history_hot_messages,
+        history_hot_bytes=args.history_hot_bytes,
+        history_hot_layout=args.history_hot_layout,
+        history_dir=args.history_dir,
+        history_segment_bytes=args.history_segment_bytes,
+        history_compression=args.history_compression,
+        history_block_messages=args.history_block_messages,
+        history_block_cache=args.history_block_cache,
+        message_durability=args.message_durability,
+        message_commit_interval=args.message_commit_interval,
+        message_commit_batch=args.message_commit_batch,
+        store_path=args.store_path,
+    )
+
+    if args.cluster:
+        from cluster import run_node
+        run_node(args.engine, args.host, args.port, config, args.cluster_index, args.cluster)
+    elif args.engine == "asyncio":
+        from async_server import AsyncServer
+        server = AsyncServer(args.host, args.port, config)
+    else:
+        server = Server(args.host, args.port, config)
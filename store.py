@@ -0,0 +1,171 @@
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    rid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS memberships (
+    rid INTEGER NOT NULL REFERENCES rooms(rid),
+    uid INTEGER NOT NULL REFERENCES users(uid),
+    PRIMARY KEY (rid, uid)
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    uid INTEGER NOT NULL REFERENCES users(uid),
+    rid INTEGER NOT NULL REFERENCES rooms(rid),
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (uid, rid)
+) WITHOUT ROWID;
+"""
+
+ADD_USER = "INSERT OR REPLACE INTO users (uid, username, password) VALUES (?, ?, ?)"
+SET_PASSWORD = "UPDATE users SET password = ? WHERE uid = ?"
+ADD_ROOM = "INSERT OR REPLACE INTO rooms (rid, name) VALUES (?, ?)"
+ADD_MEMBER = "INSERT OR IGNORE INTO memberships (rid, uid) VALUES (?, ?)"
+SET_CURSOR = "INSERT OR REPLACE INTO cursors (uid, rid, seq) VALUES (?, ?, ?)"
+
+
+class Store:
+    """Users, rooms and room memberships in a SQLite database (WAL mode).
+
+    The database is only read once, by load() at startup; the server answers
+    requests from its own dictionaries. Writes are queued and a committer
+    thread writes whatever has piled up in one transaction, once
+    commit_interval seconds have passed or batch_size writes are waiting, so
+    a request never waits on the disk. A write is durable once flush()
+    returns or its batch has been committed.
+
+    Read cursors move with every message a user reads, so only the latest
+    position of each (user, room) is kept until the next commit.
+    """
+
+    def __init__(self, path, commit_interval=0.05, batch_size=500):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.batch_size = batch_size
+
+        self.pending = [] # (sql, params) in the order they were made
+        self.cursors = {} # (uid, rid): seq, the newest cursor of each not yet committed
+        self.cursor_writes = 0 # set_cursor() calls the entries of cursors stand for
+        self.cond = threading.Condition()
+        self.committed = 0 # writes committed so far
+        self.queued = 0 # writes queued so far
+        self.closed = False
+
+        db = self.connect()
+        db.executescript(SCHEMA)
+        db.close()
+
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+
+    def start(self):
+        threading.Thread(target=self.run, name="store-committer", daemon=True).start()
+        return self
+
+
+    # returns (users, rooms, memberships, cursors) as rows of (uid, username, password), (rid, name),
+    # (rid, uid) and (uid, rid, seq), ordered by id
+    def load(self):
+        db = self.connect()
+        try:
+            return (db.execute("SELECT uid, username, password FROM users ORDER BY uid").fetchall(),
+                    db.execute("SELECT rid, name FROM rooms ORDER BY rid").fetchall(),
+                    db.execute("SELECT rid, uid FROM memberships ORDER BY rid, uid").fetchall(),
+                    db.execute("SELECT uid, rid, seq FROM cursors ORDER BY uid, rid").fetchall())
+        finally:
+            db.close()
+
+
+    def add_user(self, user):
+        self.write(ADD_USER, (user.uid, user.username, user.password))
+
+
+    def set_password(self, user):
+        self.write(SET_PASSWORD, (user.password, user.uid))
+
+
+    def add_room(self, room):
+        self.write(ADD_ROOM, (room.rid, room.name))
+
+
+    def add_member(self, room, user):
+        self.write(ADD_MEMBER, (room.rid, user.uid))
+
+
+    def set_cursor(self, user, room, seq):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Store is closed")
+            self.cursors[(user.uid, room.rid)] = seq
+            self.cursor_writes += 1
+            self.queued += 1
+
+
+    def write(self, sql, params):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Store is closed")
+            self.pending.append((sql, params))
+            self.queued += 1
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify_all()
+
+
+    def run(self):
+        db = self.connect()
+        while True:
+            with self.cond:
+                # a batch goes out when it is full, when the interval is up, or on close
+                self.cond.wait_for(lambda: len(self.pending) >= self.batch_size or self.closed,
+                                   timeout=self.commit_interval)
+                batch, self.pending = self.pending, []
+                cursors, self.cursors = self.cursors, {}
+                writes = len(batch) + self.cursor_writes
+                self.cursor_writes = 0
+                closed = self.closed
+
+            if writes:
+                try:
+                    with db: # one transaction for the whole batch
+                        for sql, params in batch:
+                            db.execute(sql, params)
+                        db.executemany(SET_CURSOR, [(uid, rid, seq) for (uid, rid), seq in cursors.items()])
+                except sqlite3.Error as e:
+                    logger.error(f"Could not commit {writes} store writes: {e}")
+
+                with self.cond:
+                    self.committed += writes
+                    self.cond.notify_all()
+
+            if closed:
+                break
+        db.close()
+
+
+    # waits until everything queued so far is committed
+    def flush(self, timeout=None):
+        with self.cond:
+            target = self.queued
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: self.committed >= target, timeout=timeout)
+
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
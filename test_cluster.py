@@ -0,0 +1,39 @@
+import json
+import socket
+import threading
+from queue import SimpleQueue
+import framing
+from cluster import BATCH_BYTES, DIRECT, PeerLink, take_batch
+
+
+def test_take_batch_stops_at_batch_bytes():
+    entries = [b"a" * (BATCH_BYTES // 2)] * 3 + [b"b"]
+    assert take_batch(entries) == [b"a" * (BATCH_BYTES // 2)] * 2
+    assert len(entries) == 2
+    # a single entry larger than a batch goes out alone
+    entries = [b"c" * (BATCH_BYTES + 1), b"d"]
+    assert take_batch(entries) == [b"c" * (BATCH_BYTES + 1)]
+    assert take_batch(entries) == [b"d"]
+
+
+def test_a_backlog_on_a_peer_link_goes_out_in_frames_of_batch_bytes():
+    a, b = socket.socketpair()
+    with a, b:
+        # a link that is already connected, the constructor would dial the peer
+        link = PeerLink.__new__(PeerLink)
+        link.peer, link.sock, link.failures = 1, a, SimpleQueue()
+        link.entries, link.cond = [], threading.Condition()
+        link.frames_sent = link.entries_sent = 0
+
+        text = "x" * 1000
+        for n in range(3000): # about three batches, queued before the sender starts
+            link.put((DIRECT, ["message", n, text]))
+        threading.Thread(target=link.run, daemon=True).start()
+
+        received = []
+        while len(received) < 3000:
+            payload = framing.recv_frame(b, 2 * BATCH_BYTES)
+            entries = json.loads(bytes(payload))
+            assert len(payload) <= BATCH_BYTES + 2 * len(entries) + 2 # the brackets and separators come on top
+            received.extend(entries)
+        assert [message[1] for _, message in received] == list(range(3000))
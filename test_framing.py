@@ -0,0 +1,90 @@
+import socket
+import asyncio
+import threading
+import pytest
+import framing
+from framing import HEADER, FrameTooLarge
+
+
+class TrickleSocket:
+    """Hands out what it was given at most step bytes per call, like a slow peer."""
+
+    def __init__(self, data, step=1):
+        self.data = memoryview(data)
+        self.step = step
+        self.sent = bytearray()
+
+    def recv(self, n):
+        chunk = bytes(self.data[:min(n, self.step)])
+        self.data = self.data[len(chunk):]
+        return chunk
+
+    def recv_into(self, buffer, n=0):
+        chunk = self.recv(n or len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def sendmsg(self, buffers):
+        sent = 0
+        for buf in buffers:
+            take = min(len(buf), self.step - sent)
+            self.sent += buf[:take]
+            sent += take
+        return sent
+
+
+@pytest.mark.parametrize("size", [0, 10, framing.SMALL_FRAME_SIZE, framing.REUSED_BUFFER_SIZE + 1])
+def test_frames_survive_reads_of_a_few_bytes(size):
+    payload = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+    sock = TrickleSocket(framing.encode_frame(payload) + framing.encode_frame(b"next"), step=7)
+    assert bytes(framing.recv_frame(sock)) == payload
+    assert bytes(framing.recv_frame(sock)) == b"next"
+
+
+def test_text_keeps_characters_split_across_reads():
+    sock = TrickleSocket(framing.encode_frame("čaj ☕".encode()), step=1)
+    assert framing.recv_text(sock) == "čaj ☕"
+
+
+@pytest.mark.parametrize("data", [HEADER.pack(5)[:2], HEADER.pack(5) + b"abc"])
+def test_a_closed_socket_in_the_middle_of_a_frame_raises_eof(data):
+    with pytest.raises(EOFError):
+        framing.recv_frame(TrickleSocket(data, step=2))
+
+
+def test_frame_size_limit():
+    assert bytes(framing.recv_frame(TrickleSocket(framing.encode_frame(b"abcd"), 4), max_frame_size=4)) == b"abcd"
+    with pytest.raises(FrameTooLarge):
+        framing.recv_frame(TrickleSocket(framing.encode_frame(b"abcde"), 4), max_frame_size=4)
+    with pytest.raises(FrameTooLarge):
+        framing.recv_frame(TrickleSocket(HEADER.pack(-1)))
+
+
+def test_send_buffers_finishes_partial_writes():
+    sock = TrickleSocket(b"", step=3)
+    framing.send_buffers(sock, [b"head", b"", b"payload"])
+    assert sock.sent == b"headpayload"
+
+
+def test_large_frames_over_a_socket():
+    payload = b"y" * (framing.SMALL_FRAME_SIZE * 5)
+    a, b = socket.socketpair()
+    with a, b:
+        writer = threading.Thread(target=framing.send_frame, args=(a, payload))
+        writer.start()
+        assert bytes(framing.recv_frame(b)) == payload
+        writer.join()
+
+
+def test_read_frame_checks_the_size_before_reading_the_payload():
+    async def read(data, max_frame_size):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await framing.read_frame(reader, max_frame_size)
+
+    assert asyncio.run(read(framing.encode_frame(b"abcd"), 4)) == b"abcd"
+    with pytest.raises(FrameTooLarge):
+        asyncio.run(read(HEADER.pack(5), 4))
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(read(HEADER.pack(4) + b"ab", 4))
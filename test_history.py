@@ -0,0 +1,43 @@
+import json
+import pytest
+from history import RoomHistory
+from message import Message
+from message_log import MessageLog
+
+
+@pytest.fixture(params=[False, True], ids=["records", "columnar"])
+def history(request, tmp_path):
+    history = RoomHistory("room", MessageLog(str(tmp_path)), max_messages=3, columnar=request.param)
+    for n in range(1, 6):
+        history.append(Message("room", "author", f"message {n}"))
+    return history
+
+
+def seqs(records):
+    return [json.loads(record)["seq"] for record in records]
+
+
+def test_pages_go_from_the_hot_window_into_the_log(history):
+    records, cursor = history.page(2)
+    assert (seqs(records), cursor) == ([5, 4], 4)
+    records, cursor = history.page(2, before=cursor)
+    assert (seqs(records), cursor) == ([3, 2], 2)
+    records, cursor = history.page(2, before=cursor)
+    assert (seqs(records), cursor) == ([1], None)
+
+
+def test_page_since_only_has_what_came_after(history):
+    records, cursor = history.page(10, since=2)
+    assert (seqs(records), cursor) == ([5, 4, 3], None)
+
+
+@pytest.mark.parametrize("since", [5, 6, 100])
+def test_page_since_the_last_message_or_past_it_is_empty(history, since):
+    assert history.page(10, since=since) == ([], None)
+    assert history.page(10, before=3, since=since) == ([], None)
+
+
+def test_read_of_an_empty_range(history):
+    assert history.read(6, 5) == []
+    assert history.read(5, 3) == []
+    assert seqs(history.read(2, 4)) == [2, 3, 4]
@@ -0,0 +1,170 @@
+import os
+import pytest
+from history import RoomHistory
+from message import Message
+from message_log import (INDEX_INTERVAL, BlockCache, CompressedSegment, Compressor, LogCommitter, LogUnwritable,
+                         MessageLog, Segment)
+
+
+def records(n, start=1):
+    return [b'{"seq": %d}\n' % seq for seq in range(start, start + n)]
+
+
+def write_log(directory, n, segment_bytes=1 << 20):
+    log = MessageLog(str(directory), segment_bytes)
+    log.write(records(n))
+    log.close()
+    return log
+
+
+def test_reopened_log_goes_on_where_it_ended(tmp_path):
+    write_log(tmp_path, 3 * INDEX_INTERVAL + 5)
+
+    log = MessageLog(str(tmp_path))
+    assert log.last_seq == 3 * INDEX_INTERVAL + 5
+    assert log.read(1, 2) == [b'{"seq": 1}', b'{"seq": 2}']
+    assert log.read(log.last_seq, log.last_seq) == [b'{"seq": %d}' % log.last_seq]
+
+
+def test_recovery_drops_a_partial_record(tmp_path):
+    write_log(tmp_path, INDEX_INTERVAL + 1)
+    segment = Segment(str(tmp_path), 1)
+    size = os.path.getsize(segment.log_path)
+    with open(segment.log_path, "ab") as f:
+        f.write(b'{"seq": ') # cut short by a crash
+
+    segment.recover()
+    assert segment.count == INDEX_INTERVAL + 1
+    assert os.path.getsize(segment.log_path) == size
+
+
+def test_recovery_drops_index_entries_past_a_truncated_log(tmp_path):
+    write_log(tmp_path, 2 * INDEX_INTERVAL + 1)
+    segment = Segment(str(tmp_path), 1)
+    # the last record, the only one of the third index entry, is lost along with half of the one before
+    with open(segment.log_path, "rb") as f:
+        data = f.read()
+    last = data.rindex(b"\n", 0, len(data) - 1) + 1
+    os.truncate(segment.log_path, last - 3)
+
+    segment.recover()
+    assert segment.count == 2 * INDEX_INTERVAL - 1
+    assert len(segment.index) == 2
+    with open(segment.index_path, "rb") as f:
+        assert f.read() == segment.index.tobytes()
+
+    log = MessageLog(str(tmp_path))
+    assert log.last_seq == 2 * INDEX_INTERVAL - 1
+    assert log.append(b'{"seq": "next"}\n').done()
+    assert log.read(log.last_seq - 1, log.last_seq) == [b'{"seq": %d}' % (2 * INDEX_INTERVAL - 1), b'{"seq": "next"}']
+
+
+def test_recovery_rebuilds_a_missing_index(tmp_path):
+    write_log(tmp_path, 2 * INDEX_INTERVAL + 1)
+    os.remove(Segment(str(tmp_path), 1).index_path)
+
+    log = MessageLog(str(tmp_path))
+    assert log.last_seq == 2 * INDEX_INTERVAL + 1
+    assert log.read(INDEX_INTERVAL + 1, INDEX_INTERVAL + 1) == [b'{"seq": %d}' % (INDEX_INTERVAL + 1)]
+
+
+def test_reads_span_segments(tmp_path):
+    write_log(tmp_path, 100, segment_bytes=200)
+
+    log = MessageLog(str(tmp_path), 200)
+    assert len(log.segments) > 2
+    assert log.read(1, 100) == [record.rstrip(b"\n") for record in records(100)]
+    assert log.read(5, 4) == []
+
+
+def test_compressed_segments_read_like_the_log_and_reopen(tmp_path):
+    log = MessageLog(str(tmp_path), 200, compressor=Compressor(block_messages=4))
+    log.write(records(100))
+    full = log.segments[:-1]
+    for segment in full:
+        log.compressor.compress(log, segment)
+    assert all(isinstance(segment, CompressedSegment) for segment in log.segments[:-1])
+    assert not any(os.path.exists(segment.log_path) for segment in full)
+    assert log.read(1, 100) == [record.rstrip(b"\n") for record in records(100)]
+    log.close()
+
+    log = MessageLog(str(tmp_path), 200)
+    assert log.last_seq == 100
+    assert isinstance(log.segments[0], CompressedSegment)
+    assert log.read(3, 6) == [b'{"seq": %d}' % seq for seq in range(3, 7)]
+    assert log.read(1, 100) == [record.rstrip(b"\n") for record in records(100)]
+
+
+def test_reopen_finishes_an_interrupted_compression(tmp_path):
+    log = write_log(tmp_path, 100, segment_bytes=200)
+    segment = log.segments[0]
+    # the .blk was written but the process died before the segment was deleted, and a later one left a .tmp
+    with open(segment.log_path, "rb") as f:
+        CompressedSegment.write(os.path.join(str(tmp_path), f"{segment.first_seq:020d}.blk"),
+                                f.read().splitlines(), "zlib", 4)
+    open(os.path.join(str(tmp_path), f"{log.segments[1].first_seq:020d}.blk.tmp"), "wb").close()
+
+    log = MessageLog(str(tmp_path), 200)
+    assert isinstance(log.segments[0], CompressedSegment)
+    assert not os.path.exists(segment.log_path)
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+    assert log.read(1, 100) == [record.rstrip(b"\n") for record in records(100)]
+
+
+def test_block_cache_keeps_the_most_recently_read_blocks():
+    cache = BlockCache(capacity=2)
+    cache.put("a", [b"1"])
+    cache.put("b", [b"2"])
+    assert cache.get("a") == [b"1"]
+    cache.put("c", [b"3"])
+    assert cache.get("b") is None
+    assert cache.get("a") == [b"1"] and cache.get("c") == [b"3"]
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def fail_after(log, n):
+    """Lets the active segment of the log take n more records, then fails the way a bug would, not with an OSError."""
+    segment = log.segments[-1]
+    append = segment.append
+    def failing(record):
+        if segment.count >= n:
+            raise ValueError("broken")
+        append(record)
+    segment.append = failing
+
+
+def test_a_failed_commit_fails_the_futures_of_its_log_only(tmp_path):
+    committer = LogCommitter(interval=1)
+    broken, other = MessageLog(str(tmp_path / "broken"), committer=committer), MessageLog(str(tmp_path / "other"), committer=committer)
+    fail_after(broken, 2)
+    futures = [broken.append(record) for record in records(4)]
+    others = [other.append(record) for record in records(2)]
+    committer.start()
+
+    for future in futures:
+        assert isinstance(future.exception(5), LogUnwritable)
+    assert [future.result(5) for future in others] == [None, None]
+    # the records of the failed write do not count as written, and nothing else is taken
+    assert broken.last_seq == 0
+    with pytest.raises(LogUnwritable):
+        broken.append(records(1)[0])
+    # the committer is still running
+    assert other.append(records(1, 3)[0]).result(5) is None
+    committer.close()
+
+
+def test_a_room_on_a_failed_log_refuses_messages_without_numbering_them(tmp_path):
+    log = MessageLog(str(tmp_path))
+    history = RoomHistory("room", log, max_messages=1)
+    for n in range(1, 3):
+        history.append(Message("room", "author", f"message {n}"))
+    fail_after(log, 2)
+
+    for _ in range(2):
+        with pytest.raises(LogUnwritable):
+            history.append(Message("room", "author", "lost"))
+    assert history.last_seq == log.last_seq == 2
+    assert len(history.page(10)[0]) == 2
+
+    log.close()
+    assert MessageLog(str(tmp_path)).last_seq == 2
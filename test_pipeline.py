@@ -0,0 +1,65 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pipeline import SerialQueue, split_request_id
+
+
+@pytest.fixture
+def pool():
+    with ThreadPoolExecutor(4) as pool:
+        yield pool
+
+
+def test_split_request_id():
+    assert split_request_id("#17|SEND_MESSAGE|Broadcast|hi") == ("17", "SEND_MESSAGE|Broadcast|hi")
+    assert split_request_id("SEND_ROOMS") == (None, "SEND_ROOMS")
+
+
+def test_calls_run_one_at_a_time_in_order(pool):
+    calls = SerialQueue(pool)
+    done = []
+    running = []
+    overlapped = [] # calls that started while another one was running, an assert would not fail the test from the pool
+    finished = threading.Event()
+
+    def call(n):
+        if running:
+            overlapped.append(n)
+        running.append(n)
+        time.sleep(0.0005)
+        done.append(n)
+        running.remove(n)
+        if n == 199:
+            finished.set()
+
+    for n in range(200):
+        calls.submit(call, n)
+    assert finished.wait(10)
+    assert done == list(range(200))
+    assert overlapped == []
+
+
+def test_a_blocked_queue_does_not_hold_up_another(pool):
+    release = threading.Event()
+    other_ran = threading.Event()
+    SerialQueue(pool).submit(release.wait, 10)
+    SerialQueue(pool).submit(other_ran.set)
+    assert other_ran.wait(5)
+    release.set()
+
+
+def test_submit_waits_for_room(pool):
+    calls = SerialQueue(pool, maxsize=2)
+    release = threading.Event()
+    calls.submit(release.wait, 10) # taken off the queue by the drain, which then blocks in it
+    while calls.calls:
+        time.sleep(0.001)
+    calls.submit(lambda: None)
+    calls.submit(lambda: None)
+
+    submitted = threading.Event()
+    threading.Thread(target=lambda: (calls.submit(lambda: None), submitted.set()), daemon=True).start()
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(5)
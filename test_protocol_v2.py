@@ -0,0 +1,57 @@
+import socket
+from types import SimpleNamespace
+import pytest
+import framing
+import protocol_v2
+from outbound import DROP_OLDEST, MARK_LAGGING, OutboundQueue
+from protocol_v2 import BinarySocket
+from server import Server
+
+
+def decoded(queue):
+    return [protocol_v2.decode_server_frame(frame[framing.HEADER.size:]) for frame in queue.frames]
+
+
+def fan_out(queue, sock, room_id, author_id, seq):
+    with sock.lock:
+        for frame in sock.definitions([(room_id, "room")], [(author_id, "author")]):
+            queue.put(frame)
+        queue.put(framing.encode_frame(protocol_v2.encode_update(room_id, author_id, seq, "hi")))
+
+
+@pytest.mark.parametrize("policy", [DROP_OLDEST, MARK_LAGGING])
+def test_full_queues_keep_the_definitions_the_updates_need(policy):
+    a, b = socket.socketpair()
+    with a, b:
+        sock, queue = BinarySocket(a), OutboundQueue(a, maxsize=2, policy=policy) # not started, nothing is written
+        fan_out(queue, sock, 1, 7, 1)
+        fan_out(queue, sock, 1, 7, 2)
+        fan_out(queue, sock, 2, 7, 1)
+
+        assert queue.dropped
+        # every id the connection counts as known is defined in the queue, before any UPDATE that uses it
+        rooms, users = set(), set()
+        for opcode, args in decoded(queue):
+            if opcode == protocol_v2.DEFINE_ROOM:
+                rooms.add(args[0])
+            elif opcode == protocol_v2.DEFINE_USER:
+                users.add(args[0])
+            else:
+                assert args[0] in rooms and args[1] in users
+        assert (rooms, users) == (sock.known_rooms, sock.known_users) == ({1, 2}, {7})
+
+
+def server_with(rooms, users):
+    fake = SimpleNamespace(rooms_by_id=[SimpleNamespace(name=name) for name in rooms], users_by_id=users)
+    fake.room_name_of = lambda rid: Server.room_name_of(fake, rid)
+    return fake
+
+
+def test_unknown_ids_resolve_to_no_room_and_are_skipped_as_users():
+    fake = server_with(["Broadcast", "room"], ["alice"])
+    parse = lambda payload: Server.parse_binary_request(fake, payload)
+
+    assert parse(protocol_v2.encode_op_id(protocol_v2.SELECT_ROOM, 1)) == ["SELECT_ROOM", "room"]
+    assert parse(protocol_v2.encode_op_id(protocol_v2.SELECT_ROOM, 5)) == ["SELECT_ROOM", None]
+    assert parse(protocol_v2.encode_op_id(protocol_v2.SEND_MESSAGE, 5, "hi")) == ["SEND_MESSAGE", None, "hi"]
+    assert parse(protocol_v2.encode_op_ids(protocol_v2.ADD_PARTICIPANTS, [0, 9], first=1)) == ["ADD_PARTICIPANTS", "room", "alice"]
@@ -0,0 +1,78 @@
+import pytest
+from ratelimit import BROADCAST, LARGE, ROOM, SMALL, USER, RateLimited, RateLimits, TokenBucket
+from room import Room
+
+
+def test_bucket_allows_a_burst_then_waits_for_the_refill():
+    bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(0.0) == pytest.approx(0.5)
+    assert bucket.take(0.25) == pytest.approx(0.25)
+    assert bucket.take(0.5) == 0.0
+
+
+def test_bucket_refills_up_to_its_burst_only():
+    bucket = TokenBucket(rate=10.0, burst=2, now=0.0)
+    bucket.take(0.0)
+    bucket.take(0.0)
+    bucket.take(100.0)
+    assert bucket.tokens == pytest.approx(1.0)
+
+
+def test_bucket_gives_back_and_lowers_its_limit():
+    bucket = TokenBucket(rate=1.0, burst=2, now=0.0)
+    bucket.take(0.0)
+    bucket.give_back()
+    bucket.give_back()
+    assert bucket.tokens == 2
+    bucket.set_limit(1.0, 1)
+    assert bucket.tokens == 1
+    assert bucket.take(0.0) == 0.0
+    assert bucket.take(0.0) == pytest.approx(1.0)
+
+
+def room(name, participants=2):
+    room = Room(name)
+    room.participants.update(f"user{n}" for n in range(participants))
+    return room
+
+
+def limits(user_limit=(0, 0), small=(0, 0), large=(0, 0), broadcast=(0, 0)):
+    return RateLimits(user_limit, {SMALL: small, LARGE: large, BROADCAST: broadcast}, large_room_size=10)
+
+
+def test_user_limit_is_counted_across_rooms():
+    rate_limits = limits(user_limit=(0.001, 1))
+    rate_limits.take("alice", room("a"))
+    with pytest.raises(RateLimited) as refused:
+        rate_limits.take("alice", room("b"))
+    assert refused.value.scope == USER
+    rate_limits.take("bob", room("b"))
+    assert rate_limits.stats()["limited"] == {USER: 1, ROOM: 0}
+
+
+def test_room_refusal_gives_the_author_token_back():
+    rate_limits = limits(user_limit=(0.001, 1), small=(0.001, 1))
+    quiet = room("quiet")
+    rate_limits.take("alice", quiet)
+    with pytest.raises(RateLimited) as refused:
+        rate_limits.take("bob", quiet)
+    assert refused.value.scope == ROOM
+    assert rate_limits.users["bob"].tokens == pytest.approx(1.0, abs=0.01)
+    assert rate_limits.stats()["limited_by_class"][SMALL] == 1
+
+
+def test_room_takes_the_limit_of_its_class():
+    rate_limits = limits(small=(0.001, 1), large=(0.001, 2), broadcast=(0, 0))
+    growing = room("growing")
+    rate_limits.take("alice", growing)
+    growing.participants.update(f"more{n}" for n in range(10))
+    assert rate_limits.room_class(growing) == LARGE
+    # the same bucket, changed in place: it holds up to 2 from now on but gets no tokens for the change
+    with pytest.raises(RateLimited):
+        rate_limits.take("alice", growing)
+    assert rate_limits.rooms["growing"].burst == 2
+
+    broadcast = room("Broadcast", 50)
+    for _ in range(10):
+        rate_limits.take("alice", broadcast)
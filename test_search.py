@@ -0,0 +1,62 @@
+import json
+import pytest
+from history import IndexNotReady, RoomHistory
+from message import Message
+from message_log import MessageLog
+from search import SearchIndex, tokenize
+
+
+def test_tokenize_folds_case_and_drops_punctuation():
+    assert tokenize("Hello, hello WORLD_1!") == {"hello", "world_1"}
+
+
+def test_search_pages_newest_first_until_no_match_is_left():
+    index = SearchIndex()
+    for seq in range(1, 11):
+        index.add(seq, "ping pong" if seq % 2 else "ping")
+
+    assert index.search("pong", 2) == ([9, 7], 7)
+    assert index.search("pong", 2, before=7) == ([5, 3], 3)
+    assert index.search("pong", 2, before=3) == ([1], None)
+    # exactly limit matches left is the last page
+    assert index.search("PONG ping", 5) == ([9, 7, 5, 3, 1], None)
+
+
+def test_search_needs_every_term():
+    index = SearchIndex()
+    index.add(1, "red apple")
+    index.add(2, "green apple")
+    assert index.search("apple red", 10) == ([1], None)
+    assert index.search("apple blue", 10) == ([], None)
+    assert index.search("", 10) == ([], None)
+
+
+def post(history, text):
+    history.append(Message("room", "author", text))
+
+
+def test_room_search_raises_index_not_ready_until_built():
+    history = RoomHistory("room")
+    post(history, "hello")
+    with pytest.raises(IndexNotReady):
+        history.search("hello", 10)
+
+    history.build_index()
+    post(history, "hello again")
+    records, cursor = history.search("hello", 1)
+    assert [json.loads(record)["seq"] for record in records] == [2]
+    records, cursor = history.search("hello", 1, before=cursor)
+    assert [json.loads(record)["text"] for record in records] == ["hello"]
+    assert cursor is None
+
+
+def test_room_index_is_built_from_the_log_and_the_hot_window(tmp_path):
+    history = RoomHistory("room", MessageLog(str(tmp_path)), max_messages=2)
+    for n in range(5):
+        post(history, f"message {n}")
+    assert len(history.hot) == 2
+
+    history.build_index()
+    records, cursor = history.search("message", 10)
+    assert [json.loads(record)["seq"] for record in records] == [5, 4, 3, 2, 1]
+    assert cursor is None
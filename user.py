@@ -1,6 +1,7 @@
 import sys
 import threading
 import logging
+from read_cursors import ReadCursors
 
 logger = logging.getLogger(__name__)
 #logger.addHandler(logging.StreamHandler(sys.stdout))
@@ -8,22 +9,20 @@ logging.basicConfig(level=logging.DEBUG) # DEBUG or ERROR
 
 class User:
 
-    username = None # Unique (PK)
-    password = None
-    socket = None
-    listening_socket = None
-    address = None
+    __slots__ = ("uid", "username", "password", "socket", "listening_socket", "outbound", "address", "cursors")
 
     def __init__(self, username, password, socket=None, listening_socket=None, address=None):
-        self.username = username
-        self.password = password
+        self.uid = None # numeric id, assigned by the server
+        self.username = sys.intern(username) # Unique (PK)
+        self.password = password # salted hash (see credentials.py), None on the User of a login
         self.socket = socket
         self.listening_socket = listening_socket
+        self.outbound = None # OutboundQueue in front of listening_socket
         self.address = address
+        self.cursors = ReadCursors() # of the registered user, how far they have read in each room
 
     def toJSON(self):
         return {
             "uid": self.uid,
             "username": self.username,
-            "password": self.password
         }
\ No newline at end of file